@@ -1,49 +1,144 @@
 # https://zhuanlan.zhihu.com/p/648127076
 import torch              # PyTorch深度学习框架的核心库，提供张量操作和自动求导功能
 import torch.nn as nn     # PyTorch的神经网络模块，包含各种层、激活函数等
+import torch.nn.functional as F   # 函数式接口，包含scaled_dot_product_attention等算子
 import numpy as np        # 数值计算库
+import hashlib            # 编码器输出缓存按输入内容计算key
+from collections import OrderedDict
+from functools import partial
+from torch.utils.checkpoint import checkpoint   # 激活重计算
 
-def pos_sinusoid_embedding(seq_len, d_model):
+def pos_sinusoid_embedding(seq_len, d_model, offset=0):
     """
     生成正弦余弦位置编码
     Position Encoding用于给序列中的每个位置添加位置信息
+    offset不为0时直接计算位置 offset ~ offset+seq_len-1，结果和完整表中对应的行相同
     """
-    # torch.zeros() 创建一个全零张量，形状为(seq_len, d_model)
-    embeddings = torch.zeros((seq_len, d_model))
-    for i in range(d_model):
-        # 偶数维度用sin，奇数维度用cos
-        f = torch.sin if i % 2 == 0 else torch.cos
-        # torch.arange(0, seq_len) 创建从0到seq_len-1的序列张量 [0,1,2,...,seq_len-1]
-        # embeddings[:, i] 表示选择所有行的第i列
-        embeddings[:, i] = f(torch.arange(0, seq_len) / np.power(1e4, 2 * (i // 2) / d_model))
+    # 第i列的频率为 1 / 10000^(2*(i//2)/d_model)，所有列一次算完，不需要按列循环
+    freqs = torch.from_numpy(np.power(1e4, 2 * (np.arange(d_model) // 2) / d_model))
+    # torch.arange(offset, offset+seq_len) 创建位置序列张量 [offset,...,offset+seq_len-1]
+    # 广播得到 (seq_len, d_model) 的角度矩阵
+    angles = torch.arange(offset, offset + seq_len).unsqueeze(1) / freqs.float()
+    # 偶数维度用sin，奇数维度用cos
+    embeddings = torch.where(torch.arange(d_model) % 2 == 0, torch.sin(angles), torch.cos(angles))
     # .float() 将张量转换为float32类型
     return embeddings.float()
 
+# 所有模块共享的位置编码表，key为(类名, d_model, dtype, device)
+_pos_tables = {}
+
+class SinusoidPositionEmbedding(nn.Module):
+    """
+    正弦余弦位置编码，没有参数
+    相同(d_model, dtype, device)的模块共享同一张表，序列变长时按2倍扩容，
+    不再在构造时为每个模块各分配一张固定长度(tgt_len)的表
+    """
+    def __init__(self, d_model):
+        super(SinusoidPositionEmbedding, self).__init__()
+        self.d_model = d_model
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 旧checkpoint里nn.Embedding.from_pretrained保存的表不需要加载
+        state_dict.pop(f"{prefix}weight", None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def compute(self, seq_len, offset=0):
+        """
+        直接计算位置 offset ~ offset+seq_len-1 的位置编码，不使用共享表(流式编码用)
+        """
+        return pos_sinusoid_embedding(seq_len, self.d_model, offset)
+
+    def table(self, seq_len, dtype=torch.float32, device=None):
+        """
+        返回至少seq_len行的共享位置编码表
+        """
+        key = (type(self).__name__, self.d_model, dtype, torch.device(device or "cpu"))
+        table = _pos_tables.get(key)
+        if table is None or table.size(0) < seq_len:
+            size = max(seq_len, 64 if table is None else 2 * table.size(0))
+            # 第一次构造或扩容可能发生在torch.inference_mode()里，生成的是inference tensor，
+            # 之后训练时RoPE要为反向保存cos/sin会报错；共享表总是按普通张量构造
+            with torch.inference_mode(False):
+                table = self.compute(size).to(dtype=dtype, device=key[-1])
+            _pos_tables[key] = table
+        return table
+
+    def forward(self, seq_len, offset=0, dtype=torch.float32, device=None):
+        """
+        返回位置 offset ~ offset+seq_len-1 的位置编码，形状为(seq_len, d_model)
+        """
+        return self.table(offset + seq_len, dtype, device)[offset:offset + seq_len]
+
+def rope_cos_sin(seq_len, head_dim, offset=0, base=1e4):
+    """
+    生成旋转位置编码(RoPE)的cos/sin表，形状为(seq_len, 2, head_dim)
+    第i对维度(i, i+head_dim/2)以频率 1 / base^(2i/head_dim) 旋转，角度用float64计算，位置很大时也准确
+    """
+    inv_freq = 1. / base ** (torch.arange(0, head_dim, 2, dtype=torch.float64) / head_dim)
+    angles = torch.arange(offset, offset + seq_len, dtype=torch.float64).unsqueeze(1) * inv_freq
+    angles = torch.cat([angles, angles], dim=-1)
+    return torch.stack([angles.cos(), angles.sin()], dim=1).float()
+
+class RotaryEmbedding(SinusoidPositionEmbedding):
+    """
+    旋转位置编码的cos/sin表，和SinusoidPositionEmbedding一样共享、按需扩容
+    表里每个位置是(2, head_dim)的[cos; sin]，作为freqs_cis传给MultiHeadAttention，由它旋转Q和K
+    """
+    def __init__(self, head_dim):
+        assert head_dim % 2 == 0, "RoPE needs an even head dimension"
+        super(RotaryEmbedding, self).__init__(head_dim)
+
+    def compute(self, seq_len, offset=0):
+        return rope_cos_sin(seq_len, self.d_model, offset)
+
+def apply_rotary_emb(x, freqs_cis):
+    """
+    按位置旋转Q或K
+    Args:
+        x: [N, num_heads, seq_len, head_dim]
+        freqs_cis: (seq_len, 2, head_dim) cos/sin of the positions of x, from RotaryEmbedding,
+            or (N, seq_len, 2, head_dim) when every row has its own positions.
+    """
+    cos, sin = freqs_cis.unbind(-2)
+    if cos.dim() == 3:
+        cos, sin = cos.unsqueeze(1), sin.unsqueeze(1)     # 沿头维广播
+    cos, sin = cos.to(x.dtype), sin.to(x.dtype)
+    x1, x2 = x.chunk(2, dim=-1)
+    return x * cos + torch.cat([-x2, x1], dim=-1) * sin
+
+POS_TYPES = ("sinusoid", "rope")
+
+def get_key_padding_mask(max_len: int, feat_lens: torch.Tensor, device: torch.device) -> torch.Tensor:
+    """
+    生成key填充掩码，形状为(batch_size, max_len)，超出实际长度的位置为True(屏蔽)
+    """
+    # torch.arange(max_len) 与每个样本的长度广播比较，不需要按batch循环
+    return torch.arange(max_len, device=device).unsqueeze(0) >= feat_lens.to(device).unsqueeze(1)
+
 def get_len_mask(b: int, max_len: int, feat_lens: torch.Tensor, device: torch.device) -> torch.Tensor:
     """
     生成长度掩码，用于屏蔽超出实际序列长度的部分
+    返回(batch_size, max_len, max_len)的广播视图，每个样本只占一行(max_len)的内存
     """
-    # torch.ones() 创建全1张量，形状为(batch_size, max_len, max_len)
-    # device参数指定张量存储在哪个设备上(CPU或GPU)
-    attn_mask = torch.ones((b, max_len, max_len), device=device)
-    for i in range(b):
-        # attn_mask[i, :, :feat_lens[i]] 表示第i个样本的所有行，前feat_lens[i]列
-        # 将有效长度内的位置设为0(不屏蔽)，其余位置保持1(屏蔽)
-        attn_mask[i, :, :feat_lens[i]] = 0
-    # .to(torch.bool) 将张量类型转换为布尔型
-    return attn_mask.to(torch.bool)
+    # 第i个样本的所有行，前feat_lens[i]列为False(不屏蔽)，其余位置为True(屏蔽)
+    # .expand() 只改变stride，不复制数据
+    return get_key_padding_mask(max_len, feat_lens, device).unsqueeze(1).expand(b, max_len, max_len)
 
-def get_subsequent_mask(b: int, max_len: int, device: torch.device) -> torch.Tensor:
+def get_subsequent_mask(b: int, max_len: int, device: torch.device, offset: int = 0) -> torch.Tensor:
     """
     生成后续位置掩码，用于Decoder中防止看到未来的信息
     Args:
         b: batch-size.
         max_len: the length of the whole seqeunce.
         device: cuda or cpu.
+        offset: number of tokens already in the KV cache. the mask is (b, max_len, offset+max_len).
     """
     # torch.triu() 返回矩阵的上三角部分，diagonal=1表示主对角线上方的元素
     # 这样可以屏蔽当前位置之后的所有位置，实现因果掩码
-    return torch.triu(torch.ones((b, max_len, max_len), device=device), diagonal=1).to(torch.bool)     # or .to(torch.uint8)
+    # 有KV缓存时，新token前面还有offset个已缓存的位置，它们都可见，所以对角线右移offset
+    # 所有样本共用同一个(max_len, offset+max_len)矩阵，.expand()得到batch维的视图
+    mask = torch.triu(torch.ones((max_len, offset + max_len), dtype=torch.bool, device=device), diagonal=offset + 1)
+    return mask.unsqueeze(0).expand(b, max_len, offset + max_len)
 
 def get_enc_dec_mask(
     b: int, max_feat_len: int, feat_lens: torch.Tensor, max_label_len: int, device: torch.device
@@ -51,20 +146,439 @@ def get_enc_dec_mask(
     """
     生成编码器-解码器交叉注意力掩码
     """
-    # torch.zeros() 创建全零张量，形状为(batch_size, decoder_seq_len, encoder_seq_len)
-    attn_mask = torch.zeros((b, max_label_len, max_feat_len), device=device)       # (b, seq_q, seq_k)
-    for i in range(b):
-        # 将超出编码器实际长度的位置设为1(屏蔽)
-        # feat_lens[i]: 表示第i个样本的编码器序列实际长度
-        attn_mask[i, :, feat_lens[i]:] = 1
-    return attn_mask.to(torch.bool)
+    # 将超出编码器实际长度的位置设为True(屏蔽)，形状为(batch_size, decoder_seq_len, encoder_seq_len)的广播视图
+    return get_key_padding_mask(max_feat_len, feat_lens, device).unsqueeze(1).expand(b, max_label_len, max_feat_len)
+
+def get_chunk_mask(b: int, max_len: int, chunk_size: int, left_context: int, device: torch.device) -> torch.Tensor:
+    """
+    生成分块流式编码的掩码，(b, max_len, max_len)的广播视图
+    每一帧能看到自己所在块的全部帧，以及块起点之前的left_context帧，
+    用它对整句做前向，结果和Encoder.forward_chunk逐块编码相同(训练时使用)
+    """
+    pos = torch.arange(max_len, device=device)
+    chunk_start = pos // chunk_size * chunk_size
+    # query i 可见的key范围是 [chunk_start(i) - left_context, chunk_start(i) + chunk_size)
+    visible = (pos.unsqueeze(0) >= (chunk_start - left_context).unsqueeze(1)) & \
+        (pos.unsqueeze(0) < (chunk_start + chunk_size).unsqueeze(1))
+    return (~visible).unsqueeze(0).expand(b, max_len, max_len)
+
+class AttnMask:
+    """
+    紧凑的注意力掩码，只保存每个样本的key有效长度和是否因果，占用O(b)内存
+    在注意力内部才按 [N, 1, q_len, k_len] 的广播形状生成布尔掩码，
+    不再为每个样本、每个头各复制一份 [q_len, k_len] 的掩码
+    """
+    def __init__(self, key_lens=None, is_causal=False):
+        """
+        Args:
+            key_lens: (b,) valid length of the keys, None means no padding.
+            is_causal: query i can not see keys after it. with a KV cache the queries are the last q_len positions.
+        """
+        self.key_lens = key_lens
+        self.is_causal = is_causal
+
+    def index_select(self, index):
+        key_lens = None if self.key_lens is None else self.key_lens.index_select(0, index)
+        return AttnMask(key_lens, self.is_causal)
+
+    def to_bool(self, q_len, k_len, device):
+        """
+        生成可广播到 [N, num_heads, q_len, k_len] 的布尔掩码(True表示屏蔽)，不需要屏蔽时返回None
+        """
+        mask = None
+        if self.key_lens is not None:
+            mask = get_key_padding_mask(k_len, self.key_lens, device)[:, None, None, :]   # [N, 1, 1, k_len]
+        if self.is_causal and q_len > 1:
+            # query i 在整段序列中的位置是 k_len - q_len + i (前面是已缓存的位置)
+            causal = get_subsequent_mask(1, q_len, device, k_len - q_len).unsqueeze(1)   # [1, 1, q_len, k_len]
+            mask = causal if mask is None else mask | causal
+        return mask
+
+def pack_sequences(X: torch.Tensor, lens: torch.Tensor):
+    """
+    把填充后的batch打包成首尾相接的一条序列，去掉所有填充位置
+    Args:
+        X: (b, max_len, ...) padded batch.
+        lens: (b,) valid lengths.
+    Returns:
+        packed: (total_len, ...) where total_len = lens.sum().
+        cu_seqlens: (b+1,) cumulative lengths, sequence i is packed[cu_seqlens[i]:cu_seqlens[i+1]].
+    """
+    lens = lens.long().to(X.device)
+    packed = X[~get_key_padding_mask(X.size(1), lens, X.device)]
+    cu_seqlens = F.pad(lens.cumsum(0), (1, 0))
+    return packed, cu_seqlens
+
+def unpack_sequences(packed: torch.Tensor, cu_seqlens: torch.Tensor, max_len: int = None):
+    """
+    pack_sequences的逆操作，返回(b, max_len, ...)的填充batch，填充位置为0
+    """
+    lens = cu_seqlens[1:] - cu_seqlens[:-1]
+    max_len = max_len or int(lens.max())
+    padded = packed.new_zeros(lens.numel(), max_len, *packed.shape[1:])
+    padded[~get_key_padding_mask(max_len, lens, packed.device)] = packed
+    return padded
+
+class PackedMask:
+    """
+    打包(packed)序列的注意力掩码
+    b条序列首尾相接成一条序列，只有真实token参与线性层、FFN和LayerNorm的计算；
+    注意力按序列分段计算，第i段query只看第i段key，计算量为sum(L_i^2)而不是b*max_len^2
+    """
+    def __init__(self, cu_seqlens_q, cu_seqlens_k=None, is_causal=False):
+        """
+        Args:
+            cu_seqlens_q: (b+1,) cumulative lengths of the packed queries.
+            cu_seqlens_k: (b+1,) cumulative lengths of the packed keys, None means the same as the queries.
+            is_causal: causal attention inside every segment (self-attention only).
+        """
+        self.cu_seqlens_q = cu_seqlens_q
+        self.cu_seqlens_k = cu_seqlens_q if cu_seqlens_k is None else cu_seqlens_k
+        self.is_causal = is_causal
+        # 分段的边界在Python里切片用，只同步一次
+        self._bounds_q = cu_seqlens_q.tolist()
+        self._bounds_k = self._bounds_q if cu_seqlens_k is None else cu_seqlens_k.tolist()
+
+    def segments(self):
+        """
+        逐段返回 (q_start, q_end, k_start, k_end)
+        """
+        bq, bk = self._bounds_q, self._bounds_k
+        for i in range(len(bq) - 1):
+            yield bq[i], bq[i + 1], bk[i], bk[i + 1]
+
+    @property
+    def max_seqlen_q(self):
+        bq = self._bounds_q
+        return max(bq[i + 1] - bq[i] for i in range(len(bq) - 1))
+
+    def positions_q(self):
+        """
+        每个打包后的query在自己序列中的位置，形状为(total_len,)
+        """
+        cu = self.cu_seqlens_q
+        lens = cu[1:] - cu[:-1]
+        return torch.arange(int(cu[-1]), device=cu.device) - cu[:-1].repeat_interleave(lens)
+
+class LayerKVCache:
+    """
+    单层self-attention的KV缓存
+    K/V存放在预分配的缓冲区里，容量不够时按2倍扩容，追加新token是均摊O(1)的拷贝，
+    避免每步torch.cat把整段历史重新拷贝一遍
+    """
+    def __init__(self, init_capacity=64):
+        self.init_capacity = init_capacity
+        self.k = None      # [N, num_kv_heads, capacity, d_k]
+        self.v = None      # [N, num_kv_heads, capacity, d_v]
+        self.len = 0       # 已缓存的token数
+        self.spare = None  # reorder()用的另一组同样大小的(K, V)缓冲区
+
+    def append(self, k, v):
+        """
+        追加新token的K/V，返回包含全部历史的K/V视图
+        Args:
+            k: [N, num_kv_heads, new_len, d_k]
+            v: [N, num_kv_heads, new_len, d_v]
+        """
+        new_len = self.len + k.size(2)
+        if self.k is None or new_len > self.k.size(2):
+            capacity = max(self.init_capacity, new_len, 0 if self.k is None else 2 * self.k.size(2))
+            k_buf = k.new_empty(k.size(0), k.size(1), capacity, k.size(3))
+            v_buf = v.new_empty(v.size(0), v.size(1), capacity, v.size(3))
+            if self.len > 0:
+                k_buf[:, :, :self.len] = self.k[:, :, :self.len]
+                v_buf[:, :, :self.len] = self.v[:, :, :self.len]
+            self.k, self.v = k_buf, v_buf
+            self.spare = None
+        self.k[:, :, self.len:new_len] = k
+        self.v[:, :, self.len:new_len] = v
+        self.len = new_len
+        return self.k[:, :, :new_len], self.v[:, :, :new_len]
+
+    @property
+    def k_len(self):
+        # 上一次append返回的K的长度，即注意力实际计算的key数
+        return self.len
+
+    def reorder(self, index):
+        """
+        按index重排/筛选batch维(beam search换beam、去掉已结束的样本)
+        用index_select直接写进备用缓冲区的前len(index)行再交换两组缓冲区，每步只拷贝一次；
+        原地重排需要先用高级索引取出一份临时结果再写回，要拷贝两次
+        """
+        if self.k is None:
+            return
+        n = index.numel()
+        if self.spare is None or self.spare[0].size(0) < n:
+            self.spare = (self.k.new_empty((n,) + self.k.shape[1:]), self.v.new_empty((n,) + self.v.shape[1:]))
+        k_buf, v_buf = self.spare
+        torch.index_select(self.k[:, :, :self.len], 0, index, out=k_buf[:n, :, :self.len])
+        torch.index_select(self.v[:, :, :self.len], 0, index, out=v_buf[:n, :, :self.len])
+        self.spare = (self.k, self.v)
+        self.k, self.v = k_buf[:n], v_buf[:n]
+
+class LeftContextKVCache:
+    """
+    流式编码中单层self-attention的有界KV缓存，只保留最近left_context帧的K/V，
+    不管音频流有多长，占用的内存都不变
+    """
+    def __init__(self, left_context):
+        self.left_context = left_context
+        self.k = None      # [N, num_heads, <=left_context, d_k]
+        self.v = None      # [N, num_heads, <=left_context, d_v]
+        self.k_len = 0     # 上一次append返回的K的长度(缓存的帧 + 新的块)，裁剪之后len会比它短
+
+    @property
+    def len(self):
+        return 0 if self.k is None else self.k.size(2)
+
+    def append(self, k, v):
+        """
+        返回 缓存的帧 + 新的块 的K/V，然后只留下最后left_context帧
+        """
+        if self.k is not None:
+            k, v = torch.cat([self.k, k], 2), torch.cat([self.v, v], 2)
+        start = max(k.size(2) - self.left_context, 0)
+        self.k, self.v = k[:, :, start:], v[:, :, start:]
+        self.k_len = k.size(2)
+        return k, v
+
+class EncoderStreamState:
+    """
+    Encoder流式编码的状态：每层一个LeftContextKVCache和已经编码的帧数
+    """
+    def __init__(self, num_layers, left_context):
+        self.caches = [LeftContextKVCache(left_context) for _ in range(num_layers)]
+        self.offset = 0
+
+class KVCache:
+    """
+    Decoder的逐层KV缓存，cache[i]对应第i个DecoderLayer的dec_attn
+    逐token解码时每步只需把新token送进Decoder，总代价随输出长度线性增长
+    """
+    def __init__(self, num_layers, init_capacity=64):
+        self.layers = [LayerKVCache(init_capacity) for _ in range(num_layers)]
+
+    def __getitem__(self, idx):
+        return self.layers[idx]
+
+    def __len__(self):
+        return len(self.layers)
+
+    @property
+    def seq_len(self):
+        # 已缓存的token数，也就是下一个新token的位置
+        return self.layers[0].len
+
+    def reorder(self, index):
+        for layer in self.layers:
+            layer.reorder(index)
+
+class EncoderMemory:
+    """
+    预先投影好的编码器记忆，memory[i]是第i个DecoderLayer的enc_dec_attn用到的(K, V)
+    交叉注意力的K/V只依赖enc_out，一条语音只需投影一次，逐token解码时每层直接复用
+    """
+    def __init__(self, enc_out, kv):
+        self.enc_out = enc_out      # [N, feat_len, d_model]
+        self.kv = kv                # list of (K, V), each [N, num_kv_heads, feat_len, d_k]
+
+    def __getitem__(self, idx):
+        return self.kv[idx]
+
+    def __len__(self):
+        return len(self.kv)
+
+    def index_select(self, index):
+        """
+        按index选取batch维，返回新的EncoderMemory(例如把每条语音扩展成beam_size份)
+        """
+        return EncoderMemory(
+            self.enc_out.index_select(0, index),
+            [(K.index_select(0, index), V.index_select(0, index)) for K, V in self.kv],
+        )
+
+def math_attention(Q, K, V, attn_mask=None, is_causal=False, dropout_p=0.):
+    """
+    参考实现：显式计算完整的分数矩阵 [N, num_heads, q_len, k_len]
+    Args:
+        Q: [N, num_heads, q_len, d_k]
+        K: [N, num_heads, k_len, d_k]
+        V: [N, num_heads, k_len, d_v]
+        attn_mask: bool mask broadcastable to [N, num_heads, q_len, k_len], True means masked.
+        is_causal: apply a causal mask (only used when q_len == k_len).
+        dropout_p: dropout rate of attention weights, 0 in eval mode.
+    """
+    if is_causal:
+        attn_mask = get_subsequent_mask(1, Q.size(2), Q.device).unsqueeze(1)
+    # calculate attention weight - 计算注意力权重
+    # torch.matmul() 执行矩阵乘法，Q @ K^T
+    # K.transpose(-1,-2) 交换K的最后两个维度，即转置操作
+    scores = torch.matmul(Q, K.transpose(-1,-2)) / np.sqrt(Q.size(-1))  # 缩放点积注意力
+    if attn_mask is not None:
+        # .masked_fill_() 将掩码为True的位置填充为指定值（分数dtype能表示的最小值）
+        # 按dtype取最小值，bf16/fp16下也不会溢出，fp32下和原来的-1e4一样softmax后为0
+        scores.masked_fill_(attn_mask, torch.finfo(scores.dtype).min)
+    # torch.softmax() 计算softmax，dim=-1表示在最后一个维度上计算
+    # 在fp32中做指数和归一化，再转回分数的dtype(bf16下直接做softmax误差较大)
+    attns = torch.softmax(scores, dim=-1, dtype=torch.float32).to(scores.dtype)
+    if dropout_p > 0:
+        attns = F.dropout(attns, p=dropout_p)  # 应用dropout
+
+    # calculate output - 计算输出
+    # 注意力权重与Value相乘得到加权的Value
+    return torch.matmul(attns, V)  # [N, num_heads, q_len, d_v]
+
+def sdpa_attention(Q, K, V, attn_mask=None, is_causal=False, dropout_p=0.):
+    """
+    融合实现：torch.nn.functional.scaled_dot_product_attention，
+    由PyTorch选择flash/memory-efficient内核，不需要完整的分数矩阵，参数同math_attention
+    """
+    if attn_mask is not None:
+        attn_mask = ~attn_mask      # SDPA的布尔掩码中True表示参与注意力，和这里相反
+    return F.scaled_dot_product_attention(Q, K, V, attn_mask=attn_mask, dropout_p=dropout_p, is_causal=is_causal)
+
+ATTN_CHUNK_SIZE = 256   # chunked后端每次处理的query数
+
+def chunked_attention(Q, K, V, attn_mask=None, is_causal=False, dropout_p=0., chunk_size=None):
+    """
+    分块实现：按query分块计算，分数矩阵的峰值内存从 q_len*k_len 降到 chunk_size*k_len，
+    每块的计算和math_attention完全相同，参数同math_attention
+    """
+    chunk_size = chunk_size or ATTN_CHUNK_SIZE
+    q_len, k_len = Q.size(2), K.size(2)
+    output = Q.new_empty(*Q.shape[:-1], V.size(-1))
+    for start in range(0, q_len, chunk_size):
+        end = min(start + chunk_size, q_len)
+        mask = None
+        if attn_mask is not None:
+            mask = attn_mask if attn_mask.size(-2) == 1 else attn_mask[..., start:end, :]
+        if is_causal:
+            causal = torch.arange(k_len, device=Q.device) > torch.arange(start, end, device=Q.device).unsqueeze(1)
+            mask = causal if mask is None else mask | causal
+        output[:, :, start:end] = math_attention(Q[:, :, start:end], K, V, mask, dropout_p=dropout_p)
+    return output
+
+def local_attention(Q, K, V, attn_mask=None, is_causal=False, dropout_p=0., window=64, num_global=0):
+    """
+    滑动窗口(局部)注意力：位置i只看 |i-j| <= window 的key，前num_global个位置是全局token，
+    它们看所有位置，也被所有位置看到。query按window分块，每块只和它附近 3*window 个key做矩阵乘，
+    分数矩阵是 [N, num_heads, q_len/window, window, 3*window]，计算量和内存都是 O(L*window)
+    Args:
+        Q, K, V: same as math_attention, q_len == k_len (self-attention).
+        attn_mask: key padding mask broadcastable to [N, 1, 1, k_len], True means masked.
+        is_causal: additionally hide keys after the query.
+        dropout_p: dropout rate of attention weights.
+        window: one-sided window size.
+        num_global: the first num_global positions are global tokens.
+    """
+    N, h, L, d_k = Q.shape
+    assert K.size(2) == L, "local attention is self-attention"
+    assert attn_mask is None or attn_mask.size(-2) == 1, "local attention only takes a key padding mask"
+    device = Q.device
+    block = window
+    num_blocks = (L + block - 1) // block
+    pad = num_blocks * block - L
+    span = block + 2 * window
+    scale = 1. / np.sqrt(d_k)
+    key_pad = None if attn_mask is None else attn_mask.reshape(attn_mask.size(0), L)     # [N or 1, L]
+
+    # 每个query块对应的key窗口：两侧各补window个位置后按块步长展开(unfold得到的是重叠窗口的视图)
+    Q_blocks = F.pad(Q, (0, 0, 0, pad)).view(N, h, num_blocks, block, d_k)
+    K_win = F.pad(K, (0, 0, window, window + pad)).unfold(2, span, block)                     # [N, h, nb, d_k, span]
+    V_win = F.pad(V, (0, 0, window, window + pad)).unfold(2, span, block).transpose(-1, -2)   # [N, h, nb, span, d_v]
+    scores = torch.matmul(Q_blocks, K_win) * scale                                            # [N, h, nb, block, span]
+
+    q_pos = torch.arange(num_blocks * block, device=device).view(num_blocks, block, 1)
+    k_pos = (torch.arange(num_blocks, device=device) * block - window).view(num_blocks, 1, 1) + \
+        torch.arange(span, device=device)
+    # 窗口外、序列外的位置，以及全局token(单独计算，避免重复)都屏蔽
+    mask = ((k_pos - q_pos).abs() > window) | (k_pos < num_global) | (k_pos >= L)              # [nb, block, span]
+    if is_causal:
+        mask = mask | (k_pos > q_pos)
+    mask = mask.unsqueeze(0).unsqueeze(0)                                                     # [1, 1, nb, block, span]
+    if key_pad is not None:
+        key_pad_win = F.pad(key_pad, (window, window + pad), value=True).unfold(1, span, block)   # [N, nb, span]
+        mask = mask | key_pad_win[:, None, :, None, :]
+    fill = torch.finfo(scores.dtype).min
+    scores = scores.masked_fill(mask, fill).flatten(2, 3)[:, :, :L]                          # [N, h, L, span]
+
+    if num_global > 0:
+        # 所有query对全局token的分数 [N, h, L, num_global]，和窗口内的分数一起做softmax
+        g_scores = torch.matmul(Q, K[:, :, :num_global].transpose(-1, -2)) * scale
+        g_mask = torch.zeros(1, num_global, dtype=torch.bool, device=device)
+        if is_causal:
+            g_mask = torch.arange(num_global, device=device) > torch.arange(L, device=device).unsqueeze(1)
+        if key_pad is not None:
+            g_mask = g_mask | key_pad[:, None, None, :num_global]
+        scores = torch.cat([scores, g_scores.masked_fill(g_mask, fill)], -1)
+    attns = torch.softmax(scores, dim=-1, dtype=torch.float32).to(scores.dtype)
+    if dropout_p > 0:
+        attns = F.dropout(attns, p=dropout_p)
+
+    band = F.pad(attns[..., :span], (0, 0, 0, pad)).view(N, h, num_blocks, block, span)
+    output = torch.matmul(band, V_win).flatten(2, 3)[:, :, :L]                               # [N, h, L, d_v]
+    if num_global > 0:
+        output = output + torch.matmul(attns[..., span:], V[:, :, :num_global])
+        # 全局token自己的行看所有位置，只有num_global行，按普通注意力计算
+        g_mask = None if key_pad is None else key_pad[:, None, None, :]
+        if is_causal:
+            causal = torch.arange(L, device=device) > torch.arange(num_global, device=device).unsqueeze(1)
+            g_mask = causal if g_mask is None else g_mask | causal
+        output[:, :, :num_global] = math_attention(Q[:, :, :num_global], K, V, g_mask, dropout_p=dropout_p)
+    return output
+
+ATTN_BACKENDS = {
+    "math": math_attention,
+    "sdpa": sdpa_attention,
+    "chunked": chunked_attention,
+}
+_default_attn_backend = "math"
+
+def set_attn_backend(backend, module=None):
+    """
+    切换注意力后端
+    Args:
+        backend: one of ATTN_BACKENDS, or None to follow the global default (only with module).
+        module: set the backend of every MultiHeadAttention inside module; None changes the global default.
+    """
+    global _default_attn_backend
+    assert backend is None or backend in ATTN_BACKENDS, f"unknown attention backend: {backend}"
+    if module is None:
+        assert backend is not None
+        _default_attn_backend = backend
+        return
+    for m in module.modules():
+        if isinstance(m, MultiHeadAttention):
+            m.backend = backend
+
+def mean_pool_kv_heads(param, head_dim, num_kv_heads):
+    """
+    把多头注意力checkpoint里W_K/W_V的参数按组取平均，转换成num_kv_heads个头(GQA/MQA)
+    Args:
+        param: weight [num_heads*head_dim, d_model] or bias [num_heads*head_dim].
+        head_dim: d_k for W_K, d_v for W_V.
+        num_kv_heads: number of K/V heads after conversion, consecutive heads form a group.
+    """
+    num_heads = param.size(0) // head_dim
+    assert num_heads % num_kv_heads == 0
+    grouped = param.reshape(num_kv_heads, num_heads // num_kv_heads, head_dim, *param.shape[1:])
+    return grouped.mean(1).reshape(num_kv_heads * head_dim, *param.shape[1:])
+
+# 融合投影层由哪些单独的投影按顺序拼接而成(沿输出维度)
+FUSED_PROJECTIONS = {
+    "W_QKV": ("W_Q", "W_K", "W_V"),
+    "W_KV": ("W_K", "W_V"),
+}
 
 class MultiHeadAttention(nn.Module):
     """
     多头注意力机制
     nn.Module是PyTorch中所有神经网络模块的基类，继承它才能使用PyTorch的功能
     """
-    def __init__(self, d_k, d_v, d_model, num_heads, p=0.):
+    def __init__(
+        self, d_k, d_v, d_model, num_heads, p=0., backend=None, fused=None, window=None, num_global=0, num_kv_heads=None,
+    ):
         """
         Args:
             d_k: dimension of key
@@ -72,6 +586,14 @@ class MultiHeadAttention(nn.Module):
             d_model: dimension of model
             num_heads: number of heads
             p: dropout rate
+            backend: attention backend in ATTN_BACKENDS, None follows the global default (see set_attn_backend)
+            fused: None, "qkv" (self-attention, one W_QKV projection) or "kv" (cross-attention, W_Q and one W_KV).
+                checkpoints with separate W_Q/W_K/W_V are converted when loading.
+            window: use local_attention with this one-sided window instead of full attention (self-attention only).
+            num_global: number of leading global tokens of local_attention.
+            num_kv_heads: number of K/V heads (grouped-query attention), each shared by num_heads // num_kv_heads
+                query heads. None means num_heads, 1 is multi-query attention. checkpoints with num_heads K/V heads
+                are mean-pooled per group when loading.
         """
         # super().__init__() 调用父类nn.Module的初始化方法，这是必须的
         super(MultiHeadAttention, self).__init__()
@@ -79,24 +601,111 @@ class MultiHeadAttention(nn.Module):
         self.d_k = d_k  # dimension of key
         self.d_v = d_v  # dimension of value
         self.num_heads = num_heads
+        self.num_kv_heads = num_kv_heads or num_heads
+        assert num_heads % self.num_kv_heads == 0, "num_heads must be divisible by num_kv_heads"
+        self.backend = backend
+        self.window = window
+        self.num_global = num_global
+        assert fused in (None, "qkv", "kv")
+        self.fused = fused
         # nn.Dropout(p) 创建一个dropout层，用于在训练时随机将p比例的神经元置零，防止过拟合
         self.dropout = nn.Dropout(p)
 
         # linear projections - 线性投影层
         # nn.Linear(in_features, out_features) 创建全连接层，实现 y = xW^T + b
-        self.W_Q = nn.Linear(d_model, d_k*num_heads)    # Query投影：将输入维度d_model转换为d_k*num_heads
-        self.W_K = nn.Linear(d_model, d_k*num_heads)    # Key投影
-        self.W_V = nn.Linear(d_model, d_v*num_heads)    # Value投影
+        # 融合模式下多个投影合并成一个更大的nn.Linear，一次GEMM代替两三次小GEMM
+        # K/V只投影到num_kv_heads个头，KV缓存和EncoderMemory也按这个头数保存
+        num_kv_heads = self.num_kv_heads
+        if fused == "qkv":
+            self.W_QKV = nn.Linear(d_model, d_k*num_heads+(d_k+d_v)*num_kv_heads)   # [W_Q; W_K; W_V]
+        else:
+            self.W_Q = nn.Linear(d_model, d_k*num_heads)    # Query投影：将输入维度d_model转换为d_k*num_heads
+        if fused == "kv":
+            self.W_KV = nn.Linear(d_model, (d_k+d_v)*num_kv_heads)   # [W_K; W_V]
+        elif fused is None:
+            self.W_K = nn.Linear(d_model, d_k*num_kv_heads)    # Key投影
+            self.W_V = nn.Linear(d_model, d_v*num_kv_heads)    # Value投影
         self.W_out = nn.Linear(d_v*num_heads, d_model)  # 输出投影：将多头结果合并回d_model维度
 
         # Weight Initialization - 权重初始化
         # nn.init.normal_() 用正态分布初始化权重，这是一种Xavier初始化的变种
-        nn.init.normal_(self.W_Q.weight,mean=0,std=np.sqrt(2.0/(d_model+d_k)))  # 用均值为0，标准差为sqrt(2.0/(d_model+d_k))的正态分布初始化W_Q的权重
-        nn.init.normal_(self.W_K.weight,mean=0,std=np.sqrt(2.0/(d_model+d_k)))  # 可以防止权重过大或过小，避免梯度消失或爆炸
-        nn.init.normal_(self.W_V.weight,mean=0,std=np.sqrt(2.0/(d_model+d_v)))
+        # 融合模式下对W_Q/W_K/W_V各自对应的那一段分别初始化，和不融合时分布相同
+        W_Q, W_K, W_V = self._projection_weights()
+        nn.init.normal_(W_Q,mean=0,std=np.sqrt(2.0/(d_model+d_k)))  # 用均值为0，标准差为sqrt(2.0/(d_model+d_k))的正态分布初始化W_Q的权重
+        nn.init.normal_(W_K,mean=0,std=np.sqrt(2.0/(d_model+d_k)))  # 可以防止权重过大或过小，避免梯度消失或爆炸
+        nn.init.normal_(W_V,mean=0,std=np.sqrt(2.0/(d_model+d_v)))
         nn.init.normal_(self.W_out.weight,mean=0,std=np.sqrt(2.0/(d_v+d_model)))
 
-    def forward(self, Q, K, V, attn_mask, **kwargs):
+    def _projection_sizes(self):
+        return {
+            "W_Q": self.d_k*self.num_heads,
+            "W_K": self.d_k*self.num_kv_heads,
+            "W_V": self.d_v*self.num_kv_heads,
+        }
+
+    def _projection_weights(self):
+        """
+        返回W_Q、W_K、W_V的权重(融合模式下是融合权重的切片视图)
+        """
+        sizes = self._projection_sizes()
+        weights = {}
+        for name in ("W_Q", "W_K", "W_V"):
+            if hasattr(self, name):
+                weights[name] = getattr(self, name).weight
+        for fused_name, names in FUSED_PROJECTIONS.items():
+            if hasattr(self, fused_name):
+                parts = getattr(self, fused_name).weight.split([sizes[n] for n in names], 0)
+                weights.update(zip(names, parts))
+        return weights["W_Q"], weights["W_K"], weights["W_V"]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 加载前把checkpoint里的投影参数转换成本模块的融合方式：
+        # 先把融合参数(W_QKV/W_KV)拆回W_Q/W_K/W_V，再按self.fused拼接
+        # checkpoint的K/V是num_heads个头而本模块是分组的K/V时，按组对头取平均
+        sizes = self._projection_sizes()
+        for suffix in ("weight", "bias"):
+            for fused_name, names in FUSED_PROJECTIONS.items():
+                key = f"{prefix}{fused_name}.{suffix}"
+                if key in state_dict:
+                    param = state_dict.pop(key)
+                    # 融合参数的行数 = Q的行数 + 每个K/V头的(d_k+d_v)行 × 头数，由此推出checkpoint的K/V头数
+                    q_rows = sizes["W_Q"] if "W_Q" in names else 0
+                    ckpt_kv_heads = (param.size(0) - q_rows) // (self.d_k + self.d_v)
+                    ckpt_sizes = {"W_Q": q_rows, "W_K": self.d_k*ckpt_kv_heads, "W_V": self.d_v*ckpt_kv_heads}
+                    parts = param.split([ckpt_sizes[n] for n in names], 0)
+                    state_dict.update({f"{prefix}{n}.{suffix}": p for n, p in zip(names, parts)})
+            for name in ("W_K", "W_V"):
+                key = f"{prefix}{name}.{suffix}"
+                if key in state_dict and state_dict[key].size(0) != sizes[name]:
+                    state_dict[key] = mean_pool_kv_heads(state_dict[key], sizes[name] // self.num_kv_heads, self.num_kv_heads)
+            for fused_name, names in FUSED_PROJECTIONS.items():
+                keys = [f"{prefix}{n}.{suffix}" for n in names]
+                if hasattr(self, fused_name) and all(k in state_dict for k in keys):
+                    state_dict[f"{prefix}{fused_name}.{suffix}"] = torch.cat([state_dict.pop(k) for k in keys], 0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_kv(self, K, V):
+        """
+        把K/V投影并拆分成多头，返回 [N, num_kv_heads, seq_len, d_k] 和 [N, num_kv_heads, seq_len, d_v]
+        融合模式下K和V必须是同一个输入(交叉注意力的enc_out)
+        """
+        N = K.size(0)
+        num_kv_heads = self.num_kv_heads
+        if self.fused is None:
+            K, V = self.W_K(K), self.W_V(V)
+        else:
+            assert K is V, "fused projections need K is V"
+            if self.fused == "kv":
+                kv = self.W_KV(K)
+            else:
+                q_size = self.d_k*self.num_heads
+                kv = F.linear(K, self.W_QKV.weight[q_size:], self.W_QKV.bias[q_size:])
+            K, V = kv.split([self.d_k*num_kv_heads, self.d_v*num_kv_heads], -1)
+        K = K.view(N,-1, num_kv_heads,self.d_k).transpose(1,2)
+        V = V.view(N,-1, num_kv_heads,self.d_v).transpose(1,2)
+        return K, V
+
+    def forward(self, Q, K, V, attn_mask, cache=None, memory=None, freqs_cis=None, **kwargs):
         """
         前向传播函数，定义了数据如何在网络中流动
         forward()是nn.Module必须实现的方法
@@ -105,52 +714,117 @@ class MultiHeadAttention(nn.Module):
         # Q: [batch_size, seq_len, d_model] - Query张量
         # K: [batch_size, seq_len, d_model] - Key张量  
         # V: [batch_size, seq_len, d_model] - Value张量
-        # attn_mask: [batch_size, seq_len, seq_len] - 注意力掩码
+        # attn_mask: AttnMask，或[batch_size, seq_len, seq_len]/可广播的[batch_size, 1, seq_len, seq_len]布尔掩码
+        # cache: LayerKVCache(或PagedLayerKVCache)，增量解码时把新token的K/V追加进去，attn_mask的k_len需包含已缓存的长度
+        # memory: project_kv()预先算好的(K, V)，给定时忽略K、V参数，不再重复投影
+        # freqs_cis: RoPE模式下Q(和新token的K)所在位置的cos/sin，(seq_len, 2, d_k)或每行不同的(N, seq_len, 2, d_k)，只用于self-attention
         # **kwargs: 其他关键字参数
 
         # .size(dim) 返回张量在指定维度的大小
         N = Q.size(0)              # batch_size
-        q_len, k_len = Q.size(1), K.size(1)    # 序列长度
         d_k, d_v = self.d_k, self.d_v
         num_heads = self.num_heads
 
         # multi_head split - 多头分割
-        # self.W_Q(Q) 将Q通过线性层变换，形状变为[N, seq_len, d_k*num_heads]
+        # self.W_Q(Q) 将Q通过线性层变换，形状变为[N, seq_len, d_k*num_heads]，融合模式见self.fused
         # .view() 重新reshape张量的形状，-1表示自动计算该维度的大小
         # .transpose(1,2) 交换第1和第2维度，将头数维度提前
-        Q = self.W_Q(Q).view(N,-1, num_heads,d_k).transpose(1,2)  # [N, num_heads, seq_len, d_k]
-        K = self.W_K(K).view(N,-1, num_heads,d_k).transpose(1,2)  # [N, num_heads, seq_len, d_k]
-        V = self.W_V(V).view(N,-1, num_heads,d_v).transpose(1,2)  # [N, num_heads, seq_len, d_v]
+        if self.fused == "qkv" and memory is None:
+            # self-attention：一次GEMM同时得到Q、K、V (K、V参数必须和Q是同一个输入)
+            num_kv_heads = self.num_kv_heads
+            Q, K, V = self.W_QKV(Q).split([d_k*num_heads, d_k*num_kv_heads, d_v*num_kv_heads], -1)
+            Q = Q.view(N,-1, num_heads,d_k).transpose(1,2)  # [N, num_heads, seq_len, d_k]
+            K = K.view(N,-1, num_kv_heads,d_k).transpose(1,2)  # [N, num_kv_heads, seq_len, d_k]
+            V = V.view(N,-1, num_kv_heads,d_v).transpose(1,2)  # [N, num_kv_heads, seq_len, d_v]
+        else:
+            if self.fused == "qkv":
+                Q = F.linear(Q, self.W_QKV.weight[:d_k*num_heads], self.W_QKV.bias[:d_k*num_heads])
+            else:
+                Q = self.W_Q(Q)
+            Q = Q.view(N,-1, num_heads,d_k).transpose(1,2)  # [N, num_heads, seq_len, d_k]
+            if memory is not None:
+                K, V = memory
+            else:
+                K, V = self.project_kv(K, V)   # [N, num_kv_heads, seq_len, d_k], [N, num_kv_heads, seq_len, d_v]
+        if freqs_cis is not None:
+            # 按绝对位置旋转Q和新token的K；缓存里的K已经旋转过，继续解码时仍然有效，不需要重算
+            assert memory is None, "RoPE is only applied in self-attention"
+            Q, K = apply_rotary_emb(Q, freqs_cis), apply_rotary_emb(K, freqs_cis)
+        if cache is not None:
+            # 只投影了新token，历史token的K/V直接从缓存里取
+            K, V = cache.append(K, V)
+        q_len, k_len = Q.size(2), K.size(2)    # 序列长度
+
+        # calculate attention - 计算注意力，具体实现由backend决定
+        attention = ATTN_BACKENDS[self.backend or _default_attn_backend]
+        dropout_p = self.dropout.p if self.training else 0.
+        if self.window is not None:
+            # 局部注意力只计算带状部分，不受backend影响
+            attention = partial(local_attention, window=self.window, num_global=self.num_global)
+
+        if isinstance(attn_mask, PackedMask):
+            # 打包序列(N=1)：逐段计算注意力，段与段之间互不可见
+            assert N == 1 and cache is None
+            output = Q.new_empty(N, num_heads, q_len, d_v)
+            for q_start, q_end, k_start, k_end in attn_mask.segments():
+                output[:, :, q_start:q_end] = self._grouped_attention(
+                    attention, Q[:, :, q_start:q_end], K[:, :, k_start:k_end], V[:, :, k_start:k_end], None,
+                    is_causal=attn_mask.is_causal and q_end - q_start > 1, dropout_p=dropout_p,
+                )
+            return self._merge_heads(output)
 
         # pre-process mask - 预处理掩码
-        if attn_mask is not None:
+        is_causal = False
+        if isinstance(attn_mask, AttnMask):
+            if self.window is not None:
+                # local_attention分别接收key padding掩码和因果标志
+                is_causal, attn_mask = attn_mask.is_causal, AttnMask(attn_mask.key_lens).to_bool(q_len, k_len, Q.device)
+            elif attn_mask.key_lens is None and attn_mask.is_causal and q_len == k_len:
+                # 纯因果掩码交给后端处理，不生成 [q_len, k_len] 的掩码
+                # q_len == 1 时因果掩码什么也不屏蔽，不按长度分支，导出时不会对长度产生约束
+                is_causal, attn_mask = True, None
+            else:
+                attn_mask = attn_mask.to_bool(q_len, k_len, Q.device)  # [N or 1, 1, q_len or 1, k_len]
+        elif attn_mask is not None and attn_mask.dim() == 3:
             # assert 断言，检查掩码形状是否正确，如果不正确会抛出异常
             assert attn_mask.size() == (N, q_len, k_len)
-            # .unsqueeze(1) 在第1维度插入一个大小为1的维度
-            # .repeat() 沿指定维度重复张量，这里在头数维度复制num_heads次
-            attn_mask = attn_mask.unsqueeze(1).repeat(1, num_heads,1,1)  # [N, 1, q_len, k_len] -> [N, num_heads, q_len, k_len]
+            # .unsqueeze(1) 在第1维度插入一个大小为1的维度，masked_fill_会沿头数维度广播，不需要复制num_heads份
+            attn_mask = attn_mask.unsqueeze(1)  # [N, 1, q_len, k_len]
+        if attn_mask is not None:
             attn_mask = attn_mask.bool()  # 转换为布尔类型
 
-        # calculate attention weight - 计算注意力权重
-        # torch.matmul() 执行矩阵乘法，Q @ K^T
-        # K.transpose(-1,-2) 交换K的最后两个维度，即转置操作
-        scores = torch.matmul(Q, K.transpose(-1,-2)) / np.sqrt(d_k)  # 缩放点积注意力
-        if attn_mask is not None:
-            # .masked_fill_() 将掩码为True的位置填充为指定值（这里是-1e4，一个很小的负数）
-            scores.masked_fill_(attn_mask, -1e4)
-        # torch.softmax() 计算softmax，dim=-1表示在最后一个维度上计算
-        attns = torch.softmax(scores, dim=-1)
-        attns = self.dropout(attns)  # 应用dropout
+        # [N, num_heads, seq_len, d_v]
+        output = self._grouped_attention(attention, Q, K, V, attn_mask, is_causal=is_causal, dropout_p=dropout_p)
+        return self._merge_heads(output)
 
-        # calculate output - 计算输出
-        # 注意力权重与Value相乘得到加权的Value
-        output = torch.matmul(attns, V)  # [N, num_heads, seq_len, d_v]
+    def _grouped_attention(self, attention, Q, K, V, attn_mask=None, is_causal=False, dropout_p=0.):
+        """
+        K/V有num_kv_heads个头时计算注意力，每num_heads // num_kv_heads个query头共用一个K/V头
+        掩码和query位置无关时(增量解码、交叉注意力)，把同组的query头拼接到序列维上，K/V不需要复制；
+        其他情况把K/V沿头维扩展成num_heads个头
+        """
+        group = self.num_heads // self.num_kv_heads
+        if group == 1:
+            return attention(Q, K, V, attn_mask, is_causal=is_causal, dropout_p=dropout_p)
+        N, _, q_len, _ = Q.shape
+        if not is_causal and self.window is None and (attn_mask is None or attn_mask.size(-2) == 1):
+            # 第h个query头属于第h // group组，[N, num_heads, q_len, d_k] -> [N, num_kv_heads, group*q_len, d_k]
+            Q = Q.reshape(N, self.num_kv_heads, group * q_len, self.d_k)
+            output = attention(Q, K, V, attn_mask, dropout_p=dropout_p)
+            return output.view(N, self.num_heads, q_len, self.d_v)
+        K = K.repeat_interleave(group, dim=1)
+        V = V.repeat_interleave(group, dim=1)
+        return attention(Q, K, V, attn_mask, is_causal=is_causal, dropout_p=dropout_p)
+
+    def _merge_heads(self, output):
+        # output: [N, num_heads, seq_len, d_v]
+        N = output.size(0)
 
         # merge heads - 合并多头
         # .transpose(1,2) 将头数和序列长度维度交换回来
         # .contiguous() 确保张量在内存中是连续的，这是reshape操作的要求
         # .reshape() 将多头结果合并为一个张量
-        output = output.transpose(1,2).contiguous().reshape(N,-1,d_v*num_heads)  # [N, seq_len, d_v*num_heads]
+        output = output.transpose(1,2).contiguous().reshape(N,-1,self.d_v*self.num_heads)  # [N, seq_len, d_v*num_heads]
         output = self.W_out(output)  # 通过输出投影层，形状变为[N, seq_len, d_model]
 
         return output
@@ -182,6 +856,16 @@ class PoswiseFFN(nn.Module):
         self.relu = nn.ReLU(inplace=True)
         self.dropout = nn.Dropout(p=p)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # LinearPoswiseFFN的权重 [out, in] 转换成Conv1d的 [out, in, 1]
+        for conv_name, linear_name in FFN_PARAM_NAMES.items():
+            for suffix in ("weight", "bias"):
+                key = f"{prefix}{linear_name}.{suffix}"
+                if key in state_dict:
+                    param = state_dict.pop(key)
+                    state_dict[f"{prefix}{conv_name}.{suffix}"] = param.unsqueeze(-1) if suffix == "weight" else param
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def forward(self, X):
         # X的形状是 [batch_size, seq_len, d_model]
         # Conv1d期望输入形状为 [batch_size, channels, length]
@@ -192,8 +876,75 @@ class PoswiseFFN(nn.Module):
         out = self.dropout(out)
         return out
 
+# PoswiseFFN的Conv1d参数名 -> LinearPoswiseFFN的nn.Linear参数名
+FFN_PARAM_NAMES = {"conv1": "linear1", "conv2": "linear2"}
+
+class LinearPoswiseFFN(nn.Module):
+    """
+    用nn.Linear实现的位置前馈网络，和PoswiseFFN数学上等价
+    直接在 [batch_size, seq_len, d_model] 的最后一维上做矩阵乘，省掉Conv1d前后的两次转置和非连续张量；
+    PoswiseFFN的Conv1d权重在加载时自动转换
+    """
+    def __init__(self, d_model, d_ff, p=0., fused_bias_relu=False):
+        # d_model: dimension of model
+        # d_ff: dimension of feedforward
+        # p: dropout rate
+        # fused_bias_relu: compute linear1 + bias + ReLU with one addmm-activation kernel (inference only)
+        super(LinearPoswiseFFN, self).__init__()
+        self.d_model = d_model
+        self.d_ff = d_ff
+        self.fused_bias_relu = fused_bias_relu
+        self.linear1 = nn.Linear(d_model, d_ff)
+        self.linear2 = nn.Linear(d_ff, d_model)
+        self.relu = nn.ReLU(inplace=True)
+        self.dropout = nn.Dropout(p=p)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Conv1d的权重 [out, in, 1] 去掉kernel维就是nn.Linear的 [out, in]
+        for conv_name, linear_name in FFN_PARAM_NAMES.items():
+            for suffix in ("weight", "bias"):
+                key = f"{prefix}{conv_name}.{suffix}"
+                if key in state_dict:
+                    param = state_dict.pop(key)
+                    state_dict[f"{prefix}{linear_name}.{suffix}"] = param.squeeze(-1) if suffix == "weight" else param
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, X):
+        # X的形状是 [batch_size, seq_len, d_model]，nn.Linear直接作用在最后一维
+        if self.fused_bias_relu and not (torch.is_grad_enabled() and self.linear1.weight.requires_grad):
+            # torch._addmm_activation 在矩阵乘的epilogue里加bias并做ReLU(CUDA上是cublasLt融合内核)
+            # 这个算子没有反向传播，训练时走下面的普通实现
+            out = torch._addmm_activation(self.linear1.bias, X.reshape(-1, self.d_model), self.linear1.weight.t())
+            out = out.view(*X.shape[:-1], self.d_ff)
+        else:
+            out = self.relu(self.linear1(X))
+        out = self.linear2(out)
+        out = self.dropout(out)
+        return out
+
+FFN_IMPLS = {
+    "conv": PoswiseFFN,
+    "linear": LinearPoswiseFFN,
+    "linear_fused": partial(LinearPoswiseFFN, fused_bias_relu=True),
+}
+
+class LayerNorm(nn.LayerNorm):
+    """
+    总是在fp32中计算的LayerNorm，输出转回输入的dtype
+    CPU上的autocast不会把layer_norm提升到fp32，bf16下均值/方差的误差会逐层累积；
+    参数名和nn.LayerNorm相同，checkpoint可以直接加载
+    """
+    def forward(self, X):
+        if X.dtype == torch.float32:
+            return super().forward(X)
+        with torch.autocast(X.device.type, enabled=False):
+            out = F.layer_norm(X.float(), self.normalized_shape, self.weight.float(), self.bias.float(), self.eps)
+        return out.to(X.dtype)
+
 class EncoderLayer(nn.Module):
-    def __init__(self, dim, n, dff, dropout_posffn, dropout_attn):
+    def __init__(
+        self, dim, n, dff, dropout_posffn, dropout_attn, fused_qkv=False, ffn_impl="conv", attn_window=None, num_global=0,
+    ):
         """
         Args:
             dim: dimension of model
@@ -201,22 +952,28 @@ class EncoderLayer(nn.Module):
             dff: dimension of feedforward
             dropout_posffn: dropout rate of positionwise feedforward network
             dropout_attn: dropout rate of attention
+            fused_qkv: fuse W_Q/W_K/W_V of the self-attention into one projection
+            ffn_impl: implementation of the positionwise feedforward network, one of FFN_IMPLS
+            attn_window: one-sided window of local self-attention, None means full attention
+            num_global: number of leading global tokens when attn_window is set
         """
         assert dim % n == 0, "dim must be divisible by n"
         hdim = dim // n # head dimension
         super(EncoderLayer, self).__init__()
 
         # LayerNorm
-        self.norm1 = nn.LayerNorm(dim)
-        self.norm2 = nn.LayerNorm(dim)
+        self.norm1 = LayerNorm(dim)
+        self.norm2 = LayerNorm(dim)
         # MultiHeadAttention
-        self.multi_head_attn = MultiHeadAttention(hdim, hdim, dim, n, dropout_attn)
-        self.poswise_ffn = PoswiseFFN(dim,dff,p=dropout_posffn)
+        self.multi_head_attn = MultiHeadAttention(
+            hdim, hdim, dim, n, dropout_attn, fused="qkv" if fused_qkv else None, window=attn_window, num_global=num_global,
+        )
+        self.poswise_ffn = FFN_IMPLS[ffn_impl](dim,dff,p=dropout_posffn)
 
-    def forward(self,enc_in,attn_mask):
+    def forward(self,enc_in,attn_mask,cache=None,freqs_cis=None):
         residual = enc_in
         # MultiHeadAttention
-        context = self.multi_head_attn(enc_in,enc_in,enc_in,attn_mask)
+        context = self.multi_head_attn(enc_in,enc_in,enc_in,attn_mask,cache=cache,freqs_cis=freqs_cis)
         # residual connection and norm
         out = self.norm1(residual + context)
         residual = out
@@ -226,10 +983,35 @@ class EncoderLayer(nn.Module):
         out = self.norm2(residual + out)
         return out
 
+def checkpoint_segments(num_layers, checkpoint_layers, block_size=1):
+    """
+    把0 ~ num_layers-1号层划分成连续的段，返回[(start, end, recompute), ...]
+    checkpoint_layers中相邻的层每block_size个合成一段，反向传播时整段重新计算，只保存段的输入；
+    其余的层保存全部激活
+    """
+    segments = []
+    for i in range(num_layers):
+        recompute = i in checkpoint_layers
+        if segments and segments[-1][2] == recompute and (not recompute or i - segments[-1][0] < block_size):
+            segments[-1][1] = i + 1
+        else:
+            segments.append([i, i + 1, recompute])
+    return [tuple(segment) for segment in segments]
+
+def set_checkpointing(stack, layers="all", block_size=1):
+    """
+    设置Encoder/Decoder训练时要重计算激活的层，见Encoder.set_checkpointing
+    """
+    if layers == "all":
+        layers = range(len(stack.layers))
+    stack.checkpoint_layers = frozenset(layers or ())
+    stack.checkpoint_block_size = block_size
+
 class Encoder(nn.Module):
     def __init__(
         self,dropout_emb,dropout_posffn,dropout_attn,
-        num_layers,enc_dim,num_heads,dff,tgt_len,
+        num_layers,enc_dim,num_heads,dff,tgt_len,fused_qkv=False,ffn_impl="conv",attn_window=None,num_global=0,
+        pos_type="sinusoid",
     ):
         """
         args:
@@ -240,50 +1022,128 @@ class Encoder(nn.Module):
             enc_dim: dimension of model
             num_heads: number of heads
             dff: dimension of feedforward
-            tgt_len: length of target
+            tgt_len: length of target, kept for compatibility. the position table grows on demand.
+            fused_qkv: fuse the Q/K/V projections of every layer
+            ffn_impl: implementation of the positionwise feedforward network, one of FFN_IMPLS
+            attn_window: one-sided window of local self-attention (O(L*window) per layer), None means full attention
+            num_global: number of leading global frames that attend to and are attended by every frame
+            pos_type: "sinusoid" adds position embeddings to the input, "rope" rotates Q/K in every self-attention
         """
         super(Encoder,self).__init__()
         # the maximum length of input sequence
         self.tgt_len = tgt_len
-        self.pos_emb = nn.Embedding.from_pretrained(pos_sinusoid_embedding(tgt_len,enc_dim),freeze=True)
+        assert pos_type in POS_TYPES
+        self.pos_type = pos_type
+        self.pos_emb = RotaryEmbedding(enc_dim // num_heads) if pos_type == "rope" else SinusoidPositionEmbedding(enc_dim)
         self.emb_dropout = nn.Dropout(dropout_emb)
         self.layers = nn.ModuleList(
-            [EncoderLayer(enc_dim,num_heads,dff,dropout_posffn,dropout_attn) for _ in range(num_layers)]
+            [
+                EncoderLayer(enc_dim,num_heads,dff,dropout_posffn,dropout_attn,fused_qkv,ffn_impl,attn_window,num_global)
+                for _ in range(num_layers)
+            ]
         )
+        self.set_checkpointing(None)
+
+    def set_checkpointing(self, layers="all", block_size=1):
+        """
+        训练时反向传播阶段重新计算这些层的激活，不保存每层的注意力分数和FFN中间结果
+        Args:
+            layers: indices of the layers to recompute, "all", or None to disable.
+            block_size: up to block_size consecutive recomputed layers form one checkpoint,
+                only the input of the block is kept. larger blocks keep fewer layer inputs
+                but recompute more layers at once during backward.
+        """
+        set_checkpointing(self, layers, block_size)
 
     def forward(self, X, X_lens, mask=None):
         # add position embedding
         batch_size,seq_len,d_model = X.shape
-        out = X + self.pos_emb(torch.arange(seq_len,device=X.device))
+        if isinstance(mask, PackedMask):
+            # 打包序列：每段的位置从0开始
+            pos_emb = self.pos_emb.table(mask.max_seqlen_q,X.dtype,X.device)[mask.positions_q()]
+        else:
+            pos_emb = self.pos_emb(seq_len,dtype=X.dtype,device=X.device)
+        out, freqs_cis = self._add_position(X, pos_emb)
         out = self.emb_dropout(out)
         #encoder layers
-        for layer in self.layers:
-            out = layer(out,mask)
+        for start, end, recompute in checkpoint_segments(len(self.layers), self.checkpoint_layers, self.checkpoint_block_size):
+            if recompute and torch.is_grad_enabled():
+                # 重计算时恢复前向时的随机数状态，dropout的结果不变
+                out = checkpoint(self._run_layers, start, end, out, mask, freqs_cis, use_reentrant=False)
+            else:
+                out = self._run_layers(start, end, out, mask, freqs_cis)
+        return out
+
+    def _run_layers(self, start, end, out, mask, freqs_cis):
+        for layer in self.layers[start:end]:
+            out = layer(out,mask,freqs_cis=freqs_cis)
+        return out
+
+    def _add_position(self, X, pos_emb):
+        # sinusoid: 加到输入上；rope: 输入不变，cos/sin作为freqs_cis传给每层的注意力
+        if self.pos_type == "rope":
+            return X, pos_emb
+        return X + pos_emb, None
+
+    def init_stream_state(self, left_context):
+        return EncoderStreamState(len(self.layers), left_context)
+
+    def forward_chunk(self, X, state, X_lens=None):
+        """
+        流式编码：输入一个块，每层注意力只看这个块和state里缓存的前left_context帧，返回这个块的输出
+        args:
+            X: (b, chunk_len, d_model) the next frames of b streams.
+            state: EncoderStreamState from init_stream_state(), updated in place.
+            X_lens: (b,) valid frames of each stream in this chunk, None means all valid.
+                a stream only has padding after its last chunk.
+        """
+        # 局部注意力的分块要求K和Q等长，不能和left_context缓存一起用
+        assert self.layers[0].multi_head_attn.window is None, "streaming does not support local attention"
+        batch_size,seq_len,d_model = X.shape
+        # 直接计算这一块的位置编码，不随流的长度扩容共享的位置编码表
+        pos_emb = self.pos_emb.compute(seq_len,state.offset).to(dtype=X.dtype,device=X.device)
+        out, freqs_cis = self._add_position(X, pos_emb)
+        out = self.emb_dropout(out)
+        # 缓存的帧都有效，只有块末尾可能是填充
+        num_cached = state.caches[0].len
+        mask = None if X_lens is None else AttnMask(key_lens=num_cached + X_lens.long())
+        for layer, cache in zip(self.layers, state.caches):
+            out = layer(out,mask,cache=cache,freqs_cis=freqs_cis)
+        state.offset += seq_len
         return out
 
 class DecoderLayer(nn.Module):
-    def __init__(self,dim,n,dff,dropout_posffn,dropout_attn):
+    def __init__(self,dim,n,dff,dropout_posffn,dropout_attn,fused_qkv=False,ffn_impl="conv",num_kv_heads=None):
         super(DecoderLayer,self).__init__()
         assert dim % n == 0
         hdim = dim // n
         # LayerNorms
-        self.norm1 = nn.LayerNorm(dim)
-        self.norm2 = nn.LayerNorm(dim)
-        self.norm3 = nn.LayerNorm(dim)
+        self.norm1 = LayerNorm(dim)
+        self.norm2 = LayerNorm(dim)
+        self.norm3 = LayerNorm(dim)
         # Position-wise Feed-Forward networks
-        self.poswise_ffn = PoswiseFFN(dim,dff,p=dropout_posffn)
+        self.poswise_ffn = FFN_IMPLS[ffn_impl](dim,dff,p=dropout_posffn)
         # MultiHeadAttention,both self-attention and cross-attention
-        self.dec_attn = MultiHeadAttention(hdim,hdim,dim, n, dropout_attn)
-        self.enc_dec_attn = MultiHeadAttention(hdim,hdim,dim, n, dropout_attn)
+        # fused_qkv时self-attention融合Q/K/V，cross-attention的Q来自decoder，只融合K/V
+        # num_kv_heads: 两个注意力都用分组的K/V头，KV缓存和EncoderMemory缩小 n // num_kv_heads 倍
+        self.dec_attn = MultiHeadAttention(
+            hdim,hdim,dim, n, dropout_attn, fused="qkv" if fused_qkv else None, num_kv_heads=num_kv_heads,
+        )
+        self.enc_dec_attn = MultiHeadAttention(
+            hdim,hdim,dim, n, dropout_attn, fused="kv" if fused_qkv else None, num_kv_heads=num_kv_heads,
+        )
 
-    def forward(self,dec_in,enc_out,dec_mask,dec_enc_mask,cache=None,freqs_cis=None):
+    def forward(self,dec_in,enc_out,dec_mask,dec_enc_mask,cache=None,freqs_cis=None,memory=None):
+        # cache: 本层的LayerKVCache，为None时按完整前缀计算
+        # memory: 本层预先投影好的交叉注意力(K, V)，见EncoderMemory
+        # freqs_cis: RoPE模式下dec_in各位置的cos/sin，只用于self-attention
         # decoder's self-attention
         residual = dec_in
-        context = self.dec_attn(dec_in,dec_in,dec_in,dec_mask)
+        context = self.dec_attn(dec_in,dec_in,dec_in,dec_mask,cache=cache,freqs_cis=freqs_cis)
         dec_out = self.norm1(residual + context)
         # encoder-decoder cross-attention
         residual = dec_out
-        context = self.enc_dec_attn(dec_out,enc_out,enc_out,dec_enc_mask)
+        context = self.enc_dec_attn(dec_out,enc_out,enc_out,dec_enc_mask,memory=memory)
         dec_out = self.norm2(residual + context)
         # position-wise feed-forward networks
         residual = dec_out 
@@ -294,7 +1154,8 @@ class DecoderLayer(nn.Module):
 class Decoder(nn.Module):
     def __init__(
         self,dropout_emb,dropout_posffn,dropout_attn,
-        num_layers,dec_dim,num_heads,dff,tgt_len,tgt_vocab_size,
+        num_layers,dec_dim,num_heads,dff,tgt_len,tgt_vocab_size,fused_qkv=False,ffn_impl="conv",num_kv_heads=None,
+        pos_type="sinusoid",
     ):
         """
         args:
@@ -305,93 +1166,401 @@ class Decoder(nn.Module):
             dec_dim: dimension of model
             num_heads: number of heads
             dff: dimension of feedforward
-            tgt_len: length of target
+            tgt_len: length of target, kept for compatibility. the position table grows on demand.
             tgt_vocab_size: size of target vocabulary
+            fused_qkv: fuse the Q/K/V (self-attention) and K/V (cross-attention) projections of every layer
+            ffn_impl: implementation of the positionwise feedforward network, one of FFN_IMPLS
+            num_kv_heads: number of K/V heads of both attentions (grouped-query attention), None means num_heads.
+                multi-head checkpoints are converted by mean-pooling the K/V heads when loading.
+            pos_type: "sinusoid" adds position embeddings to the token embeddings, "rope" rotates Q/K in dec_attn
         """
         super(Decoder,self).__init__()
+        # the maximum length of output sequence
+        self.tgt_len = tgt_len
 
         # out embedding
         self.tgt_emb = nn.Embedding(tgt_vocab_size,dec_dim)
         self.dropout_emb = nn.Dropout(p=dropout_emb)
         # position embedding
-        self.pos_emb = nn.Embedding.from_pretrained(pos_sinusoid_embedding(tgt_len,dec_dim),freeze=True)
+        assert pos_type in POS_TYPES
+        self.pos_type = pos_type
+        self.pos_emb = RotaryEmbedding(dec_dim // num_heads) if pos_type == "rope" else SinusoidPositionEmbedding(dec_dim)
         # decoder layers
         self.layers = nn.ModuleList(
             [
-                DecoderLayer(dec_dim,num_heads,dff,dropout_posffn,dropout_attn) for _ in range(num_layers)
+                DecoderLayer(dec_dim,num_heads,dff,dropout_posffn,dropout_attn,fused_qkv,ffn_impl,num_kv_heads)
+                for _ in range(num_layers)
             ]
         )
+        self.set_checkpointing(None)
+
+    def set_checkpointing(self, layers="all", block_size=1):
+        # 参数同Encoder.set_checkpointing
+        set_checkpointing(self, layers, block_size)
+
+    def build_memory(self, enc_out):
+        """
+        为每层的enc_dec_attn预先投影enc_out，返回EncoderMemory，可直接当作forward的enc_out传入
+        """
+        return EncoderMemory(enc_out, [layer.enc_dec_attn.project_kv(enc_out, enc_out) for layer in self.layers])
 
     def forward(self,labels,enc_out,dec_mask,dec_enc_mask,cache=None):
+        """
+        args:
+            labels: (b, L) token ids. with cache, only the new tokens.
+            enc_out: encoder output, or an EncoderMemory from build_memory().
+            dec_mask: AttnMask / bool mask, or PackedMask when labels is a packed (1, total_len) sequence.
+            cache: KVCache. new tokens are placed after the cache.seq_len cached ones,
+                and dec_mask may be None (a causal AttnMask is used).
+                cache.seq_len may be a (b,) tensor when every row has a different length (see paged_decoding).
+        """
+        b, seq_len = labels.size()
+        offset = 0 if cache is None else cache.seq_len
+        if cache is not None and dec_mask is None:
+            dec_mask = AttnMask(is_causal=True)
         # output embedding and position embedding
         tgt_emb = self.tgt_emb(labels)
-        pos_emb = self.pos_emb(torch.arange(labels.size(1),device=labels.device))
-        dec_out = self.dropout_emb(tgt_emb + pos_emb)
+        if isinstance(dec_mask, PackedMask):
+            # 打包序列：每段的位置从0开始
+            pos_emb = self.pos_emb.table(dec_mask.max_seqlen_q,tgt_emb.dtype,labels.device)[dec_mask.positions_q()]
+        elif torch.is_tensor(offset):
+            # 每行已缓存的长度不同：按行取位置编码，形状为(b, seq_len, ...)
+            positions = offset.unsqueeze(1) + torch.arange(seq_len, device=labels.device)
+            pos_emb = self.pos_emb.table(int(positions.max()) + 1,tgt_emb.dtype,labels.device)[positions]
+        else:
+            pos_emb = self.pos_emb(seq_len,offset,dtype=tgt_emb.dtype,device=labels.device)
+        freqs_cis = None
+        if self.pos_type == "rope":
+            # RoPE: 不加位置编码，cos/sin交给每层的dec_attn
+            dec_out, freqs_cis = self.dropout_emb(tgt_emb), pos_emb
+        else:
+            dec_out = self.dropout_emb(tgt_emb + pos_emb)
+        memory = None
+        if isinstance(enc_out, EncoderMemory):
+            memory, enc_out = enc_out, enc_out.enc_out
         #decoder layers
-        for layer in self.layers:
-            dec_out = layer(dec_out,enc_out,dec_mask,dec_enc_mask)
+        # 带KV缓存的增量解码不做重计算，重算会把新的K/V再追加一次
+        checkpoint_layers = self.checkpoint_layers if cache is None else ()
+        for start, end, recompute in checkpoint_segments(len(self.layers), checkpoint_layers, self.checkpoint_block_size):
+            args = (start, end, dec_out, enc_out, dec_mask, dec_enc_mask, cache, memory, freqs_cis)
+            if recompute and torch.is_grad_enabled():
+                dec_out = checkpoint(self._run_layers, *args, use_reentrant=False)
+            else:
+                dec_out = self._run_layers(*args)
         return dec_out
 
+    def _run_layers(self, start, end, dec_out, enc_out, dec_mask, dec_enc_mask, cache, memory, freqs_cis):
+        for i in range(start, end):
+            dec_out = self.layers[i](
+                dec_out,enc_out,dec_mask,dec_enc_mask,
+                cache=None if cache is None else cache[i],
+                memory=None if memory is None else memory[i],
+                freqs_cis=freqs_cis,
+            )
+        return dec_out
+
+class EncoderCache:
+    """
+    编码器输出的LRU缓存，key是X/X_lens内容的哈希
+    同一段语音换一种解码方式(n-best、重打分、不同的beam)再解码时，直接复用enc_out，不再运行frontend和encoder；
+    缓存的enc_out总字节数超过max_bytes时淘汰最久没有用到的
+    key里还包括frontend/encoder的模块和参数的标识及版本号：load_state_dict、原地修改参数、to()转换、
+    原地量化替换模块之后key都会改变，旧的结果不会再命中，由LRU淘汰；Transformer.train()时直接清空
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key -> enc_out
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(X, X_lens, *modules):
+        """
+        按内容计算key，还包括形状、dtype、设备和autocast的精度(它们都会改变enc_out)，
+        以及modules(产生enc_out的frontend和encoder)的权重标识
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for t in (X, X_lens):
+            digest.update(t.detach().contiguous().view(torch.uint8).cpu().numpy().tobytes())
+        autocast = torch.get_autocast_dtype(X.device.type) if torch.is_autocast_enabled(X.device.type) else None
+        return digest.hexdigest(), tuple(X.shape), X.dtype, X_lens.dtype, X.device, autocast, EncoderCache.weights_key(*modules)
+
+    @staticmethod
+    def weights_key(*modules):
+        """
+        模块和参数的标识：子模块被替换(如量化)、参数被替换(to/load_state_dict(assign=True))
+        或原地修改(load_state_dict、优化器更新，_version会增加)后都会改变
+        """
+        key = []
+        for module in modules:
+            key.extend(id(m) for m in module.modules())
+            key.extend((id(t), t.data_ptr(), t._version, t.dtype) for t in module.parameters())
+            key.extend((id(t), t.data_ptr(), t._version, t.dtype) for t in module.buffers())
+        return tuple(key)
+
+    def get(self, key):
+        enc_out = self.entries.get(key)
+        if enc_out is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return enc_out
+
+    def put(self, key, enc_out):
+        size = enc_out.numel() * enc_out.element_size()
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= self.entries[key].numel() * self.entries[key].element_size()
+        self.entries[key] = enc_out
+        self.entries.move_to_end(key)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.numel() * old.element_size()
+            self.evictions += 1
+
+    def __deepcopy__(self, memo):
+        # 复制出来的模型(例如量化、转换精度后的模型)输出不同，不能共用缓存的结果
+        return EncoderCache(self.max_bytes)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0., "entries": len(self.entries), "bytes": self.nbytes,
+        }
+
+def greedy_decode(step, tokens, eos_id, max_len):
+    """
+    贪心解码的循环，模型相关的部分都在step里(Transformer.generate和导出的模型共用)
+    Args:
+        step: callable taking the (b, 1) tokens of the previous step and returning (b, vocab) logits of the next token;
+            it keeps its own decoder state (KV cache etc.) between calls.
+        tokens: (b, 1) start tokens (sos).
+        eos_id: a sequence is finished once it produces eos_id.
+        max_len: maximum number of generated tokens.
+    Returns:
+        tokens: (b, T) generated ids without sos, positions after eos are filled with eos_id.
+        lengths: (b,) number of tokens before eos.
+    """
+    b = tokens.size(0)
+    lengths = torch.full((b,),max_len,dtype=torch.long,device=tokens.device)
+    finished = torch.zeros(b,dtype=torch.bool,device=tokens.device)
+    outputs = []
+    for i in range(max_len):
+        tokens = step(tokens).argmax(dim=-1,keepdim=True)     # (b, 1)
+        tokens.masked_fill_(finished.unsqueeze(1),eos_id)
+        outputs.append(tokens)
+        is_eos = tokens.squeeze(1) == eos_id
+        lengths.masked_fill_(is_eos & ~finished,i)
+        finished |= is_eos
+        if finished.all():
+            break
+    return torch.cat(outputs,dim=1),lengths
+
 class Transformer(nn.Module):
     def __init__(
         self,frontend:nn.Module,encoder:nn.Module,decoder:nn.Module,
-        dec_out_dim:int,vocab:int,
+        dec_out_dim:int,vocab:int,encoder_cache:EncoderCache=None,
     ) -> None:
+        """
+        args:
+            encoder_cache: optional EncoderCache used by encode() in eval mode without autograd.
+        """
         super().__init__()
         self.frontend = frontend
         self.encoder = encoder
         self.decoder = decoder
         self.linear = nn.Linear(dec_out_dim,vocab)
+        self.encoder_cache = encoder_cache
 
-    def forward(self,X:torch.Tensor,X_lens:torch.Tensor,labels:torch.Tensor):
-        X_lens,labels = X_lens.long(),labels.long()
-        b = X.size(0)
-        device = X.device
+    def train(self,mode:bool=True):
+        # 训练会改变权重，缓存的编码器输出不再有效
+        if mode and self.encoder_cache is not None:
+            self.encoder_cache.clear()
+        return super().train(mode)
+
+    def encode(self,X:torch.Tensor,X_lens:torch.Tensor) -> torch.Tensor:
+        cache = self.encoder_cache
+        # 训练、需要梯度或者导出/编译时不使用缓存
+        if cache is None or self.training or torch.is_grad_enabled() or torch.compiler.is_compiling():
+            return self._encode(X,X_lens)
+        key = cache.key(X,X_lens,self.frontend,self.encoder)
+        enc_out = cache.get(key)
+        if enc_out is None:
+            enc_out = self._encode(X,X_lens)
+            cache.put(key,enc_out)
+        return enc_out
+
+    def _encode(self,X:torch.Tensor,X_lens:torch.Tensor) -> torch.Tensor:
         # frontend
         out = self.frontend(X)
-        max_feat_len = out.size(1)
-        max_label_len = labels.size(1)
         #encoder 
-        enc_mask = get_len_mask(b,max_feat_len,X_lens,device)
-        enc_out = self.encoder(out,X_lens,enc_mask)
+        enc_mask = AttnMask(key_lens=X_lens.long())
+        return self.encoder(out,X_lens,enc_mask)
+
+    def encode_chunk(self,X:torch.Tensor,state:EncoderStreamState,X_lens:torch.Tensor=None) -> torch.Tensor:
+        """
+        流式编码一个块，frontend必须是逐帧的，参数见Encoder.forward_chunk
+        """
+        return self.encoder.forward_chunk(self.frontend(X),state,X_lens)
+
+    def forward(self,X:torch.Tensor,X_lens:torch.Tensor,labels:torch.Tensor):
+        X_lens,labels = X_lens.long(),labels.long()
+        enc_out = self.encode(X,X_lens)
         # decoder 
-        dec_mask = get_subsequent_mask(b,max_label_len,device)
-        dec_enc_mask = get_enc_dec_mask(b,max_feat_len,X_lens,max_label_len,device)
+        dec_mask = AttnMask(is_causal=True)
+        dec_enc_mask = AttnMask(key_lens=X_lens)
         dec_out = self.decoder(labels,enc_out,dec_mask,dec_enc_mask)
         logits = self.linear(dec_out)
 
         return logits
 
-if __name__ == "__main__":
-    # constants
-    batch_size = 16                 # batch size
-    max_feat_len = 100              # the maximum length of input sequence
-    max_lable_len = 50              # the maximum length of output sequence
-    fbank_dim = 80                  # the dimension of input feature
-    hidden_dim = 512                # the dimension of hidden layer
-    vocab_size = 26                 # the size of vocabulary
-
-    # dummy data
-    fbank_feature = torch.randn(batch_size, max_feat_len, fbank_dim)        # input sequence
-    feat_lens = torch.randint(1, max_feat_len, (batch_size,))               # the length of each input sequence in the batch
-    labels = torch.randint(0, vocab_size, (batch_size, max_lable_len))      # output sequence
-    label_lens = torch.randint(1, max_lable_len, (batch_size,))             # the length of each output sequence in the batch
-
-    # model
-    feature_extractor = nn.Linear(fbank_dim, hidden_dim)                     # alinear layer to simulate the audio feature extractor
+    def forward_packed(
+        self,X:torch.Tensor,cu_seqlens:torch.Tensor,labels:torch.Tensor,label_cu_seqlens:torch.Tensor,
+    ):
+        """
+        打包输入的前向计算，不对填充位置做任何计算，结果与forward在有效位置上一致
+        frontend必须是逐帧的(例如nn.Linear)，不能跨帧混合
+        Args:
+            X: (total_frames, fbank_dim) utterances packed by pack_sequences.
+            cu_seqlens: (b+1,) cumulative frame lengths.
+            labels: (total_labels,) packed labels.
+            label_cu_seqlens: (b+1,) cumulative label lengths.
+        Returns:
+            logits: (total_labels, vocab)
+        """
+        labels = labels.long()
+        # 打包后的序列作为batch_size=1的输入，各层不需要任何修改
+        out = self.frontend(X.unsqueeze(0))
+        enc_out = self.encoder(out,None,PackedMask(cu_seqlens))
+        dec_mask = PackedMask(label_cu_seqlens,is_causal=True)
+        dec_enc_mask = PackedMask(label_cu_seqlens,cu_seqlens)
+        dec_out = self.decoder(labels.unsqueeze(0),enc_out,dec_mask,dec_enc_mask)
+        return self.linear(dec_out).squeeze(0)
+
+    @torch.no_grad()
+    def generate(self,X:torch.Tensor,X_lens:torch.Tensor,sos_id:int,eos_id:int,max_len:int=200):
+        """
+        贪心自回归解码，每步只把上一步生成的token送进Decoder，历史K/V由KVCache提供
+        Returns:
+            tokens: (b, T) generated ids without sos, positions after eos are filled with eos_id.
+            lengths: (b,) number of tokens before eos.
+        """
+        X_lens = X_lens.long()
+        b = X.size(0)
+        device = X.device
+        enc_out = self.encode(X,X_lens)
+        dec_enc_mask = AttnMask(key_lens=X_lens)
+        # 交叉注意力的K/V每层只投影一次
+        memory = self.decoder.build_memory(enc_out)
+        cache = KVCache(len(self.decoder.layers))
+
+        def step(tokens):
+            return self.linear(self.decoder(tokens,memory,None,dec_enc_mask,cache)[:,-1])
+
+        tokens = torch.full((b,1),sos_id,dtype=torch.long,device=device)
+        return greedy_decode(step,tokens,eos_id,max_len)
+
+def teacher_forcing_loss(model:Transformer,X:torch.Tensor,X_lens:torch.Tensor,labels:torch.Tensor,label_lens:torch.Tensor=None):
+    """
+    teacher forcing的交叉熵：Decoder输入labels[:, :-1]，预测下一个token labels[:, 1:]
+    Args:
+        labels: (b, L) label ids, labels[:, 0] is the start token (sos), L >= 2.
+        label_lens: (b,) lengths of labels (including the start token), padded targets are excluded from the loss;
+            None means no padding.
+    """
+    logits = model(X,X_lens,labels[:,:-1])
+    targets = labels[:,1:].long()
+    if label_lens is None:
+        return F.cross_entropy(logits.transpose(1,2),targets)
+    loss = F.cross_entropy(logits.transpose(1,2),targets,reduction="none")
+    # 长度为label_lens的序列有label_lens-1个预测目标
+    valid = ~get_key_padding_mask(targets.size(1),label_lens-1,labels.device)
+    return (loss*valid).sum()/valid.sum().clamp(min=1)
+
+# 各模块__main__演示共用的模型规模和数据形状
+DEMO_BATCH_SIZE = 16
+DEMO_MAX_FEAT_LEN = 100
+DEMO_MAX_LABEL_LEN = 50
+DEMO_FBANK_DIM = 80
+DEMO_HIDDEN_DIM = 512
+DEMO_VOCAB_SIZE = 26
+
+def demo_model(num_layers=6, **kwargs):
+    """
+    构造演示用的Transformer(d_model=512、8头、d_ff=2048，前端是模拟声学特征提取的线性层)，随机初始化
+    Args:
+        num_layers: number of encoder and decoder layers.
+        kwargs: extra arguments of both Encoder and Decoder, e.g. fused_qkv=True.
+    """
     encoder = Encoder(
         dropout_emb=0.1, dropout_posffn=0.1, dropout_attn=0.,
-        num_layers=6, enc_dim=hidden_dim, num_heads=8, dff=2048, tgt_len=2048
+        num_layers=num_layers, enc_dim=DEMO_HIDDEN_DIM, num_heads=8, dff=2048, tgt_len=2048, **kwargs
     )
     decoder = Decoder(
         dropout_emb=0.1, dropout_posffn=0.1, dropout_attn=0.,
-        num_layers=6, dec_dim=hidden_dim, num_heads=8, dff=2048, tgt_len=2048, tgt_vocab_size=vocab_size
+        num_layers=num_layers, dec_dim=DEMO_HIDDEN_DIM, num_heads=8, dff=2048, tgt_len=2048,
+        tgt_vocab_size=DEMO_VOCAB_SIZE, **kwargs
     )
-    transformer = Transformer(feature_extractor, encoder, decoder, hidden_dim, vocab_size)
+    return Transformer(nn.Linear(DEMO_FBANK_DIM, DEMO_HIDDEN_DIM), encoder, decoder, DEMO_HIDDEN_DIM, DEMO_VOCAB_SIZE)
+
+def demo_batch(batch_size=DEMO_BATCH_SIZE, max_feat_len=DEMO_MAX_FEAT_LEN, max_label_len=DEMO_MAX_LABEL_LEN):
+    """
+    随机的演示数据
+    Returns:
+        fbank_feature: (batch_size, max_feat_len, fbank_dim) input features.
+        feat_lens: (batch_size,) frame counts in [1, max_feat_len).
+        labels: (batch_size, max_label_len) label ids.
+        label_lens: (batch_size,) label lengths in [1, max_label_len).
+    """
+    fbank_feature = torch.randn(batch_size, max_feat_len, DEMO_FBANK_DIM)
+    feat_lens = torch.randint(1, max_feat_len, (batch_size,))
+    labels = torch.randint(0, DEMO_VOCAB_SIZE, (batch_size, max_label_len))
+    label_lens = torch.randint(1, max_label_len, (batch_size,))
+    return fbank_feature, feat_lens, labels, label_lens
+
+if __name__ == "__main__":
+    # dummy data and model
+    fbank_feature, feat_lens, labels, label_lens = demo_batch()
+    transformer = demo_model()
 
     # forward check
     logits = transformer(fbank_feature, feat_lens, labels)
     print(f"logits: {logits.shape}")     # (batch_size, max_label_len, vocab_size)
 
+    # incremental decoding check
+    transformer.eval()
+    tokens, token_lens = transformer.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=20)
+    print(f"tokens: {tokens.shape}")
+
+    # streaming encoding check
+    with torch.no_grad():
+        state = transformer.encoder.init_stream_state(left_context=32)
+        chunks = [transformer.encode_chunk(chunk, state) for chunk in fbank_feature.split(16, dim=1)]
+    print(f"streamed enc_out: {torch.cat(chunks, dim=1).shape}")
+
+    # encoder cache check: the second decode of the same batch skips the encoder
+    transformer.encoder_cache = EncoderCache(max_bytes=64 * 2**20)
+    for _ in range(2):
+        transformer.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=20)
+    print(f"encoder cache: {transformer.encoder_cache.stats()}")
+    # 加载新的权重后不能命中旧的enc_out
+    new_weights = demo_model().eval()
+    misses = transformer.encoder_cache.misses
+    transformer.load_state_dict(new_weights.state_dict())
+    with torch.no_grad():
+        diff = (transformer(fbank_feature, feat_lens, labels) - new_weights(fbank_feature, feat_lens, labels)).abs().max()
+    assert transformer.encoder_cache.misses == misses + 1, "stale encoder output after load_state_dict"
+    print(f"after load_state_dict: cache miss, logits max diff vs fresh model {diff.item():.2e}")
+
     # output msg
     # logits: torch.Size([16, 100, 26])
\ No newline at end of file
@@ -0,0 +1,191 @@
+# 激活重计算(activation checkpointing)和按内存预算选择重计算的层
+#
+# 用法:
+#   plan = plan_checkpointing(transformer, X, X_lens, labels, budget_mb=2048)
+#   apply_plan(transformer, plan)                     # 之后正常训练，反向时重算选中的层
+#   transformer.encoder.set_checkpointing("all", block_size=2)    # 也可以直接指定
+#
+# 训练时每层要为反向传播保存激活：注意力分数和softmax结果是[N, heads, L, L]，FFN中间结果是[N, L, d_ff]，
+# 长序列时显存/内存主要花在这里。重计算的层只保存输入，反向传播到这一层时再前向计算一次，
+# 用大约一次额外前向的时间换内存。plan_checkpointing先实际跑一次前向，统计每层保存了多少字节，
+# 再按节省的字节数从大到小选层，直到估计的峰值不超过预算。
+import torch
+
+from TransformerDemo import Transformer, checkpoint_segments, teacher_forcing_loss
+from metrics import peak_memory, timeit
+
+STACKS = ("encoder", "decoder")
+
+def train_step(model: Transformer, X, X_lens, labels):
+    model.zero_grad(set_to_none=True)
+    loss = teacher_forcing_loss(model, X, X_lens, labels)
+    loss.backward()
+    return loss
+
+def saved_activation_bytes(model: Transformer, X, X_lens, labels):
+    """
+    不做重计算时一次前向为反向传播保存的激活字节数(不含参数，共用同一块存储的张量只算一次)
+    Returns:
+        {"encoder": [bytes of layer 0, ...], "decoder": [...], "other": bytes outside the layers,
+         "encoder_input": [bytes of the input of layer 0, ...], "decoder_input": [...]}
+    """
+    params = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    seen = set()
+    result = {"other": 0}
+    current = ["other"]
+    handles = []
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in params and storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            if current[0] == "other":
+                result["other"] += storage.nbytes()
+            else:
+                stack, i = current[0]
+                result[stack][i] += storage.nbytes()
+        return tensor
+
+    def pre_hook(stack, i):
+        def hook(module, args):
+            current[0] = (stack, i)
+            result[f"{stack}_input"][i] = args[0].untyped_storage().nbytes()
+        return hook
+
+    def post_hook(module, args, output):
+        current[0] = "other"
+
+    saved = {}
+    for stack in STACKS:
+        layers = getattr(model, stack).layers
+        result[stack] = [0] * len(layers)
+        result[f"{stack}_input"] = [0] * len(layers)
+        saved[stack] = (getattr(model, stack).checkpoint_layers, getattr(model, stack).checkpoint_block_size)
+        getattr(model, stack).set_checkpointing(None)
+        for i, layer in enumerate(layers):
+            handles.append(layer.register_forward_pre_hook(pre_hook(stack, i)))
+            handles.append(layer.register_forward_hook(post_hook))
+    try:
+        with torch.enable_grad(), torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            teacher_forcing_loss(model, X, X_lens, labels)
+    finally:
+        for handle in handles:
+            handle.remove()
+        for stack in STACKS:
+            getattr(model, stack).set_checkpointing(*saved[stack])
+    return result
+
+def estimate_bytes(activations, plan, block_size=1):
+    """
+    按saved_activation_bytes的统计估计plan下的激活峰值：
+    不重计算的层保存全部激活，重计算的每段只保存输入，反向时再加上最大一段重新计算的激活
+    """
+    total = activations["other"]
+    recompute_peak = 0
+    for stack in STACKS:
+        layers = activations[stack]
+        for start, end, recompute in checkpoint_segments(len(layers), plan[stack], block_size):
+            if recompute:
+                total += activations[f"{stack}_input"][start]
+                recompute_peak = max(recompute_peak, sum(layers[start:end]))
+            else:
+                total += sum(layers[start:end])
+    return total + recompute_peak
+
+def plan_checkpointing(model: Transformer, X, X_lens, labels, budget_mb, block_size=1):
+    """
+    选择要重计算的层，使估计的激活峰值不超过budget_mb；每次选节省字节数最多的层，尽量少重算
+    Args:
+        model: Transformer in training mode.
+        X, X_lens, labels: a batch of the target shape (the longest batch the training run will see).
+        budget_mb: memory budget of the saved activations in MB (weights, gradients and optimizer states excluded).
+        block_size: passed to set_checkpointing.
+    Returns:
+        {"encoder": [layer indices], "decoder": [...], "block_size": ..., "estimated_mb": ..., "fits": bool}
+        when even recomputing every layer exceeds the budget, all layers are selected and fits is False.
+    """
+    activations = saved_activation_bytes(model, X, X_lens, labels)
+    budget = budget_mb * 2**20
+    plan = {stack: set() for stack in STACKS}
+    candidates = sorted(
+        ((activations[stack][i] - activations[f"{stack}_input"][i], stack, i)
+         for stack in STACKS for i in range(len(activations[stack]))),
+        reverse=True,
+    )
+    estimated = estimate_bytes(activations, plan, block_size)
+    for _, stack, i in candidates:
+        if estimated <= budget:
+            break
+        plan[stack].add(i)
+        estimated = estimate_bytes(activations, plan, block_size)
+    return {
+        "encoder": sorted(plan["encoder"]),
+        "decoder": sorted(plan["decoder"]),
+        "block_size": block_size,
+        "estimated_mb": estimated / 2**20,
+        "fits": estimated <= budget,
+    }
+
+def apply_plan(model: Transformer, plan):
+    for stack in STACKS:
+        getattr(model, stack).set_checkpointing(plan[stack], plan["block_size"])
+
+def memory_report(model: Transformer, X, X_lens, labels, plans, warmup=1, iters=3):
+    """
+    对每种重计算方案测一次训练步(前向+反向)的新分配内存峰值和平均耗时
+    Args:
+        plans: {name: plan}, plan as returned by plan_checkpointing (only "encoder", "decoder" and "block_size" are used).
+    Returns:
+        [{"name", "encoder", "decoder", "block_size", "peak_memory_mb", "step_time_ms"}, ...]
+    """
+    saved = [(getattr(model, stack).checkpoint_layers, getattr(model, stack).checkpoint_block_size) for stack in STACKS]
+    results = []
+    try:
+        for name, plan in plans.items():
+            apply_plan(model, plan)
+            step = lambda: train_step(model, X, X_lens, labels)
+            results.append({
+                "name": name,
+                "encoder": sorted(plan["encoder"]),
+                "decoder": sorted(plan["decoder"]),
+                "block_size": plan["block_size"],
+                "peak_memory_mb": peak_memory(step) / 2**20,
+                "step_time_ms": timeit(step, warmup, iters) * 1e3,
+            })
+    finally:
+        for stack, (layers, block_size) in zip(STACKS, saved):
+            getattr(model, stack).set_checkpointing(layers, block_size)
+        model.zero_grad(set_to_none=True)
+    return results
+
+if __name__ == "__main__":
+    from TransformerDemo import DEMO_MAX_FEAT_LEN, DEMO_MAX_LABEL_LEN, demo_batch, demo_model
+
+    transformer = demo_model().train()
+    num_layers = len(transformer.encoder.layers)
+
+    def make_batch(scale):
+        # 所有样本都是最长的长度
+        X, _, labels, _ = demo_batch(max_feat_len=DEMO_MAX_FEAT_LEN * scale, max_label_len=DEMO_MAX_LABEL_LEN * scale)
+        return X, torch.full((X.size(0),), X.size(1)), labels
+
+    none = {"encoder": [], "decoder": [], "block_size": 1}
+    every = {"encoder": range(num_layers), "decoder": range(num_layers), "block_size": 1}
+
+    # 预算取原长度不做重计算时的激活量，看两倍长度的序列需要重算哪些层
+    batch = make_batch(1)
+    base = estimate_bytes(saved_activation_bytes(transformer, *batch), {"encoder": (), "decoder": ()}) / 2**20
+    long_batch = make_batch(2)
+    plan = plan_checkpointing(transformer, *long_batch, budget_mb=base)
+    print(f"activations at 1x length: {base:.1f} MB (budget)")
+    print(
+        f"plan at 2x length: encoder {plan['encoder']}, decoder {plan['decoder']}, "
+        f"estimated {plan['estimated_mb']:.1f} MB, fits: {plan['fits']}"
+    )
+
+    for scale, plans in [(1, {"none": none, "all": every}), (2, {"none": none, "all": every, "budget": plan})]:
+        for result in memory_report(transformer, *make_batch(scale), plans):
+            print(
+                f"{scale}x {result['name']:>6}: peak {result['peak_memory_mb']:8.1f} MB, "
+                f"step {result['step_time_ms']:8.1f} ms"
+            )
@@ -0,0 +1,200 @@
+# 按长度分桶、按token预算组batch的训练数据加载
+#
+# 用法:
+#   sampler = BucketBatchSampler(dataset.lengths, max_tokens=1600, shuffle=True)
+#   loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_utterances, num_workers=2)
+#   for epoch in range(num_epochs):
+#       sampler.set_epoch(epoch)
+#       stats = run_epoch(transformer, loader, optimizer)
+#
+# 随机组batch时每条语音都要填充到batch里最长的那条，长短差异大时一半以上的计算花在填充帧上；
+# 固定batch_size时短句batch的显存/内存又用不满。这里先按帧数排序，把长度相近的语音放进同一个batch，
+# 每个batch填充后的帧数 batch_size * max_len 不超过max_tokens，短句的batch自然更大。
+# 每个epoch打乱batch的顺序，长度相同的语音随机分配，不会每个epoch都得到完全相同的batch。
+import math
+import statistics
+import time
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, Sampler
+
+from TransformerDemo import Transformer, teacher_forcing_loss
+
+class RandomUtteranceDataset(Dataset):
+    """
+    随机生成的(fbank, labels)数据集，长度在[min_len, max_len]之间均匀分布，标签长度约为帧数的一半(至少2)
+    每条数据由seed和下标确定，可以在DataLoader的worker进程中生成
+    """
+    def __init__(self, num_utts, fbank_dim=80, vocab_size=26, min_len=10, max_len=200, seed=0):
+        generator = torch.Generator().manual_seed(seed)
+        self.lengths = torch.randint(min_len, max_len + 1, (num_utts,), generator=generator).tolist()
+        self.fbank_dim = fbank_dim
+        self.vocab_size = vocab_size
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + idx)
+        feat_len = self.lengths[idx]
+        fbank = torch.randn(feat_len, self.fbank_dim, generator=generator)
+        # 至少2个token：teacher forcing时第一个是输入，之后每个都是预测目标
+        labels = torch.randint(0, self.vocab_size, (max(feat_len // 2, 2),), generator=generator)
+        return fbank, labels
+
+class BucketBatchSampler(Sampler):
+    """
+    按长度分组的batch采样器，每个batch是一组下标，填充后的帧数不超过max_tokens
+    """
+    def __init__(self, lengths, max_tokens, max_batch_size=None, shuffle=True, seed=0, drop_last=False):
+        """
+        Args:
+            lengths: frame count of every utterance (e.g. dataset.lengths).
+            max_tokens: budget of padded frames per batch, batch_size * longest frame count in the batch.
+                an utterance longer than max_tokens gets a batch of its own.
+            max_batch_size: optional upper bound of utterances per batch.
+            shuffle: shuffle the batch order and the order of equal-length utterances every epoch.
+            seed: base seed, the epoch set by set_epoch() is added to it.
+            drop_last: drop the batch of the longest utterances when it is under half of the budget.
+        """
+        self.lengths = torch.as_tensor(lengths, dtype=torch.long)
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size or len(self.lengths)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._num_batches = len(self._batches(torch.argsort(self.lengths, stable=True)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _batches(self, order):
+        # order按长度升序，batch的最长帧数就是最后加入的那条
+        batches, batch = [], []
+        for idx, length in zip(order.tolist(), self.lengths[order].tolist()):
+            if batch and ((len(batch) + 1) * length > self.max_tokens or len(batch) == self.max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(idx)
+        if batch and not (self.drop_last and len(batch) * self.lengths[batch[-1]] < self.max_tokens // 2):
+            batches.append(batch)
+        return batches
+
+    def __iter__(self):
+        if not self.shuffle:
+            yield from self._batches(torch.argsort(self.lengths, stable=True))
+            return
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        # 先随机排列再稳定排序：长度相同的语音顺序随机
+        perm = torch.randperm(len(self.lengths), generator=generator)
+        order = perm[torch.argsort(self.lengths[perm], stable=True)]
+        batches = self._batches(order)
+        for i in torch.randperm(len(batches), generator=generator).tolist():
+            yield batches[i]
+
+    def __len__(self):
+        return self._num_batches
+
+def collate_utterances(batch, label_pad_id=0):
+    """
+    把[(fbank, labels), ...]组成Transformer.forward的输入，需要其他填充值时用functools.partial
+    Returns:
+        X: (b, max_feat_len, fbank_dim) zero-padded features.
+        X_lens: (b,) frame counts.
+        labels: (b, max_label_len) labels padded with label_pad_id.
+        label_lens: (b,) label lengths.
+    """
+    fbanks, labels = zip(*batch)
+    X = pad_sequence(fbanks, batch_first=True)
+    X_lens = torch.tensor([fbank.size(0) for fbank in fbanks])
+    label_lens = torch.tensor([label.size(0) for label in labels])
+    labels = pad_sequence(labels, batch_first=True, padding_value=label_pad_id)
+    return X, X_lens, labels, label_lens
+
+def run_epoch(model: Transformer, loader, optimizer=None):
+    """
+    训练一个epoch，统计填充浪费和每步耗时
+    Args:
+        loader: yields (X, X_lens, labels, label_lens), e.g. a DataLoader with collate_utterances.
+        optimizer: None only runs forward and backward.
+    Returns:
+        {"batches", "utterances", "frames", "frame_padding", "label_padding", "step_time_mean_ms",
+         "step_time_p50_ms", "data_time_s", "epoch_time_s", "frames_per_s", "loss"}
+        frame_padding/label_padding are the fractions of padded positions in all batches.
+    """
+    model.train()
+    frames = padded_frames = labels_total = padded_labels = utterances = 0
+    step_times, losses = [], []
+    data_time = 0.
+    start = data_start = time.perf_counter()
+    for X, X_lens, labels, label_lens in loader:
+        step_start = time.perf_counter()
+        data_time += step_start - data_start
+        model.zero_grad(set_to_none=True)
+        loss = teacher_forcing_loss(model, X, X_lens, labels, label_lens)
+        loss.backward()
+        if optimizer is not None:
+            optimizer.step()
+        step_times.append(time.perf_counter() - step_start)
+        losses.append(loss.item())
+        utterances += X.size(0)
+        frames += int(X_lens.sum())
+        padded_frames += X.size(0) * X.size(1)
+        labels_total += int(label_lens.sum())
+        padded_labels += labels.numel()
+        data_start = time.perf_counter()
+    epoch_time = time.perf_counter() - start
+    return {
+        "batches": len(step_times),
+        "utterances": utterances,
+        "frames": frames,
+        "frame_padding": 1 - frames / max(padded_frames, 1),
+        "label_padding": 1 - labels_total / max(padded_labels, 1),
+        "step_time_mean_ms": statistics.mean(step_times) * 1e3 if step_times else 0.,
+        "step_time_p50_ms": statistics.median(step_times) * 1e3 if step_times else 0.,
+        "data_time_s": data_time,
+        "epoch_time_s": epoch_time,
+        "frames_per_s": frames / epoch_time if epoch_time > 0 else 0.,
+        "loss": statistics.mean(losses) if losses else math.nan,
+    }
+
+if __name__ == "__main__":
+    import os
+
+    from torch.utils.data import DataLoader
+
+    from TransformerDemo import (
+        DEMO_BATCH_SIZE, DEMO_FBANK_DIM, DEMO_MAX_FEAT_LEN, DEMO_VOCAB_SIZE, demo_model,
+    )
+
+    batch_size = DEMO_BATCH_SIZE
+    max_feat_len = DEMO_MAX_FEAT_LEN
+    num_utts = 128
+    num_workers = min(2, os.cpu_count() or 1)
+
+    transformer = demo_model()
+    optimizer = torch.optim.Adam(transformer.parameters(), lr=1e-4)
+
+    # 平均帧数和demo的max_feat_len相同，最长的是它的两倍
+    dataset = RandomUtteranceDataset(num_utts, DEMO_FBANK_DIM, DEMO_VOCAB_SIZE, min_len=10, max_len=2 * max_feat_len)
+    # 随机组batch：固定batch_size
+    random_loader = DataLoader(
+        dataset, batch_size=batch_size, shuffle=True, collate_fn=collate_utterances, num_workers=num_workers,
+    )
+    # 分桶：token预算等于demo中一个batch的帧数
+    sampler = BucketBatchSampler(dataset.lengths, max_tokens=batch_size * max_feat_len)
+    bucket_loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_utterances, num_workers=num_workers)
+
+    for epoch in range(2):
+        sampler.set_epoch(epoch)
+        for name, loader in [("random", random_loader), ("bucket", bucket_loader)]:
+            stats = run_epoch(transformer, loader, optimizer)
+            print(
+                f"epoch {epoch} {name}: {stats['batches']} batches, frame padding {stats['frame_padding']:.1%}, "
+                f"label padding {stats['label_padding']:.1%}, step {stats['step_time_mean_ms']:.0f} ms "
+                f"(p50 {stats['step_time_p50_ms']:.0f} ms), epoch {stats['epoch_time_s']:.1f} s, "
+                f"{stats['frames_per_s']:.0f} frames/s"
+            )
@@ -0,0 +1,152 @@
+import torch
+
+from TransformerDemo import AttnMask, KVCache, Transformer
+
+class BeamSearch:
+    """
+    批量beam search解码
+    所有语音的所有beam放在同一个batch里(b*beam_size行)，每步只调用一次Decoder；
+    换beam时原地重排KVCache，已经结束的语音从batch中移除，不再参与计算
+    """
+    def __init__(
+        self,model:Transformer,sos_id:int,eos_id:int,
+        beam_size:int=4,max_len:int=200,len_penalty:float=1.0,early_stopping:bool=False,
+    ):
+        """
+        args:
+            model: Transformer
+            sos_id: id of start-of-sentence token
+            eos_id: id of end-of-sentence token
+            beam_size: number of beams per utterance
+            max_len: maximum number of generated tokens (including eos)
+            len_penalty: hypothesis score is log_prob / length ** len_penalty, 0 disables normalization
+            early_stopping: stop an utterance as soon as beam_size hypotheses are finished,
+                otherwise stop once no running beam can beat the worst finished one
+        """
+        self.model = model
+        self.sos_id = sos_id
+        self.eos_id = eos_id
+        self.beam_size = beam_size
+        self.max_len = max_len
+        self.len_penalty = len_penalty
+        self.early_stopping = early_stopping
+
+    def _normalize(self, scores, length):
+        return scores / (length ** self.len_penalty)
+
+    @torch.no_grad()
+    def __call__(self,X:torch.Tensor,X_lens:torch.Tensor):
+        """
+        Returns:
+            tokens: (b, beam_size, T) hypotheses without sos, best first, padded with eos_id.
+            lengths: (b, beam_size) number of tokens before eos.
+            scores: (b, beam_size) length-normalized log probabilities.
+        """
+        model = self.model
+        k, eos_id, max_len = self.beam_size, self.eos_id, self.max_len
+        X_lens = X_lens.long()
+        b = X.size(0)
+        device = X.device
+
+        enc_out = model.encode(X,X_lens)
+        # 每条语音扩展成k行，之后所有张量的batch维都是 n*k (n为还没结束的语音数)
+        rows = torch.arange(b,device=device).repeat_interleave(k)
+        memory = model.decoder.build_memory(enc_out).index_select(rows)
+        dec_enc_mask = AttnMask(key_lens=X_lens[rows])
+        cache = KVCache(len(model.decoder.layers))
+
+        alive = torch.arange(b,device=device)           # 还没结束的语音的原始下标
+        n = b
+        # 第一步所有beam都相同，只保留beam 0，避免topk选出k个重复的候选
+        scores = torch.full((n,k),float("-inf"),device=device)
+        scores[:,0] = 0.
+        history = torch.full((n*k,1),self.sos_id,dtype=torch.long,device=device)
+
+        # 每条语音已结束的k个最好的假设
+        fin_scores = torch.full((b,k),float("-inf"),device=device)
+        fin_tokens = torch.full((b,k,max_len),eos_id,dtype=torch.long,device=device)
+        fin_lens = torch.zeros((b,k),dtype=torch.long,device=device)
+
+        for t in range(max_len):
+            dec_out = model.decoder(history[:,-1:],memory,None,dec_enc_mask,cache)
+            log_probs = torch.log_softmax(model.linear(dec_out[:,-1]).float(),dim=-1)     # (n*k, V)
+            vocab = log_probs.size(-1)
+            cand = (scores.view(-1,1) + log_probs).view(n,k*vocab)
+            # 取2k个候选，保证去掉以eos结尾的之后还剩k个继续扩展
+            top_scores,top_idx = cand.topk(2*k,dim=1)                                   # (n, 2k)
+            beam_idx = torch.div(top_idx,vocab,rounding_mode="floor")
+            top_tokens = top_idx % vocab
+            is_eos = top_tokens == eos_id
+            base = (torch.arange(n,device=device) * k).unsqueeze(1)
+
+            if is_eos.any():
+                # 以eos结尾的候选并入已结束的假设，每条语音保留k个最好的
+                src = (base + beam_idx).view(-1)
+                cand_tokens = torch.full((n,2*k,max_len),eos_id,dtype=torch.long,device=device)
+                cand_tokens[:,:,:t] = history[src,1:].view(n,2*k,t)
+                cand_scores = self._normalize(top_scores,t + 1).masked_fill(~is_eos,float("-inf"))
+                all_scores = torch.cat([fin_scores[alive],cand_scores],dim=1)
+                all_tokens = torch.cat([fin_tokens[alive],cand_tokens],dim=1)
+                all_lens = torch.cat([fin_lens[alive],torch.full_like(top_tokens,t)],dim=1)
+                best,idx = all_scores.topk(k,dim=1)
+                fin_scores[alive] = best
+                fin_tokens[alive] = all_tokens.gather(1,idx.unsqueeze(-1).expand(-1,-1,max_len))
+                fin_lens[alive] = all_lens.gather(1,idx)
+
+            # 剩下的候选里按分数取前k个非eos的继续扩展 (argsort把eos候选排到最后)
+            order = (is_eos.long() * 2 * k + torch.arange(2*k,device=device)).argsort(dim=1)[:,:k]
+            scores = top_scores.gather(1,order)
+            src = (base + beam_idx.gather(1,order)).view(-1)
+            cache.reorder(src)
+            history = torch.cat([history[src],top_tokens.gather(1,order).view(-1,1)],dim=1)
+
+            if t == max_len - 1:
+                break
+            # 逐条语音判断是否可以提前结束
+            worst_fin = fin_scores[alive].min(dim=1).values         # 不足k个时为-inf
+            done = worst_fin > float("-inf")
+            if not self.early_stopping:
+                # 还在扩展的beam之后的分数只会更低，长度在[t+2, max_len]之间，取归一化后分数的上界
+                best_run = scores.max(dim=1).values
+                bound = torch.maximum(self._normalize(best_run,t + 2),self._normalize(best_run,max_len))
+                done &= worst_fin >= bound
+            if done.any():
+                keep = ~done
+                alive = alive[keep]
+                n = alive.numel()
+                if n == 0:
+                    break
+                rows = ((keep.nonzero().view(-1) * k).unsqueeze(1) + torch.arange(k,device=device)).view(-1)
+                cache.reorder(rows)
+                memory = memory.index_select(rows)
+                dec_enc_mask = dec_enc_mask.index_select(rows)
+                history = history[rows]
+                scores = scores[keep]
+
+        if n > 0 and history.size(1) > max_len:
+            # 到达max_len还没输出eos的beam也作为结束的假设
+            cand_scores = self._normalize(scores,max_len)
+            all_scores = torch.cat([fin_scores[alive],cand_scores],dim=1)
+            all_tokens = torch.cat([fin_tokens[alive],history[:,1:].view(n,k,max_len)],dim=1)
+            all_lens = torch.cat([fin_lens[alive],torch.full_like(fin_lens[alive],max_len)],dim=1)
+            best,idx = all_scores.topk(k,dim=1)
+            fin_scores[alive] = best
+            fin_tokens[alive] = all_tokens.gather(1,idx.unsqueeze(-1).expand(-1,-1,max_len))
+            fin_lens[alive] = all_lens.gather(1,idx)
+
+        # 已结束的假设按分数从高到低排序，并截掉多余的eos填充
+        fin_scores,idx = fin_scores.sort(dim=1,descending=True)
+        fin_tokens = fin_tokens.gather(1,idx.unsqueeze(-1).expand(-1,-1,max_len))
+        fin_lens = fin_lens.gather(1,idx)
+        T = min(max_len,int(fin_lens.max()) + 1)
+        return fin_tokens[:,:,:T],fin_lens,fin_scores
+
+if __name__ == "__main__":
+    from TransformerDemo import demo_batch, demo_model
+
+    fbank_feature, feat_lens, _, _ = demo_batch(batch_size=4)
+    transformer = demo_model().eval()
+
+    beam_search = BeamSearch(transformer, sos_id=0, eos_id=1, beam_size=4, max_len=20)
+    tokens, lengths, scores = beam_search(fbank_feature, feat_lens)
+    print(f"tokens: {tokens.shape}, lengths: {lengths.tolist()}")
@@ -0,0 +1,205 @@
+# Transformer各组件和整个模型的性能测试
+#
+# 用法:
+#   python benchmark.py suite --components mha ffn encoder_layer --batch-sizes 1 16 --seq-lens 100 400 \
+#       --output before.json
+#   python benchmark.py suite ... --output after.json --compare before.json
+#   python benchmark.py ffn --batch-size 16 --seq-len 100
+import argparse
+import itertools
+import json
+import platform
+import statistics
+
+import torch
+import torch.nn as nn
+
+from TransformerDemo import (
+    ATTN_BACKENDS, FFN_IMPLS, POS_TYPES, AttnMask, Decoder, DecoderLayer, Encoder, EncoderLayer,
+    MultiHeadAttention, Transformer, set_attn_backend,
+)
+from beam_search import BeamSearch
+from metrics import peak_memory, time_samples, timeit
+
+COMPONENTS = ["mha", "ffn", "encoder_layer", "decoder_layer", "transformer", "decode", "beam_search"]
+
+def build_model(args, num_heads, vocab_size=26):
+    encoder = Encoder(
+        dropout_emb=0., dropout_posffn=0., dropout_attn=0.,
+        num_layers=args.num_layers, enc_dim=args.d_model, num_heads=num_heads, dff=args.d_ff, tgt_len=2048,
+        fused_qkv=args.fused_qkv, ffn_impl=args.ffn_impl, attn_window=args.attn_window, num_global=args.num_global,
+        pos_type=args.pos_type,
+    )
+    decoder = Decoder(
+        dropout_emb=0., dropout_posffn=0., dropout_attn=0.,
+        num_layers=args.num_layers, dec_dim=args.d_model, num_heads=num_heads, dff=args.d_ff, tgt_len=2048,
+        tgt_vocab_size=vocab_size, fused_qkv=args.fused_qkv, ffn_impl=args.ffn_impl, num_kv_heads=args.num_kv_heads,
+        pos_type=args.pos_type,
+    )
+    return Transformer(nn.Linear(args.fbank_dim, args.d_model), encoder, decoder, args.d_model, vocab_size)
+
+def build_case(component, args, batch_size, seq_len, num_heads):
+    """
+    构造一个测试用例，返回(要计时的函数, 每次调用处理的token数)
+    """
+    d_model, d_ff = args.d_model, args.d_ff
+    hdim = d_model // num_heads
+    X = torch.randn(batch_size, seq_len, d_model)
+    lens = torch.full((batch_size,), seq_len, dtype=torch.long)
+    mask = AttnMask(key_lens=lens)
+
+    if component == "mha":
+        module = MultiHeadAttention(hdim, hdim, d_model, num_heads, fused="qkv" if args.fused_qkv else None).eval()
+        return (lambda: module(X, X, X, mask)), batch_size * seq_len
+    if component == "ffn":
+        module = FFN_IMPLS[args.ffn_impl](d_model, d_ff).eval()
+        return (lambda: module(X)), batch_size * seq_len
+    if component == "encoder_layer":
+        module = EncoderLayer(
+            d_model, num_heads, d_ff, 0., 0., args.fused_qkv, args.ffn_impl, args.attn_window, args.num_global,
+        ).eval()
+        return (lambda: module(X, mask)), batch_size * seq_len
+    if component == "decoder_layer":
+        module = DecoderLayer(
+            d_model, num_heads, d_ff, 0., 0., args.fused_qkv, args.ffn_impl, args.num_kv_heads,
+        ).eval()
+        labels = torch.randn(batch_size, args.label_len, d_model)
+        dec_mask = AttnMask(is_causal=True)
+        return (lambda: module(labels, X, dec_mask, mask)), batch_size * args.label_len
+
+    model = build_model(args, num_heads).eval()
+    feats = torch.randn(batch_size, seq_len, args.fbank_dim)
+    if component == "transformer":
+        labels = torch.randint(0, 26, (batch_size, args.label_len))
+        return (lambda: model(feats, lens, labels)), batch_size * (seq_len + args.label_len)
+    # eos_id=-1 永远不会生成，每次都解码固定的decode_len步
+    if component == "decode":
+        return (lambda: model.generate(feats, lens, sos_id=0, eos_id=-1, max_len=args.decode_len)), \
+            batch_size * args.decode_len
+    if component == "beam_search":
+        search = BeamSearch(model, sos_id=0, eos_id=-1, beam_size=args.beam_size, max_len=args.decode_len)
+        return (lambda: search(feats, lens)), batch_size * args.decode_len
+    raise ValueError(f"unknown component: {component}")
+
+@torch.no_grad()
+def run_suite(args):
+    results = []
+    cases = itertools.product(args.components, args.threads, args.batch_sizes, args.seq_lens, args.heads)
+    for component, threads, batch_size, seq_len, num_heads in cases:
+        torch.set_num_threads(threads)
+        torch.manual_seed(0)
+        fn, tokens = build_case(component, args, batch_size, seq_len, num_heads)
+        samples = time_samples(fn, args.warmup, args.iters)
+        latency = statistics.mean(samples)
+        result = {
+            "component": component, "threads": threads, "batch_size": batch_size,
+            "seq_len": seq_len, "num_heads": num_heads,
+            "latency_ms": latency * 1e3,
+            "latency_p50_ms": statistics.median(samples) * 1e3,
+            "latency_min_ms": min(samples) * 1e3,
+            "throughput_tokens_per_s": tokens / latency,
+            "peak_memory_mb": peak_memory(fn) / 2**20,
+        }
+        results.append(result)
+        print(
+            f"{component:>14s} threads={threads:<3d} b={batch_size:<4d} L={seq_len:<5d} h={num_heads:<3d} "
+            f"{result['latency_ms']:10.3f} ms {result['throughput_tokens_per_s']:12.1f} tok/s "
+            f"{result['peak_memory_mb']:9.2f} MB"
+        )
+    return results
+
+def case_key(result):
+    return tuple(result[k] for k in ("component", "threads", "batch_size", "seq_len", "num_heads"))
+
+def compare(results, baseline_path):
+    """
+    和之前保存的JSON结果逐项对比
+    """
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    print(f"\ncompared with {baseline_path}:")
+    for r in results:
+        base = baseline.get(case_key(r))
+        if base is None:
+            continue
+        print(
+            f"{r['component']:>14s} threads={r['threads']:<3d} b={r['batch_size']:<4d} L={r['seq_len']:<5d} "
+            f"h={r['num_heads']:<3d} speedup {base['latency_ms'] / r['latency_ms']:6.2f}x  "
+            f"memory {r['peak_memory_mb'] - base['peak_memory_mb']:+9.2f} MB"
+        )
+
+@torch.no_grad()
+def bench_ffn(batch_size, seq_len, d_model, d_ff, iters=20):
+    """
+    对比FFN_IMPLS中各个位置前馈网络实现的耗时，所有实现加载同一份Conv1d权重，并检查输出一致
+    """
+    X = torch.randn(batch_size, seq_len, d_model)
+    ref = FFN_IMPLS["conv"](d_model, d_ff).eval()
+    ref_out = ref(X)
+    results = {}
+    for impl, ffn_cls in FFN_IMPLS.items():
+        ffn = ffn_cls(d_model, d_ff).eval()
+        ffn.load_state_dict(ref.state_dict())
+        max_diff = (ffn(X) - ref_out).abs().max().item()
+        results[impl] = {"latency_ms": timeit(lambda: ffn(X), iters=iters) * 1e3, "max_diff": max_diff}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    suite = subparsers.add_parser("suite", help="sweep components over batch size, length, heads and threads")
+    suite.add_argument("--components", nargs="+", choices=COMPONENTS, default=COMPONENTS)
+    suite.add_argument("--batch-sizes", nargs="+", type=int, default=[1, 16])
+    suite.add_argument("--seq-lens", nargs="+", type=int, default=[100, 400])
+    suite.add_argument("--heads", nargs="+", type=int, default=[8])
+    suite.add_argument("--threads", nargs="+", type=int, default=[torch.get_num_threads()])
+    suite.add_argument("--d-model", type=int, default=512)
+    suite.add_argument("--d-ff", type=int, default=2048)
+    suite.add_argument("--num-layers", type=int, default=6)
+    suite.add_argument("--fbank-dim", type=int, default=80)
+    suite.add_argument("--label-len", type=int, default=32, help="label length of decoder_layer/transformer")
+    suite.add_argument("--decode-len", type=int, default=32, help="number of decoding steps")
+    suite.add_argument("--beam-size", type=int, default=4)
+    suite.add_argument("--attn-backend", choices=list(ATTN_BACKENDS), default="math")
+    suite.add_argument("--ffn-impl", choices=list(FFN_IMPLS), default="conv")
+    suite.add_argument("--fused-qkv", action="store_true")
+    suite.add_argument("--attn-window", type=int, default=None, help="local attention window of the encoder")
+    suite.add_argument("--num-global", type=int, default=0, help="global tokens of the local attention")
+    suite.add_argument("--num-kv-heads", type=int, default=None, help="K/V heads of the decoder attentions")
+    suite.add_argument("--pos-type", choices=list(POS_TYPES), default="sinusoid")
+    suite.add_argument("--warmup", type=int, default=2)
+    suite.add_argument("--iters", type=int, default=10)
+    suite.add_argument("--output", help="write results to this JSON file")
+    suite.add_argument("--compare", help="JSON file of a previous run to compare with")
+
+    ffn = subparsers.add_parser("ffn", help="compare the FFN implementations on shared weights")
+    ffn.add_argument("--batch-size", type=int, default=16)
+    ffn.add_argument("--seq-len", type=int, default=100)
+    ffn.add_argument("--d-model", type=int, default=512)
+    ffn.add_argument("--d-ff", type=int, default=2048)
+    ffn.add_argument("--iters", type=int, default=20)
+    ffn.add_argument("--threads", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "ffn":
+        if args.threads:
+            torch.set_num_threads(args.threads)
+        results = bench_ffn(args.batch_size, args.seq_len, args.d_model, args.d_ff, args.iters)
+        base = results["conv"]["latency_ms"]
+        for impl, r in results.items():
+            print(f"{impl:>14s}: {r['latency_ms']:8.3f} ms  speedup {base / r['latency_ms']:.2f}x  max_diff {r['max_diff']:.2e}")
+        return
+
+    set_attn_backend(args.attn_backend)
+    results = run_suite(args)
+    if args.output:
+        config = {k: v for k, v in vars(args).items() if k not in ("output", "compare")}
+        env = {"torch": torch.__version__, "python": platform.python_version(), "machine": platform.machine()}
+        with open(args.output, "w") as f:
+            json.dump({"config": config, "env": env, "results": results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
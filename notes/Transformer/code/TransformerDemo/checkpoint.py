@@ -0,0 +1,135 @@
+# 内存映射(mmap)的checkpoint保存和快速加载
+#
+# 用法:
+#   save_checkpoint(transformer, "transformer.pt")
+#   model = load_checkpoint("transformer.pt", build=lambda: Transformer(...))    # build只描述结构
+#
+# 加载时在meta设备上构造模型，并把nn.init里的初始化函数临时换成空操作(skip_init)：参数不分配内存、不生成随机数，
+# 也避免了第一次在meta张量上调用normal_等算子时导入分解规则的开销(约2秒)，位置编码表本来就是按需构造的；然后用torch.load(mmap=True)把权重直接映射到文件上，
+# load_state_dict(assign=True)让参数直接使用这些映射的张量，不复制。
+# 只读推理时权重页来自操作系统的page cache，同一台机器上加载同一个文件的多个进程共用一份物理内存，
+# 进程启动的耗时接近打开文件的耗时。
+import contextlib
+import time
+
+import torch
+import torch.nn as nn
+
+FORMAT_VERSION = 1
+
+_INIT_FUNCTIONS = [
+    "uniform_", "normal_", "trunc_normal_", "constant_", "ones_", "zeros_", "eye_", "dirac_",
+    "xavier_uniform_", "xavier_normal_", "kaiming_uniform_", "kaiming_normal_", "orthogonal_", "sparse_",
+]
+
+@contextlib.contextmanager
+def skip_init():
+    """
+    在with块内把nn.init.*_初始化函数替换成直接返回输入张量的空操作，用于构造马上要被checkpoint覆盖的模型
+    """
+    originals = {name: getattr(nn.init, name) for name in _INIT_FUNCTIONS if hasattr(nn.init, name)}
+    try:
+        for name in originals:
+            setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        yield
+    finally:
+        for name, fn in originals.items():
+            setattr(nn.init, name, fn)
+
+def save_checkpoint(model: nn.Module, path):
+    """
+    保存model的state_dict(torch.save的zip格式，每个存储按页对齐，可以直接mmap)
+    """
+    state_dict = {key: tensor.detach().contiguous() for key, tensor in model.state_dict().items()}
+    torch.save({"format_version": FORMAT_VERSION, "torch": str(torch.__version__), "state_dict": state_dict}, path)
+
+def load_weights(path, mmap=True):
+    """
+    读取save_checkpoint保存的state_dict(也可以是直接保存的state_dict)，mmap=True时张量直接映射到文件上
+    """
+    checkpoint = torch.load(path, map_location="cpu", mmap=mmap, weights_only=True)
+    return checkpoint.get("state_dict", checkpoint)
+
+def load_checkpoint(path, build, device=None, mmap=True, strict=True):
+    """
+    在meta设备上构造模型并加载path中的权重
+    Args:
+        path: file written by save_checkpoint (a plain state_dict file also works).
+        build: zero-argument callable returning the model, e.g. lambda: Transformer(frontend, encoder, decoder, ...).
+            it runs on the meta device, so it must not read parameter values.
+        device: move the model to this device after loading, None keeps the memory-mapped CPU weights (no copy).
+        mmap: map the file instead of reading it into memory.
+        strict: passed to load_state_dict; with strict=False every parameter still has to be in the checkpoint.
+    Returns:
+        the model in eval mode. parameters keep the checkpoint dtype (e.g. bf16 checkpoints stay bf16).
+    """
+    state_dict = load_weights(path, mmap)
+    with torch.device("meta"), skip_init():
+        model = build()
+    # 融合投影、分组K/V等的转换仍然在_load_from_state_dict里完成，这些参数会重新分配内存
+    model.load_state_dict(state_dict, strict=strict, assign=True)
+    missing = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    if missing:
+        raise RuntimeError(f"parameters not found in {path}: {missing}")
+    if device is not None:
+        model.to(device)
+    return model.eval()
+
+def eager_load(path, build, device=None):
+    """
+    对照用的常规加载方式：正常构造(随机初始化)后把整个文件读进内存再复制到参数里
+    """
+    model = build()
+    checkpoint = torch.load(path, map_location="cpu", weights_only=True)
+    model.load_state_dict(checkpoint.get("state_dict", checkpoint))
+    if device is not None:
+        model.to(device)
+    return model.eval()
+
+if __name__ == "__main__":
+    import multiprocessing
+    import os
+    import tempfile
+
+    from TransformerDemo import demo_batch, demo_model
+    from inference_pool import private_memory_mb, weight_mb
+
+    fbank_feature, feat_lens, labels, _ = demo_batch()
+    transformer = demo_model().eval()
+    with torch.no_grad():
+        ref = transformer(fbank_feature, feat_lens, labels)
+
+    def child(path, conn):
+        # 新进程加载同一个文件、做一次前向计算，报告加载耗时和独占内存
+        start = time.perf_counter()
+        model = load_checkpoint(path, demo_model)
+        load_time = time.perf_counter() - start
+        with torch.no_grad():
+            model(fbank_feature[:2], feat_lens[:2], labels[:2])
+        conn.send((load_time, private_memory_mb()))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "transformer.pt")
+        save_checkpoint(transformer, path)
+        print(f"checkpoint: {os.path.getsize(path) / 2**20:.1f} MB, weights {weight_mb(transformer):.1f} MB")
+
+        start = time.perf_counter()
+        eager = eager_load(path, demo_model)
+        eager_time = time.perf_counter() - start
+        start = time.perf_counter()
+        model = load_checkpoint(path, demo_model)
+        mmap_time = time.perf_counter() - start
+        print(f"eager build + load: {eager_time * 1e3:.1f} ms, meta build + mmap load: {mmap_time * 1e3:.1f} ms")
+
+        with torch.no_grad():
+            diff = max((m(fbank_feature, feat_lens, labels) - ref).abs().max().item() for m in (eager, model))
+        print(f"logits max diff: {diff:.2e}")
+
+        ctx = multiprocessing.get_context("fork")
+        for i in range(2):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=child, args=(path, child_conn))
+            process.start()
+            load_time, private_mb = parent_conn.recv()
+            process.join()
+            print(f"process {i}: load {load_time * 1e3:.1f} ms, private memory {private_mb:.1f} MB")
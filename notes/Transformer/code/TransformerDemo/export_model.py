@@ -0,0 +1,314 @@
+# Transformer推理图的导出(AOTInductor编译)和加载
+#
+# 用法:
+#   export_transformer(transformer, "transformer_export")     # 导出成一个目录
+#   model = ExportedTransformer("transformer_export")         # 服务进程只加载这个目录，不需要重建Encoder/Decoder
+#   logits = model(X, X_lens, labels)
+#   tokens, lengths = model.generate(X, X_lens, sos_id=0, eos_id=1, max_len=50)
+#
+# 用torch.export导出三个图，batch、特征长度、label长度和已解码长度都是动态维度：
+#   forward: Transformer.forward
+#   start:   encode + 每层交叉注意力的K/V投影 + 解码第一步
+#   step:    解码一步，历史K/V作为图的输入，返回追加新token后的K/V
+# 每个图再用AOTInductor提前编译成共享库，打包成.pt2(导出时需要C++编译器，几个图要编译几分钟)。
+# 加载时只是打开共享库，不需要反序列化图、解析符号形状，也不需要模型的Python代码；
+# 运行时直接调用编译好的算子，没有Python层面的模块调用和掩码构造，逐token解码的单步开销比eager小。
+#
+# 三个图共用同一份权重：权重只在weights.pt里保存一次(checkpoint.save_checkpoint的格式)，.pt2的共享库里不含权重，
+# 加载时把mmap映射的权重直接交给各个图(user_managed，不复制)；位置编码表单独保存在pos_tables.pt。
+# 每个图在第一次用到时才加载。
+import json
+import os
+
+import torch
+import torch.nn as nn
+from torch.export import Dim
+
+from TransformerDemo import AttnMask, EncoderMemory, Transformer, _pos_tables, greedy_decode
+from checkpoint import load_weights, save_checkpoint
+
+PROGRAMS = ("forward", "start", "step")
+WEIGHTS_FILE = "weights.pt"
+TABLES_FILE = "pos_tables.pt"
+
+class _TensorLayerCache:
+    """
+    导出用的单层KV缓存：历史K/V是图的输入，追加时用torch.cat，没有预分配的缓冲区
+    """
+    def __init__(self, k=None, v=None):
+        self.k = k
+        self.v = v
+
+    def append(self, k, v):
+        if self.k is not None:
+            k, v = torch.cat([self.k, k], 2), torch.cat([self.v, v], 2)
+        self.k, self.v = k, v
+        return k, v
+
+class _TensorKVCache:
+    """
+    和KVCache接口相同(cache[i]、seq_len)，供Decoder.forward在导出时使用
+    """
+    def __init__(self, num_layers, past_k=None, past_v=None):
+        if past_k is None:
+            self.layers = [_TensorLayerCache() for _ in range(num_layers)]
+            self.seq_len = 0
+        else:
+            self.layers = [_TensorLayerCache(k, v) for k, v in zip(past_k, past_v)]
+            self.seq_len = past_k[0].size(2)
+
+    def __getitem__(self, idx):
+        return self.layers[idx]
+
+    def __len__(self):
+        return len(self.layers)
+
+    def kv(self):
+        return [layer.k for layer in self.layers], [layer.v for layer in self.layers]
+
+class _Program(nn.Module):
+    """
+    三个图的公共基类：参数名都以"model."开头，加载时可以按名字共享权重；
+    共享的位置编码表注册成缓冲区pos_table_{i}，导出后是图的输入，不会作为常量编进共享库
+    """
+    def __init__(self, model: Transformer):
+        super(_Program, self).__init__()
+        self.model = model
+        self.table_keys = list(_pos_tables)
+        for i, key in enumerate(self.table_keys):
+            self.register_buffer(f"pos_table_{i}", _pos_tables[key], persistent=False)
+
+    def use_tables(self):
+        # 导出时缓冲区被换成追踪用的张量，而模型从_pos_tables里读表，要把表换成这些缓冲区
+        for i, key in enumerate(self.table_keys):
+            _pos_tables[key] = getattr(self, f"pos_table_{i}")
+
+class _Forward(_Program):
+    def forward(self, X, X_lens, labels):
+        self.use_tables()
+        return self.model(X, X_lens, labels)
+
+class _Start(_Program):
+    def forward(self, X, X_lens, tokens):
+        self.use_tables()
+        enc_out = self.model.encode(X, X_lens)
+        memory = self.model.decoder.build_memory(enc_out)
+        cache = _TensorKVCache(len(self.model.decoder.layers))
+        dec_out = self.model.decoder(tokens, memory, None, AttnMask(key_lens=X_lens), cache)
+        past_k, past_v = cache.kv()
+        # 第一步的K/V是融合投影结果的切片视图，step图按连续的历史K/V编译(和之后每步torch.cat的结果一样)，
+        # 编译好的图不检查输入的stride，这里复制成连续的(只有一个token)
+        past_k, past_v = [k.contiguous() for k in past_k], [v.contiguous() for v in past_v]
+        mem_k, mem_v = [k for k, _ in memory.kv], [v for _, v in memory.kv]
+        return self.model.linear(dec_out[:, -1]), mem_k, mem_v, past_k, past_v
+
+class _Step(_Program):
+    def forward(self, tokens, X_lens, mem_k, mem_v, past_k, past_v):
+        self.use_tables()
+        # 交叉注意力只用预先投影好的K/V，不需要enc_out本身
+        memory = EncoderMemory(None, list(zip(mem_k, mem_v)))
+        cache = _TensorKVCache(len(self.model.decoder.layers), past_k, past_v)
+        dec_out = self.model.decoder(tokens, memory, None, AttnMask(key_lens=X_lens), cache)
+        past_k, past_v = cache.kv()
+        return self.model.linear(dec_out[:, -1]), past_k, past_v
+
+@torch.no_grad()
+def export_transformer(model: Transformer, path, max_feat_len=None, max_label_len=None, fbank_dim=None):
+    """
+    导出model的推理图并用AOTInductor编译，写到path目录(每个图一个不含权重的.pt2包、weights.pt、pos_tables.pt和config.json)
+    注意力后端需要是math或sdpa(chunked按长度循环分块，不能导出成动态长度的图)
+    Args:
+        model: Transformer with an element-wise frontend.
+        path: output directory.
+        max_feat_len: upper bound of the feature length axis, defaults to encoder.tgt_len.
+        max_label_len: upper bound of the label/decoding length axis, defaults to decoder.tgt_len.
+        fbank_dim: input feature dimension, read from the frontend when it is an nn.Linear.
+    Returns:
+        {name: ExportedProgram} of the exported graphs before compilation.
+    """
+    model.eval()
+    max_feat_len = max_feat_len or model.encoder.tgt_len
+    max_label_len = max_label_len or model.decoder.tgt_len
+    fbank_dim = fbank_dim or model.frontend.in_features
+    num_layers = len(model.decoder.layers)
+    # 位置编码表提前扩容到最大长度，图里只剩切片，不会在导出的长度范围内触发扩容
+    device = next(model.parameters()).device
+    model.encoder.pos_emb.table(max_feat_len, device=device)
+    model.decoder.pos_emb.table(max_label_len, device=device)
+
+    batch = Dim("batch", min=1, max=1024)
+    feat_len = Dim("feat_len", min=2, max=max_feat_len)
+    label_len = Dim("label_len", min=2, max=max_label_len)
+    past_len = Dim("past_len", min=1, max=max_label_len - 1)
+    # 示例输入的各个动态维度取不同的值，避免被误认为相等而合并
+    X = torch.randn(3, 7, fbank_dim, device=device)
+    X_lens = torch.tensor([7, 5, 4], device=device)
+    labels = torch.zeros(3, 6, dtype=torch.long, device=device)
+    tokens = torch.zeros(3, 1, dtype=torch.long, device=device)
+    _, mem_k, mem_v, past_k, past_v = _Start(model)(X, X_lens, tokens)
+    # 示例的历史长度也不能是1，否则会被特化成常数
+    past_k, past_v = [k.repeat(1, 1, 3, 1) for k in past_k], [v.repeat(1, 1, 3, 1) for v in past_v]
+    memory_shape = [{0: batch, 2: feat_len}] * num_layers
+    past_shape = [{0: batch, 2: past_len}] * num_layers
+
+    wrappers = {name: cls(model) for name, cls in zip(PROGRAMS, (_Forward, _Start, _Step))}
+    tables = dict(_pos_tables)
+    try:
+        programs = {
+            "forward": torch.export.export(
+                wrappers["forward"], (X, X_lens, labels),
+                dynamic_shapes=({0: batch, 1: feat_len}, {0: batch}, {0: batch, 1: label_len}),
+            ),
+            "start": torch.export.export(
+                wrappers["start"], (X, X_lens, tokens),
+                dynamic_shapes=({0: batch, 1: feat_len}, {0: batch}, {0: batch}),
+            ),
+            "step": torch.export.export(
+                wrappers["step"], (tokens, X_lens, mem_k, mem_v, past_k, past_v),
+                dynamic_shapes=({0: batch}, {0: batch}, memory_shape, memory_shape, past_shape, past_shape),
+            ),
+        }
+    finally:
+        # use_tables()在追踪时把追踪用的张量放进了_pos_tables，恢复成原来的表
+        _pos_tables.clear()
+        _pos_tables.update(tables)
+
+    os.makedirs(path, exist_ok=True)
+    save_checkpoint(model, os.path.join(path, WEIGHTS_FILE))
+    wrapper = wrappers["forward"]
+    torch.save(
+        {f"pos_table_{i}": getattr(wrapper, f"pos_table_{i}").contiguous() for i in range(len(wrapper.table_keys))},
+        os.path.join(path, TABLES_FILE),
+    )
+    for name, program in programs.items():
+        # 权重不编进共享库，加载时由ExportedTransformer提供
+        torch._inductor.aoti_compile_and_package(
+            program, package_path=os.path.join(path, f"{name}.pt2"),
+            inductor_configs={"aot_inductor.package_constants_in_so": False},
+        )
+    config = {
+        "num_layers": num_layers, "fbank_dim": fbank_dim,
+        "max_feat_len": max_feat_len, "max_label_len": max_label_len, "torch": torch.__version__,
+    }
+    with open(os.path.join(path, "config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+    return programs
+
+class ExportedTransformer:
+    """
+    从export_transformer()导出的目录加载推理模型，接口和Transformer的forward/generate相同
+    权重从weights.pt映射一次，三个图共用；图在第一次调用时才加载，只做打分的进程不会加载解码用的图
+    """
+    def __init__(self, path):
+        """
+        Args:
+            path: directory written by export_transformer.
+        """
+        with open(os.path.join(path, "config.json")) as f:
+            self.config = json.load(f)
+        self.path = path
+        # 图里的参数名都以"model."开头，位置编码表是pos_table_{i}(见_Program)
+        self.weights = {f"model.{key}": tensor for key, tensor in load_weights(os.path.join(path, WEIGHTS_FILE)).items()}
+        self.weights.update(torch.load(os.path.join(path, TABLES_FILE), map_location="cpu", mmap=True, weights_only=True))
+        self.programs = {}
+
+    def program(self, name):
+        """
+        返回加载好的图(forward/start/step)，第一次调用时加载共享库并绑定权重
+        """
+        if name not in self.programs:
+            program = torch._inductor.aoti_load_package(os.path.join(self.path, f"{name}.pt2"))
+            # user_managed=True：图直接使用这些张量的内存，不复制；self.weights要一直持有它们
+            program.load_constants(
+                {key: self.weights[key] for key in program.get_constant_fqns()},
+                check_full_update=True, user_managed=True,
+            )
+            self.programs[name] = program
+        return self.programs[name]
+
+    @torch.no_grad()
+    def __call__(self, X, X_lens, labels):
+        # 编译好的图按连续的输入生成代码，不检查stride
+        return self.program("forward")(X.contiguous(), X_lens.long().contiguous(), labels.long().contiguous())
+
+    @torch.no_grad()
+    def generate(self, X, X_lens, sos_id, eos_id, max_len=200):
+        """
+        贪心解码，结果和Transformer.generate相同
+        Returns:
+            tokens: (b, T) generated ids without sos, positions after eos are filled with eos_id.
+            lengths: (b,) number of tokens before eos.
+        """
+        assert max_len <= self.config["max_label_len"]
+        X, X_lens = X.contiguous(), X_lens.long().contiguous()
+        state = {}
+
+        def step(tokens):
+            # 第一步由start图完成编码和交叉注意力K/V的投影，之后每步只运行step图
+            if not state:
+                logits, state["mem_k"], state["mem_v"], state["past_k"], state["past_v"] = \
+                    self.program("start")(X, X_lens, tokens)
+            else:
+                logits, state["past_k"], state["past_v"] = self.program("step")(
+                    tokens, X_lens, state["mem_k"], state["mem_v"], state["past_k"], state["past_v"]
+                )
+            return logits
+
+        tokens = torch.full((X.size(0), 1), sos_id, dtype=torch.long, device=X.device)
+        return greedy_decode(step, tokens, eos_id, max_len)
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    from TransformerDemo import demo_batch, demo_model
+    from checkpoint import load_checkpoint
+    from metrics import latency_ms
+
+    fbank_feature, feat_lens, labels, _ = demo_batch()
+    batch_size = fbank_feature.size(0)
+    transformer = demo_model().eval()
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        export_transformer(transformer, path)
+        print(f"export + compile: {time.perf_counter() - start:.1f} s")
+        sizes = {name: os.path.getsize(os.path.join(path, name)) / 2**20 for name in sorted(os.listdir(path))}
+        print("files: " + ", ".join(f"{name} {size:.1f} MB" for name, size in sizes.items()))
+
+        # 启动耗时：加载编译好的图 vs 在meta设备上构造Transformer再mmap加载同一份weights.pt
+        start = time.perf_counter()
+        exported = ExportedTransformer(path)
+        weights_time = time.perf_counter() - start
+        load_times = {}
+        for name in PROGRAMS:
+            start = time.perf_counter()
+            exported.program(name)
+            load_times[name] = time.perf_counter() - start
+        print(
+            f"exported load: weights {weights_time * 1e3:.1f} ms, "
+            + ", ".join(f"{name} {t * 1e3:.1f} ms" for name, t in load_times.items())
+        )
+        start = time.perf_counter()
+        eager = load_checkpoint(os.path.join(path, WEIGHTS_FILE), demo_model)
+        print(f"meta build + mmap checkpoint: {(time.perf_counter() - start) * 1e3:.1f} ms")
+
+        with torch.no_grad():
+            ref = transformer(fbank_feature, feat_lens, labels)
+            diff = (exported(fbank_feature, feat_lens, labels) - ref).abs().max()
+            tokens, _ = exported.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=20)
+            ref_tokens, _ = transformer.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=20)
+            print(f"logits max diff: {diff.item():.2e}, greedy tokens equal: {torch.equal(tokens, ref_tokens)}")
+
+            # 每次调用的耗时：forward和逐token解码(eos_id=-1，固定解码20步)
+            for name, batch in [("forward", batch_size), ("forward", 1), ("generate", batch_size), ("generate", 1)]:
+                args = (fbank_feature[:batch], feat_lens[:batch])
+                if name == "forward":
+                    calls = [lambda m=m: m(*args, labels[:batch]) for m in (eager, exported)]
+                else:
+                    calls = [lambda m=m: m.generate(*args, sos_id=0, eos_id=-1, max_len=20) for m in (eager, exported)]
+                eager_ms, exported_ms = (latency_ms(call) for call in calls)
+                print(
+                    f"{name} b={batch}: eager {eager_ms:.1f} ms, exported {exported_ms:.1f} ms "
+                    f"({eager_ms / exported_ms:.2f}x)"
+                )
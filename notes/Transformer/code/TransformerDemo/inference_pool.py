@@ -0,0 +1,225 @@
+# 多进程CPU推理池
+#
+# 用法:
+#   with InferencePool(transformer, num_workers=4, threads_per_worker=8) as pool:
+#       logits = pool.forward(X, X_lens, labels)                            # batch按行切分给各个worker
+#       tokens, lengths = pool.generate(X, X_lens, sos_id=0, eos_id=1, max_len=50)
+#       print(pool.metrics())
+#
+# 单个进程里batch较小时intra-op多线程加速有限，Python层的请求处理也受GIL限制；
+# 这里把模型权重放进共享内存，启动num_workers个进程，每个进程固定自己的线程数(并绑定到各自的CPU核)，
+# 各自处理一部分batch。所有worker映射同一份权重，多一个worker不会多一份权重内存。
+import os
+import queue
+import statistics
+import time
+import traceback
+
+import torch
+import torch.multiprocessing as mp
+import torch.nn as nn
+import torch.nn.functional as F
+
+from TransformerDemo import Transformer
+
+def private_memory_mb(pid=None):
+    """
+    进程独占的内存(Private_Clean + Private_Dirty，单位MB)，共享内存里的权重不计入；只支持Linux
+    """
+    path = f"/proc/{pid or os.getpid()}/smaps_rollup"
+    if not os.path.exists(path):
+        return float("nan")
+    total = 0
+    with open(path) as f:
+        for line in f:
+            if line.startswith(("Private_Clean:", "Private_Dirty:")):
+                total += int(line.split()[1])
+    return total / 1024
+
+def weight_mb(model: nn.Module):
+    return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers())) / 2**20
+
+def _worker(worker_id, model, threads, cores, tasks, results):
+    torch.set_num_threads(threads)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    model.eval()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, method, args, kwargs = task
+        start = time.perf_counter()
+        try:
+            with torch.no_grad():
+                output = getattr(model, method)(*args, **kwargs)
+        except Exception:
+            output = RuntimeError(f"worker {worker_id} failed:\n{traceback.format_exc()}")
+        results.put((task_id, worker_id, output, time.perf_counter() - start, private_memory_mb()))
+
+class InferencePool:
+    """
+    共享权重的多进程推理池，每次调用把batch切成若干份，由空闲的worker取走计算，结果按原顺序拼接
+    """
+    def __init__(self, model: Transformer, num_workers=None, threads_per_worker=1, pin_cores=True, start_method="fork"):
+        """
+        Args:
+            model: CPU Transformer, its parameters and buffers are moved to shared memory.
+            num_workers: number of processes, defaults to cpu_count // threads_per_worker.
+            threads_per_worker: intra-op threads of every worker.
+            pin_cores: bind worker i to cores [i*threads_per_worker, (i+1)*threads_per_worker).
+            start_method: "fork" inherits the model directly; use "forkserver"/"spawn" when the parent already
+                ran multithreaded OpenMP work, the shared weights are then passed as file descriptors, still one copy,
+                but every worker imports torch again (a few hundred MB of private memory each).
+        """
+        cpu_count = os.cpu_count() or 1
+        self.num_workers = num_workers or max(cpu_count // threads_per_worker, 1)
+        self.threads_per_worker = threads_per_worker
+        model.eval().share_memory()
+        ctx = mp.get_context(start_method)
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = []
+        for i in range(self.num_workers):
+            cores = None
+            if pin_cores and (i + 1) * threads_per_worker <= cpu_count:
+                cores = set(range(i * threads_per_worker, (i + 1) * threads_per_worker))
+            worker = ctx.Process(
+                target=_worker, args=(i, model, threads_per_worker, cores, self.tasks, self.results), daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        self._next_task = 0
+        self._stats = [{"tasks": 0, "rows": 0, "busy": 0., "latencies": [], "private_mb": 0.} for _ in self.workers]
+        self._wall = 0.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def _run(self, method, batch_args, kwargs, num_shards=None):
+        """
+        把batch_args(batch维在第0维)按行切成num_shards份分给worker，返回按原顺序排列的各份结果
+        """
+        assert all(arg.size(0) == batch_args[0].size(0) for arg in batch_args), "batch sizes differ"
+        num_shards = min(num_shards or self.num_workers, batch_args[0].size(0))
+        shards = list(zip(*[arg.tensor_split(num_shards) for arg in batch_args]))
+        task_ids = []
+        start = time.perf_counter()
+        for shard in shards:
+            task_ids.append(self._next_task)
+            self.tasks.put((self._next_task, method, shard, kwargs))
+            self._next_task += 1
+        # 某一份出错时也要等这次调用的所有份都返回，不把旧结果留在results里给下一次调用
+        outputs, error = {}, None
+        while len(outputs) < len(task_ids):
+            try:
+                task_id, worker_id, output, latency, private_mb = self.results.get(timeout=1.)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("an inference worker exited unexpectedly")
+                continue
+            if task_id not in task_ids:
+                # 之前的调用因worker退出中断后遗留的结果
+                continue
+            outputs[task_id] = output
+            if isinstance(output, Exception):
+                error = error or output
+                continue
+            stats = self._stats[worker_id]
+            stats["tasks"] += 1
+            stats["rows"] += shards[task_ids.index(task_id)][0].size(0)
+            stats["busy"] += latency
+            stats["latencies"].append(latency)
+            stats["private_mb"] = private_mb
+        self._wall += time.perf_counter() - start
+        if error is not None:
+            raise error
+        return [outputs[task_id] for task_id in task_ids]
+
+    def forward(self, X, X_lens, labels, num_shards=None):
+        return torch.cat(self._run("forward", (X, X_lens, labels), {}, num_shards), dim=0)
+
+    def encode(self, X, X_lens, num_shards=None):
+        # 各份的特征长度都是X.size(1)，直接拼接
+        return torch.cat(self._run("encode", (X, X_lens), {}, num_shards), dim=0)
+
+    def generate(self, X, X_lens, sos_id, eos_id, max_len=200, num_shards=None):
+        """
+        和Transformer.generate相同，各份解码的长度不同，tokens用eos_id补齐到最长的一份
+        """
+        outputs = self._run("generate", (X, X_lens), {"sos_id": sos_id, "eos_id": eos_id, "max_len": max_len}, num_shards)
+        T = max(tokens.size(1) for tokens, _ in outputs)
+        tokens = torch.cat([F.pad(tokens, (0, T - tokens.size(1)), value=eos_id) for tokens, _ in outputs], dim=0)
+        return tokens, torch.cat([lengths for _, lengths in outputs], dim=0)
+
+    def metrics(self):
+        """
+        每个worker的任务数、处理的行数、平均/中位延迟、忙碌时的吞吐(行/秒)、利用率和独占内存，
+        以及整个池按墙钟时间计算的吞吐
+        """
+        workers = []
+        for i, stats in enumerate(self._stats):
+            latencies = stats["latencies"] or [0.]
+            workers.append({
+                "worker": i,
+                "tasks": stats["tasks"],
+                "rows": stats["rows"],
+                "latency_mean_ms": statistics.mean(latencies) * 1e3,
+                "latency_p50_ms": statistics.median(latencies) * 1e3,
+                "rows_per_s": stats["rows"] / stats["busy"] if stats["busy"] > 0 else 0.,
+                "utilization": stats["busy"] / self._wall if self._wall > 0 else 0.,
+                "private_mb": stats["private_mb"],
+            })
+        rows = sum(stats["rows"] for stats in self._stats)
+        return {"rows_per_s": rows / self._wall if self._wall > 0 else 0., "workers": workers}
+
+if __name__ == "__main__":
+    from TransformerDemo import DEMO_VOCAB_SIZE, demo_batch, demo_model
+
+    num_workers = 2
+    fbank_feature, feat_lens, labels, _ = demo_batch()
+    transformer = demo_model().eval()
+
+    threads = max((os.cpu_count() or 1) // num_workers, 1)
+    with InferencePool(transformer, num_workers=num_workers, threads_per_worker=threads) as pool:
+        start = time.perf_counter()
+        logits = pool.forward(fbank_feature, feat_lens, labels)
+        print(f"pool forward: {time.perf_counter() - start:.2f} s")
+        with torch.no_grad():
+            torch.set_num_threads(threads * num_workers)
+            start = time.perf_counter()
+            ref = transformer(fbank_feature, feat_lens, labels)
+            print(f"single process forward: {time.perf_counter() - start:.2f} s")
+        tokens, _ = pool.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=20)
+        ref_tokens, _ = transformer.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=20)
+        print(f"logits max diff: {(logits - ref).abs().max().item():.2e}, tokens equal: {torch.equal(tokens, ref_tokens)}")
+
+        # 一份出错(词表外的label)时整个调用报错，之后的调用不受影响
+        bad_labels = labels.clone()
+        bad_labels[0, 0] = DEMO_VOCAB_SIZE
+        try:
+            pool.forward(fbank_feature, feat_lens, bad_labels)
+        except RuntimeError as e:
+            print(f"bad request raised: {str(e).splitlines()[0]}")
+        logits = pool.forward(fbank_feature, feat_lens, labels)
+        print(f"after error, logits max diff: {(logits - ref).abs().max().item():.2e}")
+
+        metrics = pool.metrics()
+        print(f"weights: {weight_mb(transformer):.1f} MB (shared), pool throughput: {metrics['rows_per_s']:.1f} rows/s")
+        for worker in metrics["workers"]:
+            print(
+                f"worker {worker['worker']}: {worker['tasks']} tasks, {worker['rows']} rows, "
+                f"mean {worker['latency_mean_ms']:.1f} ms, p50 {worker['latency_p50_ms']:.1f} ms, "
+                f"{worker['rows_per_s']:.1f} rows/s, utilization {worker['utilization']:.2f}, "
+                f"private {worker['private_mb']:.1f} MB"
+            )
@@ -0,0 +1,83 @@
+# 性能测试和精度对比共用的测量函数：计时、内存峰值、logits误差和解码结果一致率
+#
+# benchmark.py(命令行工具)和quantization、mixed_precision、activation_checkpoint、export_model等模块都从这里导入
+import statistics
+import time
+
+import torch
+import torch.nn.functional as F
+from torch.profiler import ProfilerActivity, profile
+
+from TransformerDemo import get_key_padding_mask
+
+def timeit(fn, warmup=3, iters=20):
+    """
+    返回fn每次调用的平均耗时(秒)
+    """
+    return statistics.mean(time_samples(fn, warmup, iters))
+
+def time_samples(fn, warmup=3, iters=20):
+    """
+    返回fn每次调用的耗时列表(秒)
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def peak_memory(fn):
+    """
+    fn执行期间新分配张量的峰值字节数(不含调用前已经存在的权重和输入)
+    CUDA上用max_memory_allocated，CPU上按profiler记录的内存分配/释放事件累加
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        base = torch.cuda.memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+        fn()
+        torch.cuda.synchronize()
+        return torch.cuda.max_memory_allocated() - base
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        # 算子内部的分配记在self_cpu_memory_usage上，算子之外的释放记在"[memory]"事件上
+        current += event.cpu_memory_usage if event.name == "[memory]" else event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak
+
+def logits_drift(ref, out):
+    """
+    两组logits之间的误差：最大/平均绝对误差、相对误差、余弦相似度和top-1一致率
+    Args:
+        ref: (..., vocab) reference logits.
+        out: (..., vocab) logits to compare, same shape as ref.
+    """
+    ref, out = ref.float().flatten(0, -2), out.float().flatten(0, -2)
+    diff = out - ref
+    return {
+        "logits_max_abs_diff": diff.abs().max().item(),
+        "logits_mean_abs_diff": diff.abs().mean().item(),
+        "logits_rel_error": (diff.norm() / ref.norm()).item(),
+        "logits_cosine": torch.cosine_similarity(ref, out, dim=-1).mean().item(),
+        "top1_agreement": (ref.argmax(-1) == out.argmax(-1)).float().mean().item(),
+    }
+
+def token_agreement(ref_tokens, ref_lens, tokens, eos_id, max_len):
+    """
+    两次generate()结果的token一致率，补齐到max_len后在参考结果的有效位置(包括eos)上比较
+    """
+    ref_tokens = F.pad(ref_tokens, (0, max_len - ref_tokens.size(1)), value=eos_id)
+    tokens = F.pad(tokens, (0, max_len - tokens.size(1)), value=eos_id)
+    valid = ~get_key_padding_mask(max_len, (ref_lens + 1).clamp(max=max_len), ref_tokens.device)
+    return (tokens == ref_tokens)[valid].float().mean().item()
+
+def latency_ms(fn, iters=3):
+    """
+    预热一次后fn的平均耗时(毫秒)
+    """
+    return timeit(fn, warmup=1, iters=iters) * 1e3
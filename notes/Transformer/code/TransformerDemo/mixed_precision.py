@@ -0,0 +1,108 @@
+# Transformer的bfloat16混合精度推理/训练
+#
+# 用法:
+#   with bf16_autocast(X.device.type):
+#       logits = transformer(X, X_lens, labels)
+#
+# 权重保持fp32，autocast下nn.Linear和注意力里的matmul用bf16计算，激活(包括KVCache和EncoderMemory)
+# 都是bf16，内存带宽减半；softmax和LayerNorm在fp32中计算，掩码按分数的dtype填充最小值，不会溢出。
+# bf16和fp32的指数范围相同，训练时不需要GradScaler。
+#
+# autocast每次进入时都要把fp32权重转换成bf16副本；只做推理时用to_bf16()把权重本身转换成bf16，
+# 权重内存和带宽也减半，输入特征传bf16即可。
+import copy
+
+import torch
+import torch.nn as nn
+
+from TransformerDemo import Transformer, get_key_padding_mask
+from metrics import latency_ms, logits_drift, peak_memory, token_agreement
+
+def bf16_supported(device_type="cpu"):
+    """
+    当前设备是否有原生的bf16矩阵乘(CPU上需要AVX512-BF16/AMX，否则退化成转换后的fp32计算)
+    """
+    if device_type == "cuda":
+        return torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+def bf16_autocast(device_type="cpu", enabled=True):
+    """
+    返回bf16的autocast上下文，训练和推理(包括generate/BeamSearch)都可以用
+    Args:
+        device_type: "cpu" or "cuda".
+        enabled: False runs the model in fp32, convenient for switching with a flag.
+    """
+    return torch.autocast(device_type, dtype=torch.bfloat16, enabled=enabled)
+
+def to_bf16(model: Transformer, inplace=False) -> Transformer:
+    """
+    返回权重转换成bf16的推理模型(eval模式)，LayerNorm和softmax仍在fp32中计算
+    Args:
+        model: fp32 Transformer.
+        inplace: convert model itself instead of a copy.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    return model.eval().to(torch.bfloat16)
+
+@torch.no_grad()
+def drift_report(model: Transformer, X, X_lens, labels, sos_id=0, eos_id=1, max_len=20, cast_weights=False):
+    """
+    同一个模型在bf16和fp32下的数值偏差：encoder输出和logits的误差、top-1一致率、
+    贪心解码的token一致率，以及前向耗时和前向过程中新分配内存的峰值
+    Args:
+        cast_weights: run the bf16 side with to_bf16(model) instead of autocast.
+    """
+    model.eval()
+    X_lens = X_lens.long()
+    bf16_model = to_bf16(model) if cast_weights else None
+
+    def run(bf16, fn_name, *args):
+        if bf16 and cast_weights:
+            return getattr(bf16_model, fn_name)(args[0].bfloat16(), *args[1:])
+        with bf16_autocast(X.device.type, bf16):
+            return getattr(model, fn_name)(*args)
+
+    enc_ref = run(False, "encode", X, X_lens)
+    enc_out = run(True, "encode", X, X_lens).float()
+    valid = ~get_key_padding_mask(X.size(1), X_lens, X.device).unsqueeze(-1)
+    enc_diff = (enc_out - enc_ref).masked_select(valid)
+    report = {"encoder_rel_error": (enc_diff.norm() / enc_ref.masked_select(valid).norm()).item()}
+    report.update(logits_drift(run(False, "forward", X, X_lens, labels), run(True, "forward", X, X_lens, labels)))
+
+    ref_tokens, ref_lens = run(False, "generate", X, X_lens, sos_id, eos_id, max_len)
+    tokens, _ = run(True, "generate", X, X_lens, sos_id, eos_id, max_len)
+    report["greedy_token_agreement"] = token_agreement(ref_tokens, ref_lens, tokens, eos_id, max_len)
+
+    fp32_ms = latency_ms(lambda: run(False, "forward", X, X_lens, labels))
+    bf16_ms = latency_ms(lambda: run(True, "forward", X, X_lens, labels))
+    report.update({
+        "fp32_forward_ms": fp32_ms,
+        "bf16_forward_ms": bf16_ms,
+        "speedup": fp32_ms / bf16_ms,
+        # autocast下包括转换后的bf16权重副本
+        "fp32_peak_memory_mb": peak_memory(lambda: run(False, "forward", X, X_lens, labels)) / 2**20,
+        "bf16_peak_memory_mb": peak_memory(lambda: run(True, "forward", X, X_lens, labels)) / 2**20,
+    })
+    return report
+
+if __name__ == "__main__":
+    from TransformerDemo import demo_batch, demo_model
+
+    fbank_feature, feat_lens, labels, _ = demo_batch()
+    transformer = demo_model()
+
+    # training step under autocast: fp32 weights and gradients, bf16 activations
+    transformer.train()
+    with bf16_autocast():
+        logits = transformer(fbank_feature, feat_lens, labels)
+    loss = nn.functional.cross_entropy(logits.float().flatten(0, 1), labels.flatten())
+    loss.backward()
+    print(f"bf16 supported: {bf16_supported()}, logits: {logits.dtype}, loss: {loss.item():.4f}")
+
+    for cast_weights in (False, True):
+        print(f"\n{'bf16 weights' if cast_weights else 'autocast'} vs fp32:")
+        report = drift_report(transformer, fbank_feature, feat_lens, labels, cast_weights=cast_weights)
+        for key, value in report.items():
+            print(f"{key:>24s}: {value:.4f}")
@@ -0,0 +1,397 @@
+# 分页KV缓存和连续批处理(continuous batching)解码
+#
+# 用法:
+#   scheduler = ContinuousBatchingScheduler(transformer, sos_id=0, eos_id=1, max_batch_size=32, num_blocks=512)
+#   ids = [scheduler.add_request(x, max_len=50) for x in features]     # x: (T, fbank_dim)，不需要填充
+#   outputs = scheduler.run()                                          # {request_id: 不含eos的token id}
+#
+# KV缓存按固定大小的块(block_size个token)从一个预分配的池里分配，每条序列有自己的块表，
+# 序列变长时只追加新块，结束后块立刻回收给其他序列；一条序列最多浪费block_size-1个位置，
+# 任何空闲块都能分给任何序列，没有外部碎片。
+# 每步解码前调度器先移除已经结束的请求、再加入等待中的请求，batch始终是满的，
+# 不需要把所有请求填充到最长的那个、也不需要等最慢的请求结束。
+from collections import OrderedDict, deque
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from TransformerDemo import AttnMask, EncoderMemory, Transformer
+
+class BlockManager:
+    """
+    KV缓存块的分配器：空闲块列表 + 每条序列的块表
+    """
+    def __init__(self, num_blocks, block_size):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.free_blocks = deque(range(num_blocks))
+        self.tables = {}        # seq_id -> [block id]
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    def blocks_needed(self, num_tokens):
+        return -(-num_tokens // self.block_size)
+
+    def ensure(self, seq_id, num_tokens):
+        """
+        保证seq_id的块能放下num_tokens个token，空闲块不够时不分配并返回False
+        """
+        table = self.tables.setdefault(seq_id, [])
+        extra = self.blocks_needed(num_tokens) - len(table)
+        if extra > self.num_free_blocks:
+            return False
+        for _ in range(extra):
+            table.append(self.free_blocks.popleft())
+        return True
+
+    def free(self, seq_id):
+        self.free_blocks.extend(self.tables.pop(seq_id, []))
+
+    def block_table(self, seq_ids, device=None):
+        """
+        返回(b, max_blocks)的块表，不足的位置用块0填充(对应的位置会被注意力掩码屏蔽)
+        """
+        tables = [self.tables[seq_id] for seq_id in seq_ids]
+        width = max(len(t) for t in tables)
+        return torch.tensor([t + [0] * (width - len(t)) for t in tables], dtype=torch.long, device=device)
+
+    def utilization(self, seq_lens):
+        """
+        已分配的块中实际存放token的比例，seq_lens: {seq_id: 已缓存的token数}
+        """
+        used = sum(len(t) for t in self.tables.values()) * self.block_size
+        return sum(seq_lens.values()) / used if used else 1.
+
+class PagedLayerKVCache:
+    """
+    PagedKVCache中单层的视图，接口和LayerKVCache相同(append、len、k_len)
+    """
+    def __init__(self, cache, layer):
+        self.cache = cache
+        self.layer = layer
+        self.len = 0
+
+    def append(self, k, v):
+        """
+        把新token的K/V写进各行的块里，返回按块表拼接的全部历史K/V [N, num_kv_heads, max_blocks*block_size, d]
+        超出各行长度的位置是其他序列或未使用的数据，由attn_mask的key_lens屏蔽
+        返回的是PagedKVCache共用缓冲区的视图，下一层append时会被覆盖，只能在这一层的注意力里使用
+        """
+        cache = self.cache
+        k_pool, v_pool = cache.k_pool[self.layer], cache.v_pool[self.layer]
+        block_size = cache.block_size
+        positions = cache.seq_lens.unsqueeze(1) + torch.arange(k.size(2), device=k.device)     # (N, new_len)
+        blocks = cache.block_table.gather(1, torch.div(positions, block_size, rounding_mode="floor"))
+        offsets = positions % block_size
+        # 两个高级索引相邻，结果维度留在原位: k_pool[:, blocks, offsets]的形状是(num_kv_heads, N, new_len, d_k)
+        k_pool[:, blocks, offsets] = k.transpose(0, 1).to(k_pool.dtype)
+        v_pool[:, blocks, offsets] = v.transpose(0, 1).to(v_pool.dtype)
+        N, num_blocks = cache.block_table.shape
+        # 池的布局是[num_kv_heads, num_blocks, block_size, d]，按块表取出的块在每个头内首尾相接，
+        # 一次index_select写进缓冲区就是[num_kv_heads, N, max_blocks*block_size, d]，再换成[N, num_kv_heads, ...]的视图
+        index = cache.block_table.reshape(-1)
+        k = torch.index_select(k_pool, 1, index, out=cache.gather_buffer("k", k_pool, index.numel()))
+        v = torch.index_select(v_pool, 1, index, out=cache.gather_buffer("v", v_pool, index.numel()))
+        k = k.view(k.size(0), N, num_blocks * block_size, -1).transpose(0, 1)
+        v = v.view(v.size(0), N, num_blocks * block_size, -1).transpose(0, 1)
+        self.len = k.size(2)
+        return k, v
+
+    @property
+    def k_len(self):
+        return self.len
+
+class PagedKVCache:
+    """
+    Decoder的分页KV缓存，接口和KVCache相同(cache[i]、seq_len)，可以直接传给Decoder.forward
+    所有层共用块号，第i层的K/V存在k_pool[i]/v_pool[i]里([num_kv_heads, num_blocks, block_size, d])；
+    每步解码前用bind()设置这一步的batch
+    """
+    def __init__(self, num_layers, num_blocks, block_size, num_kv_heads, d_k, d_v, dtype=torch.float32, device=None):
+        self.block_size = block_size
+        # 用0初始化，未写入的位置参与矩阵乘时不会产生nan
+        self.k_pool = torch.zeros(num_layers, num_kv_heads, num_blocks, block_size, d_k, dtype=dtype, device=device)
+        self.v_pool = torch.zeros(num_layers, num_kv_heads, num_blocks, block_size, d_v, dtype=dtype, device=device)
+        self.layers = [PagedLayerKVCache(self, i) for i in range(num_layers)]
+        self.block_table = None
+        self.seq_lens = None
+        # 各层按块表取出K/V时共用的缓冲区，只在batch的块数变多时重新分配
+        self._buffers = {}
+
+    def gather_buffer(self, name, pool, num_blocks):
+        """
+        返回能放下pool中num_blocks个块的缓冲区[num_kv_heads, num_blocks, block_size, d]，各层共用
+        """
+        shape = (pool.size(0), num_blocks) + tuple(pool.shape[2:])
+        numel = pool.size(0) * num_blocks * pool.size(2) * pool.size(3)
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.numel() < numel:
+            buffer = pool.new_empty(numel)
+            self._buffers[name] = buffer
+        return buffer[:numel].view(shape)
+
+    @classmethod
+    def for_model(cls, model, num_blocks, block_size, dtype=None, device=None):
+        """
+        按model(Transformer或Decoder)的decoder层数和K/V形状创建缓存
+        """
+        decoder = model.decoder if isinstance(model, Transformer) else model
+        attn = decoder.layers[0].dec_attn
+        param = next(decoder.parameters())
+        return cls(
+            len(decoder.layers), num_blocks, block_size, attn.num_kv_heads, attn.d_k, attn.d_v,
+            dtype or param.dtype, device or param.device,
+        )
+
+    def nbytes(self):
+        return self.k_pool.numel() * self.k_pool.element_size() + self.v_pool.numel() * self.v_pool.element_size()
+
+    def bind(self, block_table, seq_lens):
+        """
+        Args:
+            block_table: (b, max_blocks) block ids of every row, from BlockManager.block_table.
+            seq_lens: (b,) number of cached tokens of every row, new tokens are written after them.
+        """
+        self.block_table = block_table
+        self.seq_lens = seq_lens
+
+    def __getitem__(self, idx):
+        return self.layers[idx]
+
+    def __len__(self):
+        return len(self.layers)
+
+    @property
+    def seq_len(self):
+        # 每行的长度不同，Decoder按行取位置编码
+        return self.seq_lens
+
+class Request:
+    """
+    一个解码请求的状态
+    """
+    def __init__(self, request_id, X, max_len):
+        self.request_id = request_id
+        self.X = X                  # (T, fbank_dim)
+        self.max_len = max_len
+        self.memory = None          # 每层交叉注意力的(K, V)，[num_kv_heads, T, d]
+        self.output_ids = []        # 生成的token，不含sos
+        self.finished = False
+
+    @property
+    def num_cached(self):
+        # 已经送进Decoder的token数(sos + 除最后一个以外的输出)
+        return len(self.output_ids)
+
+class ContinuousBatchingScheduler:
+    """
+    连续批处理的贪心解码调度器
+    每步：移除结束的请求并回收它们的块 -> 按空闲块加入新请求(新请求单独编码一次) -> 所有请求一起解码一个token
+    空闲块不够时抢占最后加入的请求：释放它的块、放回等待队列最前面，之后从头重新解码(贪心解码结果不变)
+    """
+    def __init__(
+        self, model: Transformer, sos_id: int, eos_id: int,
+        max_batch_size: int = 32, num_blocks: int = 1024, block_size: int = 16, max_len: int = 200, watermark: int = 1,
+    ):
+        """
+        args:
+            model: Transformer
+            sos_id: id of start-of-sentence token
+            eos_id: id of end-of-sentence token
+            max_batch_size: maximum number of requests decoded together
+            num_blocks: number of KV blocks in the pool, the KV memory is fixed at construction
+            block_size: tokens per block
+            max_len: default maximum number of generated tokens (including eos) of a request
+            watermark: free blocks kept when admitting a request, so running requests can grow without preemption
+        """
+        self.model = model.eval()
+        self.sos_id = sos_id
+        self.eos_id = eos_id
+        self.max_batch_size = max_batch_size
+        self.max_len = max_len
+        self.watermark = watermark
+        self.block_manager = BlockManager(num_blocks, block_size)
+        self.cache = PagedKVCache.for_model(model, num_blocks, block_size)
+        self.waiting = deque()
+        self.running = []
+        self.finished = OrderedDict()
+        self._next_id = 0
+        self._memory = None         # 当前batch的EncoderMemory和交叉注意力掩码，batch组成变化时重建
+        self.stats = {"steps": 0, "tokens": 0, "preemptions": 0, "batch_size_sum": 0, "utilization_sum": 0.}
+
+    def add_request(self, X, max_len=None):
+        """
+        加入一个请求，返回request_id
+        Args:
+            X: (T, fbank_dim) features of one utterance, without padding.
+            max_len: maximum number of generated tokens (including eos), defaults to the scheduler's max_len.
+        """
+        max_len = max_len or self.max_len
+        if self.block_manager.blocks_needed(max_len) > self.block_manager.num_blocks:
+            raise ValueError(f"max_len={max_len} does not fit into {self.block_manager.num_blocks} blocks")
+        request = Request(self._next_id, X, max_len)
+        self._next_id += 1
+        self.waiting.append(request)
+        return request.request_id
+
+    def has_unfinished(self):
+        return bool(self.waiting or self.running)
+
+    def _preempt(self):
+        request = self.running.pop()
+        self.block_manager.free(request.request_id)
+        request.output_ids = []
+        self.waiting.appendleft(request)
+        self.stats["preemptions"] += 1
+        self._memory = None
+
+    def _reserve(self):
+        """
+        为每个运行中的请求预留这一步的KV位置，块不够时从最后加入的请求开始抢占
+        """
+        i = 0
+        while i < len(self.running):
+            request = self.running[i]
+            if self.block_manager.ensure(request.request_id, request.num_cached + 1):
+                i += 1
+            else:
+                self._preempt()
+
+    def _admit(self):
+        admitted = []
+        while self.waiting and len(self.running) + len(admitted) < self.max_batch_size:
+            if self.block_manager.num_free_blocks < 1 + self.watermark and (self.running or admitted):
+                break
+            request = self.waiting.popleft()
+            if not self.block_manager.ensure(request.request_id, 1):
+                self.waiting.appendleft(request)
+                break
+            admitted.append(request)
+        if not admitted:
+            return
+        # 新请求一起编码一次，交叉注意力的K/V按各自的长度保存
+        new = [r for r in admitted if r.memory is None]
+        if new:
+            X = pad_sequence([r.X for r in new], batch_first=True)
+            X_lens = torch.tensor([r.X.size(0) for r in new], device=X.device)
+            memory = self.model.decoder.build_memory(self.model.encode(X, X_lens))
+            for i, r in enumerate(new):
+                r.memory = [(K[i, :, :r.X.size(0)], V[i, :, :r.X.size(0)]) for K, V in memory.kv]
+        self.running.extend(admitted)
+        self._memory = None
+
+    def _batch_memory(self):
+        if self._memory is None:
+            # pad_sequence按第0维对齐，[num_kv_heads, T, d] 先转成 [T, num_kv_heads, d]
+            def pad(tensors):
+                return pad_sequence([t.transpose(0, 1) for t in tensors], batch_first=True).transpose(1, 2)
+            num_layers = len(self.running[0].memory)
+            kv = [
+                (pad([r.memory[i][0] for r in self.running]), pad([r.memory[i][1] for r in self.running]))
+                for i in range(num_layers)
+            ]
+            key_lens = torch.tensor([r.X.size(0) for r in self.running], device=kv[0][0].device)
+            self._memory = EncoderMemory(None, kv), AttnMask(key_lens=key_lens)
+        return self._memory
+
+    @torch.no_grad()
+    def step(self):
+        """
+        解码一步，返回这一步结束的请求列表
+        """
+        self._admit()
+        self._reserve()
+        if not self.running:
+            return []
+        model, running = self.model, self.running
+        device = self.cache.k_pool.device
+        memory, dec_enc_mask = self._batch_memory()
+        seq_lens = torch.tensor([r.num_cached for r in running], device=device)
+        tokens = torch.tensor(
+            [[r.output_ids[-1] if r.output_ids else self.sos_id] for r in running], device=device,
+        )
+        self.cache.bind(self.block_manager.block_table([r.request_id for r in running], device), seq_lens)
+        # 每行只看自己已缓存的token和新token
+        dec_mask = AttnMask(key_lens=seq_lens + 1)
+        dec_out = model.decoder(tokens, memory, dec_mask, dec_enc_mask, self.cache)
+        next_tokens = model.linear(dec_out[:, -1]).argmax(dim=-1).tolist()
+
+        self.stats["steps"] += 1
+        self.stats["tokens"] += len(running)
+        self.stats["batch_size_sum"] += len(running)
+        self.stats["utilization_sum"] += self.block_manager.utilization({r.request_id: r.num_cached + 1 for r in running})
+        done = []
+        for request, token in zip(running, next_tokens):
+            request.output_ids.append(token)
+            if token == self.eos_id or len(request.output_ids) >= request.max_len:
+                request.finished = True
+                done.append(request)
+        if done:
+            for request in done:
+                self.block_manager.free(request.request_id)
+                self.finished[request.request_id] = request
+            self.running = [r for r in running if not r.finished]
+            self._memory = None
+        return done
+
+    def run(self):
+        """
+        解码直到所有请求结束，返回 {request_id: (n,) 不含eos的token id}
+        """
+        while self.has_unfinished():
+            self.step()
+        outputs = {}
+        for request_id, request in self.finished.items():
+            ids = request.output_ids
+            if ids and ids[-1] == self.eos_id:
+                ids = ids[:-1]
+            outputs[request_id] = torch.tensor(ids, dtype=torch.long)
+        return outputs
+
+if __name__ == "__main__":
+    import time
+
+    from TransformerDemo import DEMO_FBANK_DIM, DEMO_MAX_FEAT_LEN, DEMO_MAX_LABEL_LEN, demo_model
+
+    num_requests = 64
+    max_batch_size = 16
+
+    feat_lens = torch.randint(10, DEMO_MAX_FEAT_LEN, (num_requests,))
+    features = [torch.randn(int(T), DEMO_FBANK_DIM) for T in feat_lens]
+    # 每个请求的输出长度不同，模拟长短不一的回复
+    max_lens = torch.randint(5, DEMO_MAX_LABEL_LEN, (num_requests,)).tolist()
+    transformer = demo_model().eval()
+
+    # 静态批处理：按到达顺序每max_batch_size个请求填充成一个batch，解码到batch里最长的请求结束
+    start = time.perf_counter()
+    static = {}
+    with torch.no_grad():
+        for i in range(0, num_requests, max_batch_size):
+            ids = range(i, min(i + max_batch_size, num_requests))
+            X = pad_sequence([features[j] for j in ids], batch_first=True)
+            tokens, lengths = transformer.generate(X, feat_lens[list(ids)], 0, 1, max(max_lens[j] for j in ids))
+            for row, j in enumerate(ids):
+                static[j] = tokens[row, :min(int(lengths[row]), max_lens[j])]
+    static_time = time.perf_counter() - start
+
+    scheduler = ContinuousBatchingScheduler(
+        transformer, sos_id=0, eos_id=1, max_batch_size=max_batch_size, num_blocks=48, block_size=16,
+    )
+    for x, max_len in zip(features, max_lens):
+        scheduler.add_request(x, max_len)
+    start = time.perf_counter()
+    outputs = scheduler.run()
+    continuous_time = time.perf_counter() - start
+
+    tokens = sum(len(o) for o in outputs.values())
+    stats = scheduler.stats
+    same = all(torch.equal(outputs[j], static[j]) for j in range(num_requests))
+    print(f"KV pool: {scheduler.cache.nbytes() / 2**20:.1f} MB, outputs equal to static batching: {same}")
+    print(f"static batching:     {static_time:.2f} s, {tokens / static_time:.1f} tok/s")
+    print(
+        f"continuous batching: {continuous_time:.2f} s, {tokens / continuous_time:.1f} tok/s, "
+        f"{stats['steps']} steps, mean batch {stats['batch_size_sum'] / stats['steps']:.1f}, "
+        f"{stats['preemptions']} preemptions, mean block utilization {stats['utilization_sum'] / stats['steps']:.2f}"
+    )
@@ -0,0 +1,231 @@
+# Encoder/Decoder逐层、逐子模块的耗时/FLOPs/激活内存统计
+#
+# 用法:
+#   profiler = LayerProfiler(transformer)
+#   with profiler:                  # 进入时注册hook，退出时移除，不启用时没有任何开销
+#       transformer(X, X_lens, labels)
+#   print(profiler.table())
+#   profiler.export_chrome_trace("trace.json")   # 在 chrome://tracing 或 Perfetto 中打开
+import json
+import time
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+
+from TransformerDemo import Decoder, Encoder, LinearPoswiseFFN, MultiHeadAttention, PackedMask, PoswiseFFN
+
+def _tensor_bytes(output):
+    if isinstance(output, torch.Tensor):
+        return output.numel() * output.element_size()
+    if isinstance(output, (tuple, list)):
+        return sum(_tensor_bytes(o) for o in output)
+    return 0
+
+def _linear_flops(tokens, in_features, out_features):
+    # 一次乘加算2个FLOP
+    return 2 * tokens * in_features * out_features
+
+def attention_flops(module: MultiHeadAttention, args, kwargs):
+    """
+    估算一次MultiHeadAttention.forward的FLOPs(投影 + QK^T + 注意力加权 + 输出投影)
+    """
+    Q, K = args[0], args[1]
+    attn_mask = args[3] if len(args) > 3 else kwargs.get("attn_mask")
+    cache, memory = kwargs.get("cache"), kwargs.get("memory")
+    h, d_k, d_v, d_model = module.num_heads, module.d_k, module.d_v, module.d_model
+    N, q_len = Q.size(0), Q.size(1)
+    flops = _linear_flops(N * q_len, d_model, h * d_k)
+    if memory is None:
+        flops += _linear_flops(N * K.size(1), d_model, module.num_kv_heads * (d_k + d_v))
+    if isinstance(attn_mask, PackedMask):
+        qk_pairs = sum((qe - qs) * (ke - ks) for qs, qe, ks, ke in attn_mask.segments())
+    else:
+        # 在post hook里调用，cache已经追加了本次的新token；k_len是append返回给注意力的K的长度，
+        # LeftContextKVCache追加后会裁剪，cache.len比实际参与计算的key数少
+        if memory is not None:
+            k_len = memory[0].size(2)
+        elif cache is not None:
+            k_len = cache.k_len
+        else:
+            k_len = K.size(1)
+        if module.window is not None:
+            # 局部注意力：每个query只看两侧window个key和num_global个全局key，全局token的行看所有key
+            qk_pairs = N * (q_len * (min(2 * module.window + 1, k_len) + module.num_global) + module.num_global * k_len)
+        else:
+            qk_pairs = N * q_len * k_len
+    flops += 2 * h * qk_pairs * (d_k + d_v)
+    flops += _linear_flops(N * q_len, h * d_v, d_model)
+    return flops
+
+def ffn_flops(module, args, kwargs):
+    X = args[0]
+    tokens = X.numel() // X.size(-1)
+    return _linear_flops(tokens, module.d_model, module.d_ff) + _linear_flops(tokens, module.d_ff, module.d_model)
+
+def layer_norm_flops(module, args, kwargs):
+    # 均值、方差、归一化、仿射变换，每个元素约5个FLOP
+    return 5 * args[0].numel()
+
+class _Stats:
+    __slots__ = ("calls", "time", "flops", "activation_bytes")
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.
+        self.flops = 0
+        self.activation_bytes = 0
+
+class LayerProfiler:
+    """
+    挂在Encoder.layers / Decoder.layers上的profiler，不修改模型代码
+    对每层本身和它的直接子模块(注意力、FFN、LayerNorm)记录耗时、估算FLOPs和输出激活的字节数，
+    多次调用累加；只在启用期间注册hook，关闭后模型上不留任何hook
+    """
+    FLOP_ESTIMATORS = {
+        MultiHeadAttention: attention_flops,
+        PoswiseFFN: ffn_flops,
+        LinearPoswiseFFN: ffn_flops,
+        nn.LayerNorm: layer_norm_flops,
+    }
+
+    def __init__(self, model: nn.Module, record_trace=True):
+        """
+        Args:
+            model: a Transformer/Encoder/Decoder, every Encoder/Decoder inside it is profiled.
+            record_trace: keep every call for export_chrome_trace, otherwise only the aggregates.
+        """
+        self.model = model
+        self.record_trace = record_trace
+        self.stats = OrderedDict()      # name -> _Stats
+        self.events = []                # (name, start, duration, flops, activation_bytes)
+        self._handles = []
+        self._starts = {}
+        self._origin = time.perf_counter()
+
+    def _targets(self):
+        """
+        返回 [(名字, 模块)]：每个EncoderLayer/DecoderLayer本身及其直接子模块
+        """
+        targets = []
+        for name, module in self.model.named_modules():
+            if not isinstance(module, (Encoder, Decoder)):
+                continue
+            prefix = f"{name}.layers" if name else "layers"
+            for i, layer in enumerate(module.layers):
+                targets.append((f"{prefix}.{i}", layer))
+                for child_name, child in layer.named_children():
+                    if not isinstance(child, nn.Dropout):
+                        targets.append((f"{prefix}.{i}.{child_name}", child))
+        return targets
+
+    def _estimate_flops(self, module, args, kwargs):
+        for cls, estimator in self.FLOP_ESTIMATORS.items():
+            if isinstance(module, cls):
+                return estimator(module, args, kwargs)
+        return 0
+
+    def enable(self):
+        if self._handles:
+            return self
+        for name, module in self._targets():
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name), with_kwargs=True))
+            self._handles.append(module.register_forward_hook(self._post_hook(name), with_kwargs=True))
+        return self
+
+    def disable(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, *exc):
+        self.disable()
+
+    def reset(self):
+        self.stats.clear()
+        self.events = []
+        self._origin = time.perf_counter()
+
+    def _pre_hook(self, name):
+        def hook(module, args, kwargs):
+            # 在pre hook里建立统计项，table()中层排在它的子模块前面
+            if name not in self.stats:
+                self.stats[name] = _Stats()
+            self._starts[name] = time.perf_counter()
+        return hook
+
+    def _post_hook(self, name):
+        def hook(module, args, kwargs, output):
+            end = time.perf_counter()
+            start = self._starts.pop(name)
+            is_layer = name.rsplit(".", 1)[-1].isdigit()
+            # 层本身的FLOPs是子模块之和，在table()里汇总，这里不重复估算
+            flops = 0 if is_layer else self._estimate_flops(module, args, kwargs)
+            activation_bytes = _tensor_bytes(output)
+            stats = self.stats[name]
+            stats.calls += 1
+            stats.time += end - start
+            stats.flops += flops
+            stats.activation_bytes += activation_bytes
+            if self.record_trace:
+                self.events.append((name, start - self._origin, end - start, flops, activation_bytes))
+        return hook
+
+    def summary(self):
+        """
+        返回 {名字: {calls, time_ms, gflops, gflops_per_s, activation_mb}}，层的FLOPs为子模块之和
+        """
+        rows = OrderedDict()
+        for name, stats in self.stats.items():
+            rows[name] = {
+                "calls": stats.calls,
+                "time_ms": stats.time * 1e3,
+                "gflops": stats.flops / 1e9,
+                "activation_mb": stats.activation_bytes / 2**20,
+            }
+        for name, row in rows.items():
+            if name.rsplit(".", 1)[-1].isdigit():
+                row["gflops"] = sum(r["gflops"] for n, r in rows.items() if n.startswith(name + "."))
+            row["gflops_per_s"] = row["gflops"] / (row["time_ms"] / 1e3) if row["time_ms"] > 0 else 0.
+        return rows
+
+    def table(self):
+        rows = self.summary()
+        width = max([len(n) for n in rows] + [4])
+        lines = [f"{'name':<{width}s} {'calls':>6s} {'time(ms)':>10s} {'GFLOPs':>9s} {'GFLOP/s':>9s} {'act(MB)':>9s}"]
+        for name, r in rows.items():
+            lines.append(
+                f"{name:<{width}s} {r['calls']:6d} {r['time_ms']:10.3f} {r['gflops']:9.3f} "
+                f"{r['gflops_per_s']:9.2f} {r['activation_mb']:9.2f}"
+            )
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """
+        导出Chrome trace格式(JSON)，层和子模块按嵌套关系显示
+        """
+        trace = [
+            {
+                "name": name, "ph": "X", "pid": 0, "tid": 0,
+                "ts": start * 1e6, "dur": duration * 1e6,
+                "args": {"flops": flops, "activation_bytes": activation_bytes},
+            }
+            for name, start, duration, flops, activation_bytes in self.events
+        ]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+if __name__ == "__main__":
+    from TransformerDemo import demo_batch, demo_model
+
+    fbank_feature, feat_lens, labels, _ = demo_batch()
+    transformer = demo_model().eval()
+
+    profiler = LayerProfiler(transformer)
+    with torch.no_grad(), profiler:
+        transformer(fbank_feature, feat_lens, labels)
+        transformer.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=10)
+    print(profiler.table())
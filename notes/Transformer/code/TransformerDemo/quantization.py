@@ -0,0 +1,99 @@
+# Transformer的int8动态量化CPU推理
+#
+# 注意力的W_Q/W_K/W_V/W_out(包括融合后的W_QKV/W_KV)、FFN的两层投影和最后的Transformer.linear
+# 权重量化成int8，激活在每次矩阵乘之前按张量动态量化，不需要校准数据集；
+# frontend和词嵌入保持fp32。掩码、KVCache、EncoderMemory和BeamSearch都不受影响。
+import copy
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+from TransformerDemo import LinearPoswiseFFN, PoswiseFFN, Transformer
+from metrics import latency_ms, logits_drift, token_agreement
+
+def convert_ffn_to_linear(model: nn.Module):
+    """
+    把Conv1d实现的PoswiseFFN原地替换成等价的LinearPoswiseFFN(动态量化只支持nn.Linear)
+    fused_bias_relu直接读取fp32权重，量化时也关掉
+    """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, PoswiseFFN) or (isinstance(child, LinearPoswiseFFN) and child.fused_bias_relu):
+                ffn = LinearPoswiseFFN(child.d_model, child.d_ff, p=child.dropout.p)
+                ffn.load_state_dict(child.state_dict())
+                setattr(module, name, ffn.to(next(child.parameters()).device))
+    return model
+
+def quantize_int8(model: Transformer, inplace=False) -> Transformer:
+    """
+    返回int8动态量化的推理模型(eval模式)
+    Args:
+        model: fp32 Transformer.
+        inplace: convert model itself instead of a copy.
+    """
+    if not inplace:
+        model = copy.deepcopy(model)
+    model.eval()
+    convert_ffn_to_linear(model)
+    # 只量化encoder/decoder里的nn.Linear和输出层，权重按输出通道量化，精度比按张量量化好
+    qconfig_spec = {
+        name: per_channel_dynamic_qconfig
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and (name.startswith(("encoder.", "decoder.")) or name == "linear")
+    }
+    return quantize_dynamic(model, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+def weight_bytes(model: nn.Module):
+    """
+    模型权重占用的字节数，量化后的Linear按打包的int8权重和fp32 bias计算
+    """
+    total = 0
+    for module in model.modules():
+        if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+            weight, bias = module._weight_bias()
+            total += weight.numel() * weight.element_size()
+            total += 0 if bias is None else bias.numel() * bias.element_size()
+        else:
+            total += sum(p.numel() * p.element_size() for p in module.parameters(recurse=False))
+    return total
+
+@torch.no_grad()
+def accuracy_report(fp32_model: Transformer, int8_model: Transformer, X, X_lens, labels, sos_id=0, eos_id=1, max_len=20):
+    """
+    用一批校准数据比较int8模型和fp32模型：有效位置上logits的误差、top-1一致率、贪心解码的token一致率，
+    以及权重内存和前向耗时
+    """
+    fp32_model.eval()
+    int8_model.eval()
+    X_lens = X_lens.long()
+    # decoder self-attention只有因果掩码，所有label位置的logits都参与比较
+    report = logits_drift(fp32_model(X, X_lens, labels), int8_model(X, X_lens, labels))
+
+    ref_tokens, ref_lens = fp32_model.generate(X, X_lens, sos_id, eos_id, max_len)
+    tokens, _ = int8_model.generate(X, X_lens, sos_id, eos_id, max_len)
+    report["greedy_token_agreement"] = token_agreement(ref_tokens, ref_lens, tokens, eos_id, max_len)
+
+    fp32_bytes, int8_bytes = weight_bytes(fp32_model), weight_bytes(int8_model)
+    fp32_ms = latency_ms(lambda: fp32_model(X, X_lens, labels))
+    int8_ms = latency_ms(lambda: int8_model(X, X_lens, labels))
+    report.update({
+        "fp32_weight_mb": fp32_bytes / 2**20,
+        "int8_weight_mb": int8_bytes / 2**20,
+        "weight_compression": fp32_bytes / int8_bytes,
+        "fp32_forward_ms": fp32_ms,
+        "int8_forward_ms": int8_ms,
+        "speedup": fp32_ms / int8_ms,
+    })
+    return report
+
+if __name__ == "__main__":
+    from TransformerDemo import demo_batch, demo_model
+
+    fbank_feature, feat_lens, labels, _ = demo_batch()
+    transformer = demo_model().eval()
+    int8_transformer = quantize_int8(transformer)
+
+    report = accuracy_report(transformer, int8_transformer, fbank_feature, feat_lens, labels)
+    for key, value in report.items():
+        print(f"{key:>24s}: {value:.4f}")
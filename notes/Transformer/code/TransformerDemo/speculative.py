@@ -0,0 +1,284 @@
+# 用小的draft Decoder做投机解码(speculative decoding)
+#
+# 用法:
+#   draft = truncated_draft(transformer.decoder, num_layers=2)        # 或者单独训练的1~2层Decoder
+#   distill_draft(transformer, draft, X, X_lens, labels)              # 可选：用目标模型的输出分布蒸馏draft
+#   decoder = SpeculativeDecoder(transformer, draft, num_draft=4)
+#   tokens, lengths = decoder(X, X_lens, sos_id=0, eos_id=1)          # 和transformer.generate的结果相同
+#
+# 每一轮draft逐个提出num_draft个token，目标Decoder把它们和上一个token一起做一次前向计算，
+# 得到每个位置自己的预测；从头开始接受和目标一致的draft token，第一个不一致的位置换成目标的token。
+# 一轮至少得到1个token，最多num_draft+1个，目标Decoder的前向次数少于输出的token数。
+# temperature > 0 时用拒绝采样决定是否接受，输出服从目标模型的采样分布。
+# batch里每个样本接受的token数不同，KV缓存用paged_decoding.PagedKVCache按行记录长度，
+# 没被接受的token不需要回退，下一轮直接覆盖。
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from TransformerDemo import AttnMask, Decoder, Transformer
+from paged_decoding import BlockManager, PagedKVCache
+
+def truncated_draft(decoder: Decoder, num_layers: int) -> Decoder:
+    """
+    复制decoder的词嵌入和前num_layers层作为draft
+    """
+    draft = copy.deepcopy(decoder)
+    draft.layers = draft.layers[:num_layers]
+    return draft
+
+def distill_draft(
+    model: Transformer, draft: Decoder, X, X_lens, labels, draft_linear: nn.Module = None, steps=100, lr=1e-4,
+):
+    """
+    用目标模型在labels(以sos开头)上每个位置的输出分布训练draft，损失为KL散度，只更新draft的参数
+    Returns:
+        losses: list of the loss of every step.
+    """
+    draft_linear = draft_linear or model.linear
+    X_lens, labels = X_lens.long(), labels.long()
+    model.eval()
+    with torch.no_grad():
+        enc_out = model.encode(X, X_lens)
+        dec_mask, dec_enc_mask = AttnMask(is_causal=True), AttnMask(key_lens=X_lens)
+        target = torch.log_softmax(model.linear(model.decoder(labels, enc_out, dec_mask, dec_enc_mask)), dim=-1)
+    draft.train()
+    optimizer = torch.optim.Adam(draft.parameters(), lr=lr)
+    losses = []
+    for _ in range(steps):
+        log_probs = torch.log_softmax(draft_linear(draft(labels, enc_out, dec_mask, dec_enc_mask)), dim=-1)
+        loss = F.kl_div(log_probs.flatten(0, 1), target.flatten(0, 1), log_target=True, reduction="batchmean")
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    draft.eval()
+    return losses
+
+def causal_mask(seq_lens, q_len, k_len):
+    """
+    每行新token的因果掩码，[N, 1, q_len, k_len]，True表示屏蔽
+    第n行的第i个新token位于seq_lens[n] + i，只能看到不超过这个位置的key
+    """
+    positions = seq_lens.unsqueeze(1) + torch.arange(q_len, device=seq_lens.device)
+    return (torch.arange(k_len, device=seq_lens.device) > positions.unsqueeze(-1)).unsqueeze(1)
+
+class SpeculativeDecoder:
+    """
+    投机解码：batch里所有样本一起提出和验证，每个样本按自己接受的token数前进，结束的样本从batch中移除
+    """
+    def __init__(
+        self,model:Transformer,draft:Decoder,draft_linear:nn.Module=None,
+        num_draft:int=4,temperature:float=0.,generator:torch.Generator=None,block_size:int=16,
+    ):
+        """
+        args:
+            model: target Transformer, its encoder output is shared with the draft
+            draft: Decoder with the same dec_dim as model.decoder, usually 1-2 layers
+            draft_linear: output projection of the draft, defaults to model.linear
+            num_draft: number of tokens proposed by the draft per round
+            temperature: 0 is greedy decoding, otherwise sample from softmax(logits / temperature)
+            generator: random generator used when sampling
+            block_size: block size of the KV caches
+        """
+        assert num_draft >= 1
+        self.model = model
+        self.draft = draft
+        self.draft_linear = draft_linear or model.linear
+        self.num_draft = num_draft
+        self.temperature = temperature
+        self.generator = generator
+        self.block_size = block_size
+        self.stats = {"rounds": 0, "row_rounds": 0, "tokens": 0, "proposed": 0, "accepted": 0}
+
+    def _probs(self, logits):
+        return torch.softmax(logits.float() / self.temperature, dim=-1)
+
+    def _sample(self, probs):
+        shape = probs.shape[:-1]
+        return torch.multinomial(probs.reshape(-1, probs.size(-1)), 1, generator=self.generator).view(*shape, 1)
+
+    def _forward(self, decoder, linear, tokens, seq_lens, memory, dec_enc_mask, cache, block_table):
+        """
+        把tokens写在每行的seq_lens之后做一次前向计算，返回(b, q_len, V)的logits
+        """
+        q_len = tokens.size(1)
+        # 只取用得到的块，注意力的长度跟着最长的行增长
+        num_blocks = -(-int((seq_lens + q_len).max()) // self.block_size)
+        block_table = block_table[:, :num_blocks]
+        cache.bind(block_table, seq_lens)
+        dec_mask = causal_mask(seq_lens, q_len, num_blocks * self.block_size)
+        return linear(decoder(tokens, memory, dec_mask, dec_enc_mask, cache))
+
+    def _propose(self, history, hist_lens, draft_lens, memory, dec_enc_mask, cache, block_table):
+        """
+        draft逐个生成num_draft个token，返回(b, num_draft)的token和采样时每步的分布(b, num_draft, V)
+        draft的缓存最多比history少两个token，第一步把缺的token一起送进去(已缓存的位置重新写一遍)
+        """
+        q_len = int((hist_lens - draft_lens).max())
+        seq_lens = hist_lens - q_len
+        tokens = history.gather(1, seq_lens.unsqueeze(1) + torch.arange(q_len, device=history.device))
+        drafted, probs = [], []
+        for _ in range(self.num_draft):
+            logits = self._forward(
+                self.draft, self.draft_linear, tokens, seq_lens, memory, dec_enc_mask, cache, block_table,
+            )[:, -1]
+            seq_lens = seq_lens + tokens.size(1)
+            if self.temperature > 0:
+                probs.append(self._probs(logits))
+                tokens = self._sample(probs[-1])
+            else:
+                tokens = logits.argmax(dim=-1, keepdim=True)
+            drafted.append(tokens)
+        return torch.cat(drafted, dim=1), torch.stack(probs, dim=1) if probs else None
+
+    def _verify(self, drafted, draft_probs, logits):
+        """
+        返回每个样本接受的draft token数a (b,)，以及第a个位置的token (b, 1)
+        Args:
+            drafted: (b, k) proposed tokens.
+            draft_probs: (b, k, V) draft distributions, None for greedy decoding.
+            logits: (b, k+1, V) target logits, position i predicts the token after drafted[:, :i].
+        """
+        k = drafted.size(1)
+        if self.temperature == 0:
+            target = logits.argmax(dim=-1)
+            num_accepted = (drafted == target[:, :k]).long().cumprod(dim=1).sum(dim=1)
+            return num_accepted, target.gather(1, num_accepted.unsqueeze(1))
+        probs = self._probs(logits)
+        p = probs[:, :k].gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+        q = draft_probs.gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+        # 以min(1, p/q)的概率接受draft的token
+        accepted = torch.rand(p.shape, device=p.device, generator=self.generator) * q < p
+        num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+        # 全部接受的样本从目标在最后一个位置的分布中多采样一个token；
+        # 在第a个位置被拒绝的样本从 max(p - q, 0) 归一化后的分布中重新采样
+        rows = torch.arange(drafted.size(0), device=drafted.device)
+        index = num_accepted.clamp(max=k - 1)
+        residual = (probs[rows, index] - draft_probs[rows, index]).clamp(min=0)
+        norm = residual.sum(dim=-1, keepdim=True)
+        residual = torch.where(norm > 0, residual / norm.clamp(min=1e-20), probs[rows, index])
+        last = torch.where((num_accepted == k).unsqueeze(1), self._sample(probs[:, k]), self._sample(residual))
+        return num_accepted, last
+
+    @torch.no_grad()
+    def __call__(self,X:torch.Tensor,X_lens:torch.Tensor,sos_id:int,eos_id:int,max_len:int=200):
+        """
+        Returns:
+            tokens: (b, T) generated ids without sos, positions after eos are filled with eos_id.
+            lengths: (b,) number of tokens before eos.
+        """
+        model, k = self.model, self.num_draft
+        X_lens = X_lens.long()
+        b = X.size(0)
+        device = X.device
+        enc_out = model.encode(X,X_lens)
+        dec_enc_mask = AttnMask(key_lens=X_lens)
+        memory = model.decoder.build_memory(enc_out)
+        draft_memory = self.draft.build_memory(enc_out)
+        # 每行一次分配到最大长度，两个缓存共用同一张块表
+        capacity = max_len + k + 1
+        manager = BlockManager(b * -(-capacity // self.block_size), self.block_size)
+        for row in range(b):
+            manager.ensure(row, capacity)
+        block_table = manager.block_table(range(b), device)
+        cache = PagedKVCache.for_model(model, manager.num_blocks, self.block_size)
+        draft_cache = PagedKVCache.for_model(self.draft, manager.num_blocks, self.block_size)
+
+        # history[:, :hist_lens]是每行的sos和已经生成的token，目标的缓存里是除最后一个以外的token
+        # 已经结束的样本从batch中移除，结果写到outputs里，alive是还在解码的样本的原始下标
+        history = torch.full((b,capacity + 1),eos_id,dtype=torch.long,device=device)
+        history[:,0] = sos_id
+        outputs = history.clone()
+        hist_lens = torch.ones(b,dtype=torch.long,device=device)
+        draft_lens = torch.zeros(b,dtype=torch.long,device=device)
+        lengths = torch.full((b,),max_len,dtype=torch.long,device=device)
+        alive = torch.arange(b,device=device)
+        columns = torch.arange(k + 1,device=device)
+        while alive.numel() > 0:
+            drafted, draft_probs = self._propose(
+                history,hist_lens,draft_lens,draft_memory,dec_enc_mask,draft_cache,block_table,
+            )
+            draft_lens = hist_lens + k - 1
+            tokens = torch.cat([history.gather(1,(hist_lens - 1).unsqueeze(1)),drafted],dim=1)
+            logits = self._forward(
+                model.decoder,model.linear,tokens,hist_lens - 1,memory,dec_enc_mask,cache,block_table,
+            )
+            num_accepted, last = self._verify(drafted,draft_probs,logits)
+
+            # 每行新增 接受的draft token + 目标给出的token，不超过max_len，遇到eos为止
+            new_tokens = F.pad(drafted,(0,1)).scatter(1,num_accepted.unsqueeze(1),last)
+            num_new = (num_accepted + 1).minimum(max_len - (hist_lens - 1))
+            is_eos = (new_tokens == eos_id) & (columns < num_new.unsqueeze(1))
+            has_eos = is_eos.any(dim=1)
+            first_eos = is_eos.long().argmax(dim=1)
+            num_new = torch.where(has_eos,first_eos + 1,num_new)
+            rows, cols = (columns < num_new.unsqueeze(1)).nonzero(as_tuple=True)
+            history[rows,hist_lens[rows] + cols] = new_tokens[rows,cols]
+
+            n = alive.numel()
+            self.stats["rounds"] += 1
+            self.stats["row_rounds"] += n
+            self.stats["tokens"] += int(num_new.sum())
+            self.stats["proposed"] += k * n
+            self.stats["accepted"] += int(num_accepted.minimum(num_new - 1).sum())
+            lengths[alive[has_eos]] = (hist_lens - 1 + first_eos)[has_eos]
+            hist_lens = hist_lens + num_new
+            # 缓存中超出history的部分是没被接受的token，下一轮会被覆盖
+            draft_lens = draft_lens.minimum(hist_lens - 1)
+
+            finished = has_eos | (hist_lens - 1 >= max_len)
+            if finished.any():
+                outputs[alive[finished]] = history[finished]
+                keep = (~finished).nonzero().view(-1)
+                alive = alive[keep]
+                history, hist_lens, draft_lens = history[keep], hist_lens[keep], draft_lens[keep]
+                block_table = block_table[keep]
+                memory, draft_memory = memory.index_select(keep), draft_memory.index_select(keep)
+                dec_enc_mask = dec_enc_mask.index_select(keep)
+        # 和generate一样，在所有样本都结束的那一步截断，eos之后填充eos_id
+        T = int((lengths + 1).clamp(max=max_len).max())
+        tokens = outputs[:,1:1 + T]
+        return tokens.masked_fill(torch.arange(T,device=device) > lengths.unsqueeze(1),eos_id),lengths
+
+    def summary(self):
+        stats = self.stats
+        row_rounds = max(stats["row_rounds"], 1)
+        return {
+            "acceptance_rate": stats["accepted"] / max(stats["proposed"], 1),
+            "tokens_per_round": stats["tokens"] / row_rounds,
+            "target_passes_per_token": row_rounds / max(stats["tokens"], 1),
+        }
+
+if __name__ == "__main__":
+    import time
+
+    from TransformerDemo import DEMO_MAX_LABEL_LEN, demo_batch, demo_model
+
+    fbank_feature, feat_lens, _, _ = demo_batch()
+    batch_size, max_label_len = fbank_feature.size(0), DEMO_MAX_LABEL_LEN
+    transformer = demo_model().eval()
+
+    start = time.perf_counter()
+    ref_tokens, ref_lens = transformer.generate(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=max_label_len)
+    greedy_time = time.perf_counter() - start
+
+    # 随机初始化的模型没有可以学的规律，这里在同一批语音上蒸馏draft，只用来演示接受率高时的效果
+    draft = truncated_draft(transformer.decoder, num_layers=2)
+    labels = torch.cat([torch.zeros(batch_size, 1, dtype=torch.long), ref_tokens[:, :-1]], dim=1)
+    losses = distill_draft(transformer, draft, fbank_feature, feat_lens, labels, steps=150, lr=3e-4)
+    print(f"draft distillation loss: {losses[0]:.3f} -> {losses[-1]:.3f}")
+
+    for num_draft in (2, 4):
+        speculative = SpeculativeDecoder(transformer, draft, num_draft=num_draft)
+        start = time.perf_counter()
+        tokens, lengths = speculative(fbank_feature, feat_lens, sos_id=0, eos_id=1, max_len=max_label_len)
+        speculative_time = time.perf_counter() - start
+        same = torch.equal(tokens, ref_tokens) and torch.equal(lengths, ref_lens)
+        summary = ", ".join(f"{key} {value:.3f}" for key, value in speculative.summary().items())
+        print(
+            f"num_draft={num_draft}: greedy {greedy_time:.2f} s, speculative {speculative_time:.2f} s, "
+            f"outputs equal: {same}, {summary}"
+        )